@@ -1,20 +1,30 @@
+import io
+import json
 import logging.config
+import queue
 
 import sqlite3
+import time
 import traceback
-import pickle
 
+# numpy, pandas and the serving modules stay module-level: every scoring route needs them, and deferring them would
+# only move their import into the first request's latency, or out of what `gunicorn --preload` shares with workers
+import numpy as np
 import pandas as pd
-import yaml
 import sqlalchemy.exc
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, Response, g, render_template, request, redirect, url_for, jsonify
 
 # pylint: disable=locally-disabled, invalid-name
 
 # For setting up the Flask-SQLAlchemy database session
+from src.batching import MicroBatcher
 from src.create_db import ChurnManager, Customer
-from src.modeling import pred_one_record
-from src.process_data import validate_input
+from src.metrics import metrics
+from src.modeling import pred_one_record, predict_batch
+from src.prediction_cache import PredictionCache
+from src.process_data import validate_batch, validate_record
+from src.registry import ModelRegistry
+from src.write_behind import WriteBehindQueue
 
 # Initialize the Flask application
 app = Flask(__name__, template_folder='app/templates',
@@ -39,24 +49,136 @@ logger.debug(
 # Initialize the database session
 churn_manager = ChurnManager(app)
 
+# Model and configuration are loaded once per worker and reloaded when a new model is trained
+registry = ModelRegistry(app.config['MODEL_PATH'], app.config['CONFIG_PATH'],
+                         app.config['FEATURE_SCHEMA_PATH'], check_interval=app.config['MODEL_RELOAD_INTERVAL'])
+
+# Concurrent single-record predictions are scored together, each with the model version its request looked up,
+# so a reload while records wait never caches one model's prediction under another's version
+batcher = None
+if app.config['BATCHING_ENABLED']:
+    batcher = MicroBatcher(max_batch_size=app.config['BATCH_MAX_SIZE'],
+                           max_wait_ms=app.config['BATCH_MAX_WAIT_MS'],
+                           max_queue_depth=app.config['BATCH_QUEUE_DEPTH'])
+
+# Predictions of feature vectors scored before are served from the cache until the model changes
+prediction_cache = None
+if app.config['PREDICTION_CACHE_ENABLED']:
+    prediction_cache = PredictionCache(max_entries=app.config['PREDICTION_CACHE_MAX_ENTRIES'],
+                                       ttl_seconds=app.config['PREDICTION_CACHE_TTL'],
+                                       store_path=app.config['PREDICTION_CACHE_PATH'])
+
+
+def write_customers(records: list) -> None:
+    """Upsert customer records from the write-behind thread, which needs its own app context for a session."""
+    with app.app_context():
+        churn_manager.upsert_customers(records)
+
+
+# Customer records of /predict are written in the background, in batches, instead of one commit per request
+write_behind = None
+if app.config['WRITE_BEHIND_ENABLED']:
+    write_behind = WriteBehindQueue(write_customers,
+                                    max_queue_depth=app.config['WRITE_BEHIND_QUEUE_DEPTH'],
+                                    max_batch_size=app.config['WRITE_BEHIND_BATCH_SIZE'],
+                                    flush_interval_ms=app.config['WRITE_BEHIND_FLUSH_MS'],
+                                    overflow=app.config['WRITE_BEHIND_OVERFLOW'],
+                                    submit_timeout=app.config['WRITE_BEHIND_TIMEOUT'],
+                                    wal_dir=app.config['WRITE_BEHIND_WAL_DIR'],
+                                    wal_fsync=app.config['WRITE_BEHIND_WAL_FSYNC'])
+    # replays records a crashed worker left in the write-ahead log
+    write_behind.start()
+
+
+def warmup() -> None:
+    """
+        Load the model, feature schema and configuration and score one record, so the files are read and the
+        model's dependencies imported once, before serving. Under `gunicorn --preload` the workers forked afterwards
+        share the loaded model; if it is missing, every worker loads it on its first request instead.
+    """
+    start = time.perf_counter()
+    try:
+        rf_model, schema, model_version = registry.versioned_model()
+        config = registry.config
+    except FileNotFoundError as e:
+        logger.warning('Model not warmed up, the workers will load it on their first request: %s', e)
+        return
+    rf_model.predict_proba(np.zeros((1, len(schema.features))))
+    logger.info('Model %s and %d configuration sections loaded and warmed up in %.1f ms', model_version, len(config),
+                (time.perf_counter() - start) * 1000)
+
+
+if app.config['MODEL_WARMUP']:
+    warmup()
+
+
+@app.before_request
+def start_request_timer():
+    """Remember when the request started, for its latency in /metrics."""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response: Response) -> Response:
+    """
+        Record the latency and status code of the request by route, not by URL, so ids do not multiply the series.
+        A streamed response is timed until its first chunk is ready, not until the client has received it all.
+        Returns:
+            The response, unchanged
+    """
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if 'request_started' in g:
+        metrics.observe('churn_http_request_seconds', time.perf_counter() - g.request_started, endpoint=endpoint,
+                        method=request.method)
+    metrics.inc('churn_http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+def parse_customer_filters(args) -> dict:
+    """
+        Parse the keyset cursor, page size and filters of the customer listing from query parameters.
+        Returns:
+            Keyword arguments for ChurnManager.list_customers
+    """
+    filters = {'limit': min(int(args.get('limit', app.config['MAX_ROWS_SHOW'])), app.config['MAX_PAGE_SIZE'])}
+    if filters['limit'] < 1:
+        raise ValueError('limit must be at least 1')
+    for name in ('after_id', 'min_service_calls', 'max_service_calls'):
+        if args.get(name):
+            filters[name] = int(args[name])
+    for name in ('churn', 'international_plan', 'voice_mail_plan'):
+        if args.get(name):
+            if args[name] not in ('Yes', 'No'):
+                raise ValueError(f'{name} must be Yes or No')
+            filters[name] = args[name]
+    return filters
+
 
 @app.route('/')
 def index():
     """Main view of customer data from churn table in the database.
 
     Create view into index page that uses data queried from Customer database and
-    inserts it into the app/templates/index.html template.
+    inserts it into the app/templates/index.html template. Query parameters select
+    the page (`after_id`) and filter the customers (see `parse_customer_filters`).
 
     Returns:
         Rendered html template
 
     """
     try:
-        customers = churn_manager.session.query(Customer).order_by(Customer.id).\
-            limit(app.config['MAX_ROWS_SHOW'])
+        filters = parse_customer_filters(request.args)
+    except ValueError as e:
+        logger.error('Error: invalid customer filters: %s', e)
+        return render_template('error.html')
+    try:
+        customers, next_after_id = churn_manager.list_customers(**filters)
 
         logger.debug('Index page accessed')
-        return render_template('index.html', customers=customers)
+        next_args = None
+        if next_after_id is not None:
+            next_args = {**request.args.to_dict(), 'after_id': next_after_id}
+        return render_template('index.html', customers=customers, filters=request.args, next_args=next_args)
     except sqlite3.OperationalError as e:
         logger.error(
             'Error page returned. Not able to query local sqlite database: %s.'
@@ -75,6 +197,49 @@ def index():
         return render_template('error.html')
 
 
+@app.route('/api/customers')
+def api_customers():
+    """
+        List customers page by page as JSON, with the same cursor and filters as the index page.
+        Returns:
+            JSON response with the customers of the page and the `after_id` cursor of the next page
+    """
+    try:
+        filters = parse_customer_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        customers, next_after_id = churn_manager.list_customers(**filters)
+    except (sqlite3.OperationalError, sqlalchemy.exc.OperationalError) as e:
+        logger.error('Not able to query database: %s. Error: %s', app.config['SQLALCHEMY_DATABASE_URI'], e)
+        return jsonify({'error': 'Database is not available'}), 503
+    columns = [col.name for col in Customer.__table__.columns]
+    return jsonify({'customers': [{col: getattr(customer, col) for col in columns} for customer in customers],
+                    'next_after_id': next_after_id})
+
+
+@app.route('/api/stats')
+def api_stats():
+    """
+        Churn rate and mean usage by plan flags and bucket of customer service calls, read from the precomputed
+        churn_segments table. `by` lists the dimensions to break down by, comma-separated; all three by default.
+        Returns:
+            JSON response with the totals and one entry per segment
+    """
+    by = None
+    if 'by' in request.args:
+        by = [dim for dim in request.args['by'].split(',') if dim]
+    try:
+        segments = churn_manager.segment_stats(by)
+        totals = churn_manager.segment_stats([])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except (sqlite3.OperationalError, sqlalchemy.exc.OperationalError) as e:
+        logger.error('Not able to query database: %s. Error: %s', app.config['SQLALCHEMY_DATABASE_URI'], e)
+        return jsonify({'error': 'Database is not available'}), 503
+    return jsonify({'totals': totals[0] if totals else None, 'segments': segments})
+
+
 @app.route('/predict', methods=['POST'])
 def predict_churn():
     """
@@ -97,9 +262,7 @@ def predict_churn():
     intl_calls = request.form['intl_calls']
     service_calls = request.form['service_calls']
 
-    # Load configuration file
-    with open('config/config.yaml', 'r', encoding='utf8') as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+    config = registry.config
 
     record = {'id': cust_id,
               'international_plan': intl_plan,
@@ -111,37 +274,48 @@ def predict_churn():
               'total_intl_minutes': intl_mins,
               'total_intl_calls': intl_calls,
               'customer_service_calls': service_calls}
-    record_df = pd.DataFrame(record, index=[0])
     # Validate user input data
     try:
-        valid_record_df = validate_input(record_df, **config['process_data']['validate_input'])
+        valid_record = validate_record(record, **config['process_data']['validate_input'])
     except ValueError as e:
         logger.error('Error: %s', e)
         return render_template('error.html')
 
     # Predict churn label
     try:
-        with open('models/rf_model.pkl', 'rb') as f:
-            rf_model = pickle.load(f)
+        rf_model, schema, model_version = registry.versioned_model()
     except FileNotFoundError:
-        logger.error('File not found, please check if model object is saved')
-    churn_pred = pred_one_record(rf_model,
-                                 columns=config['modeling']['pred_one_record']['columns'],
-                                 record_df=valid_record_df)
-    if churn_pred == 0:
+        logger.error('File not found, please check if model object and feature schema are saved')
+        return render_template('error.html')
+    try:
+        churn_pred = pred_one_record(rf_model, schema, valid_record, batcher=batcher, cache=prediction_cache,
+                                     model_version=model_version)
+    except queue.Full:
+        logger.error('Error page returned. Too many predictions are waiting to be scored')
+        return render_template('error.html')
+    if churn_pred in (0, 'No'):
         final_churn_pred = 'No'
     else:
         final_churn_pred = 'Yes'
 
+    if write_behind is not None:
+        try:
+            write_behind.submit({**valid_record, 'churn': final_churn_pred})
+        except queue.Full:
+            logger.error('Error page returned. Too many customer records are waiting to be written')
+            return render_template('error.html')
+        logger.info('One customer record queued: customer id %s', request.form['id'])
+        return redirect(url_for('index'))
+
     try:
-        churn_manager.add_one_record(valid_record_df['id'].item(), intl_plan, vm_plan,
-                                     valid_record_df['number_vmail_messages'].item(),
-                                     valid_record_df['total_day_minutes'].item(),
-                                     valid_record_df['total_eve_minutes'].item(),
-                                     valid_record_df['total_night_minutes'].item(),
-                                     valid_record_df['total_intl_minutes'].item(),
-                                     valid_record_df['total_intl_calls'].item(),
-                                     valid_record_df['customer_service_calls'].item(),
+        churn_manager.add_one_record(valid_record['id'], intl_plan, vm_plan,
+                                     valid_record['number_vmail_messages'],
+                                     valid_record['total_day_minutes'],
+                                     valid_record['total_eve_minutes'],
+                                     valid_record['total_night_minutes'],
+                                     valid_record['total_intl_minutes'],
+                                     valid_record['total_intl_calls'],
+                                     valid_record['customer_service_calls'],
                                      final_churn_pred)
         logger.info('One customer record added: customer id %s', request.form['id'])
         return redirect(url_for('index'))
@@ -166,6 +340,131 @@ def predict_churn():
         return render_template('error.html')
 
 
+def read_batch_payload(max_records: int) -> pd.DataFrame:
+    """
+        Parse a batch of records from a JSON (list of records or {"records": [...]}) or CSV request body.
+        Args:
+            max_records (int): records accepted; parsing stops one record past it, so that oversized payloads are
+                recognized without building a dataframe of all their records
+        Returns:
+            Dataframe with one row per record
+    """
+    if request.mimetype == 'text/csv':
+        return pd.read_csv(io.StringIO(request.get_data(as_text=True)), nrows=max_records + 1)
+    payload = request.get_json(force=True, silent=True)
+    if payload is None:
+        raise ValueError('Request body is not valid JSON')
+    if isinstance(payload, dict):
+        payload = payload.get('records')
+    if not isinstance(payload, list):
+        raise ValueError('JSON payload must be a list of records or an object with a "records" list')
+    records = payload[:max_records + 1]
+    if not all(isinstance(record, dict) for record in records):
+        raise ValueError('Every record must be a JSON object')
+    return pd.DataFrame.from_records(records)
+
+
+def stream_predictions(pred_df: pd.DataFrame, as_csv: bool):
+    """
+        Serialize prediction results chunk by chunk as CSV or newline-delimited JSON.
+        Yields:
+            Chunks of the response body
+    """
+    chunk_size = app.config['API_STREAM_CHUNK_SIZE']
+    for start in range(0, len(pred_df), chunk_size):
+        chunk = pred_df.iloc[start:start + chunk_size]
+        if as_csv:
+            yield chunk.to_csv(index=False, header=start == 0)
+        else:
+            yield ''.join(json.dumps(row) + '\n' for row in chunk.to_dict(orient='records'))
+
+
+@app.route('/api/predict', methods=['POST'])
+def api_predict():
+    """
+        Predict customer churn for a batch of records posted as JSON or CSV.
+        Returns:
+            Streamed CSV (for CSV input) or newline-delimited JSON with one prediction per record
+    """
+    try:
+        record_df = read_batch_payload(app.config['API_MAX_RECORDS'])
+    except (ValueError, pd.errors.ParserError) as e:
+        logger.error('Error: not able to parse batch payload: %s', e)
+        return jsonify({'error': f'Not able to parse payload: {e}'}), 400
+    if len(record_df) > app.config['API_MAX_RECORDS']:
+        return jsonify({'error': f'At most {app.config["API_MAX_RECORDS"]} records are accepted'}), 413
+    if record_df.empty:
+        # e.g. a CSV body with only a header row; there is nothing to validate or score
+        return jsonify({'error': 'No records'}), 400
+
+    config = registry.config
+    try:
+        rf_model, schema, model_version = registry.versioned_model()
+    except FileNotFoundError:
+        logger.error('File not found, please check if model object and feature schema are saved')
+        return jsonify({'error': 'Model is not available'}), 503
+    missing = [col for col in schema.columns if col not in record_df.columns]
+    if missing:
+        return jsonify({'error': f'Missing columns: {missing}'}), 400
+    valid_df, invalid, errors = validate_batch(record_df, categories=schema.categories,
+                                               **config['process_data']['validate_input'])
+    if invalid.all():
+        logger.error('Error: all %d records are invalid, e.g. %s', len(record_df), errors.iloc[0])
+        return jsonify({'error': 'No valid records', 'errors': errors.head(10).tolist()}), 400
+    try:
+        pred_df = predict_batch(rf_model, schema, valid_df, cache=prediction_cache, model_version=model_version)
+    except ValueError as e:
+        logger.error('Error: %s', e)
+        return jsonify({'error': str(e)}), 400
+
+    pred_df = pred_df.rename(columns={'pred_class': 'churn', 'pred_proba': 'churn_proba'})
+    if 'id' in valid_df.columns:
+        pred_df.insert(0, 'id', valid_df['id'])
+    if invalid.any():
+        # rejected records keep their place in the response, with their id as sent, no prediction and the reason
+        logger.warning('%d of %d records rejected, e.g. %s', invalid.sum(), len(record_df), errors.iloc[0])
+        pred_df = pred_df.astype(object).reindex(record_df.index)
+        if 'id' in record_df.columns:
+            pred_df.loc[invalid, 'id'] = record_df.loc[invalid, 'id']
+        pred_df['error'] = errors
+        pred_df = pred_df.where(pred_df.notna(), None)
+    logger.info('Batch prediction made for %d records', int((~invalid).sum()))
+
+    as_csv = request.mimetype == 'text/csv'
+    return Response(stream_predictions(pred_df, as_csv),
+                    mimetype='text/csv' if as_csv else 'application/x-ndjson')
+
+
+@app.route('/api/status')
+def status():
+    """
+        Report the active model version, registry load/cache statistics, micro-batching metrics, prediction
+        cache hit ratio and evictions, write-behind queue depth and counters, and database connection pool usage.
+        Returns:
+            JSON response
+    """
+    stats = registry.stats()
+    if batcher is not None:
+        stats['batcher'] = batcher.stats()
+    if prediction_cache is not None:
+        stats['prediction_cache'] = prediction_cache.stats()
+    if write_behind is not None:
+        stats['write_behind'] = write_behind.stats()
+    stats['db_pool'] = churn_manager.pool_stats()
+    return jsonify(stats)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+        Export request latencies and the time spent validating, encoding, scoring and writing to the database in
+        the Prometheus text format. Every worker process reports its own metrics.
+        Returns:
+            Prometheus text response
+    """
+    return Response(metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     app.run(debug=app.config['DEBUG'], port=app.config['PORT'],
             host=app.config['HOST'])
@@ -0,0 +1,99 @@
+"""Async serving mode: the Flask app behind an asyncio server, with the same routes as app.py.
+
+The event loop accepts connections and reads request bodies; each request is then handled by the Flask views in a
+pool of ASGI_THREADS threads, so validation and inference of concurrent requests overlap with the network I/O of
+others. Customer records of /predict go through the write-behind queue (WRITE_BEHIND_ENABLED is on by default
+here), so a prediction is returned without waiting on the database. The queue is drained when the server shuts
+down.
+
+Run from the root of the repo:
+    uvicorn asgi:application --host 0.0.0.0 --port 5001
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+# pylint: disable=locally-disabled, invalid-name, wrong-import-position
+
+os.environ.setdefault('WRITE_BEHIND_ENABLED', 'true')
+
+from app import app, write_behind
+
+logger = logging.getLogger(app.config['APP_NAME'])
+
+executor = ThreadPoolExecutor(max_workers=app.config['ASGI_THREADS'], thread_name_prefix='asgi')
+
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    """One request of the wrapped Flask app, run in the shared thread pool instead of asgiref's single thread.
+
+    WsgiToAsgi has no setting for the executor its requests run in, so `run_wsgi_app` is overridden with one built
+    on the instance's public WSGI parts (`build_environ`, `start_response` and `sync_send`) rather than on asgiref's
+    own decorated implementation.
+    """
+
+    async def run_wsgi_app(self, body):  # pylint: disable=invalid-overridden-method
+        await sync_to_async(self.serve, thread_sensitive=False, executor=executor)(body)
+
+    def serve(self, body) -> None:
+        """Run the Flask app on the request body and send its response, in a thread of the pool."""
+        try:
+            environ = self.build_environ(self.scope, body)
+        except ValueError:
+            # too many duplicate headers
+            self.sync_send({'type': 'http.response.start', 'status': 400,
+                            'headers': [(b'content-type', b'text/plain')]})
+            self.sync_send({'type': 'http.response.body', 'body': b'Bad Request'})
+            return
+        response = self.wsgi_application(environ, self.start_response)
+        try:
+            bytes_sent = 0
+            for output in response:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                if self.response_content_length is not None:
+                    output = output[:self.response_content_length - bytes_sent]
+                self.sync_send({'type': 'http.response.body', 'body': output, 'more_body': True})
+                bytes_sent += len(output)
+                if bytes_sent == self.response_content_length:
+                    break
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+class ChurnApplication(WsgiToAsgi):
+    """ASGI application serving the Flask app, which also drains the write-behind queue on shutdown."""
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        await ThreadPoolWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+    @staticmethod
+    async def lifespan(receive, send) -> None:
+        """Answer the server's startup and shutdown events, writing the queued customer records before exiting."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                logger.info('Serving with %d threads, write-behind %s', app.config['ASGI_THREADS'],
+                            'on' if write_behind is not None else 'off')
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if write_behind is not None:
+                    await sync_to_async(write_behind.close, thread_sensitive=False, executor=executor)()
+                executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = ChurnApplication(app)
@@ -0,0 +1,58 @@
+"""Write and read times of the cleaned data as CSV, Parquet and Feather, at multiples of the raw data size.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_artifacts --scales 10 100
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import pandas as pd
+import yaml
+
+from src.artifacts import ARTIFACT_FORMATS
+from src.modeling import load_table, save_table
+from src.process_data import clean_data
+
+# pylint: disable=locally-disabled, invalid-name
+
+
+def best_of(fn, repeat: int) -> float:
+    """Return the fastest of `repeat` calls of `fn`, in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pipeline artifact formats')
+    parser.add_argument('--raw_data_path', default='data/external/raw_data.csv', help='Raw data to scale up')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--scales', default=[10, 100], type=int, nargs='+',
+                        help='Multiples of the raw data size to benchmark')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per measurement; the fastest is reported')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    train_config = config['modeling']['train_model']
+    projection = train_config['used_features'] + [train_config['target']]
+    cleaned = clean_data(pd.read_csv(args.raw_data_path), config['process_data']['clean_data']['target'])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scales:
+            data = pd.concat([cleaned] * scale, ignore_index=True)
+            print(f'{scale}x raw data: {len(data):,} rows, {data.shape[1]} columns')
+            print(f'{"format":>8} {"write ms":>10} {"read ms":>10} {"projected read ms":>18} {"size MB":>8}')
+            for fmt in ARTIFACT_FORMATS:
+                path = os.path.join(tmp_dir, f'final_data_{scale}.{fmt}')
+                write_ms = best_of(lambda data=data, path=path: save_table(data, path), args.repeat)
+                read_ms = best_of(lambda path=path: load_table(path), args.repeat)
+                projected_ms = best_of(lambda path=path: load_table(path, columns=projection), args.repeat)
+                print(f'{fmt:>8} {write_ms:>10.1f} {read_ms:>10.1f} {projected_ms:>18.1f} '
+                      f'{os.path.getsize(path) / 1024 / 1024:>8.2f}')
+            print()
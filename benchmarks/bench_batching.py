@@ -0,0 +1,51 @@
+"""Throughput of concurrent single-record predictions with and without micro-batching.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_batching
+"""
+import argparse
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import yaml
+
+from src.batching import MicroBatcher
+from src.modeling import build_feature_schema, train_model
+from src.process_data import clean_data
+
+# pylint: disable=locally-disabled, invalid-name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark micro-batching of concurrent predictions')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--data_path', default='data/external/raw_data.csv', help='Raw data to train on')
+    parser.add_argument('--n_requests', default=2000, type=int, help='Number of predictions to make')
+    parser.add_argument('--n_threads', default=32, type=int, help='Number of concurrent callers')
+    parser.add_argument('--max_batch_size', default=64, type=int, help='Most records per model call')
+    parser.add_argument('--max_wait_ms', default=2.0, type=float, help='Longest a record waits for others')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    used_features = config['modeling']['train_model']['used_features']
+    data = clean_data(pd.read_csv(args.data_path), config['process_data']['clean_data']['target'])
+    rf, *_ = train_model(data, **config['modeling']['train_model'])
+    schema = build_feature_schema(data, used_features)
+    records = data[used_features].to_dict(orient='records')
+    rows = [schema.encode_record(records[i % len(records)]) for i in range(args.n_requests)]
+
+    batcher = MicroBatcher(rf.predict_proba, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           max_queue_depth=args.n_requests)
+    variants = {'one model call per request': lambda row: rf.predict_proba(row)[0],
+                'micro-batched': batcher.predict_proba}
+    for name, predict in variants.items():
+        with ThreadPoolExecutor(args.n_threads) as pool:
+            start = time.perf_counter()
+            list(pool.map(predict, rows))
+            elapsed = time.perf_counter() - start
+        print(f'{name:<28} {args.n_requests / elapsed:>10,.0f} predictions/s')
+    print('batcher metrics:', batcher.stats())
@@ -0,0 +1,58 @@
+"""Peak memory and time of cleaning the raw data in memory against chunked streaming, for growing files.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_clean --scales 10 100 --chunksize 50000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from src.modeling import save_table
+from src.process_data import clean_data, clean_data_streaming
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def make_raw_data(raw_data_path: str, scale: int, path: str) -> None:
+    """Write `scale` copies of the raw data rows to `path`, one copy at a time."""
+    raw = pd.read_csv(raw_data_path)
+    for i in range(scale):
+        raw.to_csv(path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+
+
+def clean_in_memory(raw_path: str, output_path: str, target: str) -> float:
+    """Clean the whole file at once like `run.py clean_data` without --chunksize; return peak traced MB."""
+    tracemalloc.start()
+    save_table(clean_data(pd.read_csv(raw_path), target), output_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark in-memory against streaming cleaning')
+    parser.add_argument('--raw_data_path', default='data/external/raw_data.csv', help='Raw data to scale up')
+    parser.add_argument('--scales', default=[10, 100], type=int, nargs='+',
+                        help='Multiples of the raw data size to benchmark')
+    parser.add_argument('--chunksize', default=50000, type=int, help='Rows per chunk for streaming')
+    parser.add_argument('--target', default='churn', help='Target column name')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f'{"rows":>10} {"in-memory MB":>13} {"in-memory s":>12} {"streaming MB":>13} {"streaming s":>12}')
+        for scale in args.scales:
+            raw_path = os.path.join(tmp_dir, f'raw_{scale}.csv')
+            make_raw_data(args.raw_data_path, scale, raw_path)
+
+            start = time.perf_counter()
+            memory_mb = clean_in_memory(raw_path, os.path.join(tmp_dir, 'in_memory.parquet'), args.target)
+            memory_s = time.perf_counter() - start
+
+            profile = clean_data_streaming(raw_path, [os.path.join(tmp_dir, 'streaming.parquet')], args.target,
+                                           args.chunksize)
+            print(f'{profile["rows"]:>10,} {memory_mb:>13.1f} {memory_s:>12.2f} '
+                  f'{profile["peak_traced_mb"]:>13.1f} {profile["seconds"]:>12.2f}')
@@ -0,0 +1,57 @@
+"""Latency and throughput of RandomForestClassifier.predict_proba against the flattened forest evaluator.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_forest
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from src.forest import compile_forest
+from src.modeling import train_model
+from src.process_data import clean_data
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def time_per_call(func, n_iter: int) -> float:
+    """Mean latency in seconds of `func()` over `n_iter` calls."""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    return (time.perf_counter() - start) / n_iter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the flattened forest evaluator')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--data_path', default='data/external/raw_data.csv', help='Raw data to train on')
+    parser.add_argument('--batch_sizes', default=[1, 10, 100, 1000, 10000], type=int, nargs='+',
+                        help='Batch sizes to time')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    data = clean_data(pd.read_csv(args.data_path), config['process_data']['clean_data']['target'])
+    rf, X_train, X_test, _, _ = train_model(data, **config['modeling']['train_model'])
+    forest = compile_forest(rf)
+
+    X_all = pd.concat([X_train, X_test]).values.astype(np.float64)
+    assert np.array_equal(rf.predict_proba(X_all), forest.predict_proba(X_all)), 'outputs differ'
+    print('predict_proba outputs are bit-for-bit identical')
+
+    print(f'{"batch":>7} {"sklearn ms":>11} {"flat ms":>9} {"sklearn rows/s":>15} {"flat rows/s":>12}')
+    rng = np.random.default_rng(0)
+    for batch_size in args.batch_sizes:
+        X = X_all[rng.integers(0, len(X_all), batch_size)]
+        n_iter = max(3, min(200, 20000 // batch_size))
+        sk = time_per_call(lambda X=X: rf.predict_proba(X), max(3, n_iter // 10))
+        flat = time_per_call(lambda X=X: forest.predict_proba(X), n_iter)
+        print(f'{batch_size:>7} {sk * 1e3:>11.2f} {flat * 1e3:>9.2f} {batch_size / sk:>15,.0f} '
+              f'{batch_size / flat:>12,.0f}')
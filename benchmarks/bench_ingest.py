@@ -0,0 +1,84 @@
+"""Ingest throughput of the ORM path against chunked Core inserts on a synthetic customer file in SQLite.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_ingest --n_rows 1000000
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.create_db import ChurnManager, create_db
+
+# pylint: disable=locally-disabled, invalid-name
+
+
+def make_customers(n_rows: int, path: str, seed: int = 0, block_size: int = 100000) -> None:
+    """
+    Write a synthetic csv with the columns of the churn table, block by block to keep memory bounded
+    Args:
+        n_rows (int): number of customers
+        path (str): path to write the csv to
+        seed (int): random seed
+        block_size (int): rows generated and written at a time
+
+    Returns:
+        None
+    """
+    rng = np.random.default_rng(seed)
+    yes_no = np.array(['No', 'Yes'])
+    for start in range(0, n_rows, block_size):
+        n = min(block_size, n_rows - start)
+        pd.DataFrame({
+            'id': np.arange(start + 1, start + n + 1),
+            'international_plan': yes_no[rng.integers(0, 2, n)],
+            'voice_mail_plan': yes_no[rng.integers(0, 2, n)],
+            'number_vmail_messages': rng.integers(0, 50, n),
+            'total_day_minutes': rng.uniform(0, 350, n).round(1),
+            'total_eve_minutes': rng.uniform(0, 350, n).round(1),
+            'total_night_minutes': rng.uniform(0, 350, n).round(1),
+            'total_intl_minutes': rng.uniform(0, 20, n).round(1),
+            'total_intl_calls': rng.integers(0, 20, n),
+            'customer_service_calls': rng.integers(0, 10, n),
+            'churn': yes_no[rng.integers(0, 2, n)],
+        }).to_csv(path, index=False, mode='w' if start == 0 else 'a', header=start == 0)
+
+
+def ingest(input_path: str, db_path: str, chunksize) -> float:
+    """Ingest `input_path` into a fresh SQLite database and return rows/sec."""
+    engine_string = f'sqlite:///{db_path}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    start = time.perf_counter()
+    n_rows = cm.add_customer_data(input_path, chunksize=chunksize)
+    elapsed = time.perf_counter() - start
+    cm.close()
+    return n_rows / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark customer data ingest')
+    parser.add_argument('--n_rows', default=1000000, type=int, help='Rows of the synthetic file')
+    parser.add_argument('--orm_rows', default=100000, type=int,
+                        help='Rows ingested through the ORM path (it holds every row in memory at once)')
+    parser.add_argument('--chunksize', default=50000, type=int, help='Rows per chunk for streaming ingest')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full_path = os.path.join(tmp_dir, 'customers.csv')
+        orm_path = os.path.join(tmp_dir, 'customers_orm.csv')
+        make_customers(args.n_rows, full_path)
+        make_customers(min(args.orm_rows, args.n_rows), orm_path)
+
+        # streaming runs first, so the peak RSS it reports is not inflated by the ORM run
+        rate = ingest(full_path, os.path.join(tmp_dir, 'stream.db'), args.chunksize)
+        print(f'Chunked Core insert, {args.n_rows:,} rows: {rate:>12,.0f} rows/sec, '
+              f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+
+        rate = ingest(orm_path, os.path.join(tmp_dir, 'orm.db'), None)
+        print(f'ORM add_all, {min(args.orm_rows, args.n_rows):,} rows: {rate:>12,.0f} rows/sec, '
+              f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
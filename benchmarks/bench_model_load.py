@@ -0,0 +1,95 @@
+"""Cold-start load time and per-worker memory of the model as a pickle, a numpy archive and a memory-mapped forest.
+
+Every format is loaded by `--workers` fresh processes, like gunicorn workers starting up. Each reports how long
+`load_model` took (the loads take turns, so they do not compete for cores), and, once all workers hold the model, its
+resident memory (RSS) and its proportional share of memory (PSS), which splits pages shared between processes, such
+as a memory-mapped forest, across the processes that map them.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_model_load --workers 4 --n_estimators 500
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from src.forest import compile_forest
+from src.modeling import save_model, train_model
+from src.process_data import clean_data
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def memory_mb() -> dict:
+    """RSS and PSS of this process in MB, from /proc/self/smaps_rollup (Linux only)."""
+    usage = {}
+    with open('/proc/self/smaps_rollup', 'r', encoding='utf8') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                usage[key.lower()] = int(value.split()[0]) / 1024
+    return usage
+
+
+def worker(path: str, X: np.ndarray, lock, barrier, results) -> None:
+    """Load the model, score once, report load time and memory once every worker has loaded, then exit."""
+    # imported here, as an app worker does at startup, so the import is not part of the load time
+    import sklearn.ensemble  # pylint: disable=import-outside-toplevel,unused-import
+    from src.registry import load_model  # pylint: disable=import-outside-toplevel
+    before = memory_mb()
+    with lock:
+        start = time.perf_counter()
+        model = load_model(path)
+        load_ms = (time.perf_counter() - start) * 1000
+    barrier.wait()
+    after = memory_mb()
+    # scoring touches the pages a worker actually serves from
+    model.predict_proba(X)
+    results.put({'load_ms': load_ms, 'rss': after['rss'] - before['rss'], 'pss': after['pss'] - before['pss']})
+    barrier.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark model artifact formats at worker startup')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--data_path', default='data/external/raw_data.csv', help='Raw data to train on')
+    parser.add_argument('--workers', default=4, type=int, help='Worker processes loading the model at once')
+    parser.add_argument('--n_estimators', default=500, type=int, help='Trees in the benchmarked forest')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    data = clean_data(pd.read_csv(args.data_path), config['process_data']['clean_data']['target'])
+    rf, _, X_test, _, _ = train_model(data, model_params={'n_estimators': args.n_estimators},
+                                      **config['modeling']['train_model'])
+    X = X_test.values.astype(np.float32)
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {'pickle': os.path.join(tmp_dir, 'rf_model.pkl'),
+                 'npz': os.path.join(tmp_dir, 'rf_model_flat.npz'),
+                 'forest': os.path.join(tmp_dir, 'rf_model_flat.forest')}
+        save_model(rf, paths['pickle'])
+        forest = compile_forest(rf)
+        forest.save(paths['npz'])
+        forest.save(paths['forest'])
+
+        print(f'{args.n_estimators} trees, {args.workers} workers; memory is the growth per worker while loading')
+        print(f'{"format":>8} {"file MB":>8} {"load ms":>8} {"RSS MB":>7} {"PSS MB":>7}')
+        for fmt, path in paths.items():
+            lock, barrier, results = ctx.Lock(), ctx.Barrier(args.workers), ctx.Queue()
+            processes = [ctx.Process(target=worker, args=(path, X, lock, barrier, results))
+                         for _ in range(args.workers)]
+            for process in processes:
+                process.start()
+            reports = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            print(f'{fmt:>8} {os.path.getsize(path) / 2 ** 20:>8.2f} '
+                  f'{np.median([r["load_ms"] for r in reports]):>8.1f} '
+                  f'{np.mean([r["rss"] for r in reports]):>7.1f} {np.mean([r["pss"] for r in reports]):>7.1f}')
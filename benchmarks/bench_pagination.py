@@ -0,0 +1,73 @@
+"""Latency of a deep customer page with keyset pagination against OFFSET as the churn table grows.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_pagination --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from sqlalchemy.orm import Query
+
+from src.create_db import ChurnManager, Customer, create_db
+from benchmarks.bench_ingest import make_customers
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def time_per_call(func, n_iter: int) -> float:
+    """Mean latency in milliseconds of `func()` over `n_iter` calls."""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    return (time.perf_counter() - start) / n_iter * 1e3
+
+
+def keyset_page(cm: ChurnManager, page_size: int, after_id: int, filters: Dict[str, Any]) -> Callable[[], Any]:
+    """Function listing the page of `page_size` customers after `after_id` matching `filters`, by keyset."""
+    def list_page():
+        return cm.list_customers(page_size, after_id=after_id, **filters)
+    return list_page
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark paginated customer listing')
+    parser.add_argument('--sizes', default=[10000, 100000, 1000000], type=int, nargs='+',
+                        help='Numbers of customers in the churn table')
+    parser.add_argument('--page_size', default=10, type=int, help='Customers per page')
+    parser.add_argument('--depth', default=0.9, type=float, help='Position of the page as a fraction of the table')
+    parser.add_argument('--n_iter', default=20, type=int, help='Timed calls per variant')
+    args = parser.parse_args()
+
+    print(f'{"rows":>9} {"filter":>22} {"keyset ms":>10} {"offset ms":>10}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_rows in args.sizes:
+            csv_path = os.path.join(tmp_dir, f'customers_{n_rows}.csv')
+            engine_string = f'sqlite:///{os.path.join(tmp_dir, f"churn_{n_rows}.db")}'
+            make_customers(n_rows, csv_path)
+            create_db(engine_string)
+            cm = ChurnManager(engine_string=engine_string)
+            cm.add_customer_data(csv_path, chunksize=100000)
+
+            after_id = int(n_rows * args.depth)
+            variants: List[Tuple[str, Dict[str, Any]]] = [
+                ('none', {}),
+                ('churn=Yes', {'churn': 'Yes'}),
+                ('service calls 4-6', {'min_service_calls': 4, 'max_service_calls': 6})]
+            for name, filters in variants:
+                keyset = time_per_call(keyset_page(cm, args.page_size, after_id, filters), args.n_iter)
+                # same page addressed by OFFSET: count the matching rows before it, then skip them
+                query: Query = cm.session.query(Customer)
+                if 'churn' in filters:
+                    query = query.filter(Customer.churn == filters['churn'])
+                if 'min_service_calls' in filters:
+                    query = query.filter(Customer.customer_service_calls.between(filters['min_service_calls'],
+                                                                                 filters['max_service_calls']))
+                offset = query.filter(Customer.id <= after_id).count()
+                paged = query.order_by(Customer.id).offset(offset).limit(args.page_size)
+                offset_ms = time_per_call(paged.all, args.n_iter)
+                print(f'{n_rows:>9} {name:>22} {keyset:>10.2f} {offset_ms:>10.2f}')
+            cm.close()
@@ -0,0 +1,59 @@
+"""Throughput and peak memory of scoring a synthetic churn table in SQLite with `score_db`.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_score_db --n_rows 1000000 --batch_sizes 10000 50000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+import yaml
+
+from benchmarks.bench_ingest import make_customers
+from src.create_db import ChurnManager, create_db
+from src.modeling import build_feature_schema, train_model
+from src.process_data import clean_data
+
+# pylint: disable=locally-disabled, invalid-name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batch scoring of the churn table')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--data_path', default='data/external/raw_data.csv', help='Raw data to train on')
+    parser.add_argument('--n_rows', default=1000000, type=int, help='Customers in the synthetic churn table')
+    parser.add_argument('--batch_sizes', default=[10000, 50000], type=int, nargs='+',
+                        help='Customers per batch to benchmark')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    train_config = config['modeling']['train_model']
+    data = clean_data(pd.read_csv(args.data_path), config['process_data']['clean_data']['target'])
+    rf, _, _, _, _ = train_model(data, **train_config)
+    schema = build_feature_schema(data, train_config['used_features'])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'customers.csv')
+        engine_string = f'sqlite:///{os.path.join(tmp_dir, "churn.db")}'
+        make_customers(args.n_rows, input_path)
+        create_db(engine_string)
+        cm = ChurnManager(engine_string=engine_string)
+        cm.add_customer_data(input_path, chunksize=50000)
+        os.remove(input_path)
+
+        print(f'{"batch":>7} {"seconds":>8} {"rows/s":>9} {"peak traced MB":>15}')
+        for batch_size in args.batch_sizes:
+            start = time.perf_counter()
+            n_rows = cm.score_customers(rf, schema, 'bench', batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            # a second run under tracemalloc, which slows it down, for the peak memory
+            tracemalloc.start()
+            cm.score_customers(rf, schema, 'bench', batch_size=batch_size)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{batch_size:>7,} {elapsed:>8.1f} {n_rows / elapsed:>9,.0f} {peak / 2 ** 20:>15.1f}')
+        cm.close()
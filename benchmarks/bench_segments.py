@@ -0,0 +1,55 @@
+"""Latency of churn statistics read from the churn_segments summary table against a GROUP BY over the churn table.
+
+For growing synthetic churn tables in SQLite, `summary ms` is `ChurnManager.segment_stats`, which backs /api/stats,
+and `full scan ms` runs the GROUP BY query that `rebuild_segments` uses over every customer. Reading the summary
+costs the same at every size; the scan grows with the table. `rebuild s` is the one-pass rebuild of the summary.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_segments --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_ingest import make_customers
+from src.create_db import ChurnManager, create_db, segments_query
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def time_ms(fn, repeats: int) -> float:
+    """Median milliseconds of `repeats` calls of `fn`."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark churn statistics from the summary table')
+    parser.add_argument('--sizes', default=[10000, 100000, 1000000], type=int, nargs='+',
+                        help='Rows of the churn table')
+    parser.add_argument('--repeats', default=5, type=int, help='Calls timed per size')
+    args = parser.parse_args()
+
+    print(f'{"customers":>10} {"summary ms":>11} {"full scan ms":>13} {"rebuild s":>10}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            input_path = os.path.join(tmp_dir, f'customers_{size}.csv')
+            engine_string = f'sqlite:///{os.path.join(tmp_dir, f"churn_{size}.db")}'
+            make_customers(size, input_path)
+            create_db(engine_string)
+            cm = ChurnManager(engine_string=engine_string)
+            cm.add_customer_data(input_path, chunksize=50000)
+            summary_ms = time_ms(cm.segment_stats, args.repeats)
+            scan_ms = time_ms(lambda cm=cm: cm.session.execute(segments_query()).fetchall(), args.repeats)
+            start = time.perf_counter()
+            cm.rebuild_segments()
+            rebuild_s = time.perf_counter() - start
+            print(f'{size:>10,} {summary_ms:>11.2f} {scan_ms:>13.2f} {rebuild_s:>10.2f}')
+            cm.close()
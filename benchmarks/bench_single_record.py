@@ -0,0 +1,64 @@
+"""Per-record inference latency of the legacy DataFrame path against the frozen feature schema fast path.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_single_record
+"""
+import argparse
+import time
+import warnings
+
+import pandas as pd
+import yaml
+
+from src.modeling import build_feature_schema, train_model
+from src.process_data import clean_data
+
+# pylint: disable=locally-disabled, invalid-name
+
+
+def time_per_call(func, n_iter: int) -> float:
+    """Mean latency in microseconds of `func()` over `n_iter` calls."""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    return (time.perf_counter() - start) / n_iter * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark single record inference')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--data_path', default='data/external/raw_data.csv', help='Raw data to train on')
+    parser.add_argument('--n_iter', default=500, type=int, help='Number of timed calls per variant')
+    args = parser.parse_args()
+    # newer scikit-learn versions warn when a model fit on a dataframe receives a plain array
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    used_features = config['modeling']['train_model']['used_features']
+
+    data = clean_data(pd.read_csv(args.data_path), config['process_data']['clean_data']['target'])
+    rf, *_ = train_model(data, **config['modeling']['train_model'])
+    schema = build_feature_schema(data, used_features)
+    record = data[used_features].iloc[0].to_dict()
+
+    def legacy_encode():
+        """Encode the record with a one-row DataFrame and get_dummies, as before the feature schema."""
+        # the legacy one-row get_dummies emits misaligned column names, so only its values reach the model
+        return pd.get_dummies(pd.DataFrame(record, index=[0])[used_features]).values
+
+    def schema_encode():
+        """Encode the record with the frozen feature schema."""
+        return schema.encode_record(record)
+
+    results = {
+        'encode (DataFrame + get_dummies)': time_per_call(legacy_encode, args.n_iter),
+        'encode (feature schema)': time_per_call(schema_encode, args.n_iter),
+        'encode + predict (DataFrame + get_dummies)': time_per_call(lambda: rf.predict(legacy_encode()),
+                                                                    args.n_iter // 10),
+        'encode + predict (feature schema)': time_per_call(lambda: rf.predict(schema_encode()),
+                                                           args.n_iter // 10),
+    }
+    for name, latency in results.items():
+        print(f'{name:<45} {latency:>10.1f} us/record')
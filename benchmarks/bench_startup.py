@@ -0,0 +1,116 @@
+"""Import time of the CLI subcommands and the app, from `python -X importtime`, as a regression check.
+
+Every scenario runs in a fresh interpreter. The import time is the sum of the self times of all modules imported,
+the heaviest dependencies are ranked by their cumulative time. A scenario fails if it imports a dependency it should
+not need (e.g. scikit-learn for create_db), or, with `--baseline`, if its import time grew by more than
+`--tolerance` over the saved results.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_startup --save startup.json
+    python -m benchmarks.bench_startup --baseline startup.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+import yaml
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+# model pipeline steps read and write in the temporary directory, with a copy of the configuration pointing there
+PIPELINE_ARGS = ['--config', '{tmp}/config.yaml', '--force', '--n_jobs', '1'] + \
+    [arg for name in ('raw_data_dir', 'cleaned_data_dir', 'model_dir', 'X_train_dir', 'X_test_dir', 'y_train_dir',
+                      'y_test_dir', 'pred_result_dir', 'model_eval_dir') for arg in (f'--{name}', '{tmp}')]
+# name: (arguments of the interpreter, top-level packages the scenario must not import); acquire_data is left out
+# because it needs s3
+SCENARIOS = {
+    'run.py --help': (['run.py', '--help'], ['pandas', 'sklearn', 'boto3', 'sqlalchemy']),
+    'run.py create_db': (['run.py', 'create_db', '--engine_string', 'sqlite:///{tmp}/churn.db'], ['sklearn', 'boto3']),
+    'run.py ingest_data': (['run.py', 'ingest_data', '--engine_string', 'sqlite:///{tmp}/churn.db', '--input_path',
+                            'test/unit_test_data/final_data_test.csv'], ['sklearn', 'boto3']),
+    'run.py clean_data': (['run.py', 'clean_data'] + PIPELINE_ARGS, ['sklearn', 'boto3']),
+    'run.py train_model': (['run.py', 'train_model'] + PIPELINE_ARGS, ['boto3']),
+    'run.py predict': (['run.py', 'predict'] + PIPELINE_ARGS, ['boto3']),
+    'run.py evaluate': (['run.py', 'evaluate'] + PIPELINE_ARGS, ['boto3']),
+    'app.py': (['-c', 'import app'], ['sklearn', 'boto3']),
+}
+OWN_PACKAGES = ('src', 'app', 'config')
+
+
+def import_profile(args: List[str]) -> Dict:
+    """Run the interpreter with `-X importtime` and summarize the import times it reports."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args, capture_output=True, text=True, check=False)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'{" ".join(args)} failed:\n{result.stderr[-2000:]}')
+    total_us, packages = 0, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total_us += int(self_us)
+        module = name.strip()
+        # a package's own line comes after its submodules and its cumulative time includes them
+        if '.' not in module:
+            packages[module] = int(cumulative_us)
+    return {'import_ms': total_us / 1000, 'wall_s': wall, 'packages': packages}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark and check the startup imports of run.py and app.py')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs per scenario; the median is reported')
+    parser.add_argument('--save', default=None, help='Write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='Compare against results saved with --save')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Largest accepted growth of the import time over the baseline, as a fraction')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf8') as f:
+            baseline = json.load(f)
+
+    results, failures = {}, []
+    print(f'{"scenario":>20} {"import ms":>10} {"wall s":>7} {"baseline ms":>12}  '
+          'heaviest dependencies (cumulative ms)')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open('config/config.yaml', 'r', encoding='utf8') as f:
+            config = yaml.safe_load(f)
+        config['pipeline']['manifest_path'] = os.path.join(tmp_dir, 'pipeline_manifest.json')
+        config['metrics']['dump_dir'] = None
+        with open(os.path.join(tmp_dir, 'config.yaml'), 'w', encoding='utf8') as f:
+            yaml.safe_dump(config, f)
+        shutil.copy('test/unit_test_data/raw_data_test.csv', os.path.join(tmp_dir, config['s3']['raw_data_filename']))
+        for name, (scenario_args, forbidden) in SCENARIOS.items():
+            scenario_args = [arg.format(tmp=tmp_dir) for arg in scenario_args]
+            profiles = [import_profile(scenario_args) for _ in range(args.repeat)]
+            import_ms = float(np.median([p['import_ms'] for p in profiles]))
+            wall_s = float(np.median([p['wall_s'] for p in profiles]))
+            packages = profiles[-1]['packages']
+            results[name] = {'import_ms': round(import_ms, 1), 'wall_s': round(wall_s, 3)}
+            heaviest = sorted(((package, us) for package, us in packages.items() if package not in OWN_PACKAGES),
+                              key=lambda item: -item[1])[:4]
+            reference = baseline.get(name, {}).get('import_ms')
+            print(f'{name:>20} {import_ms:>10.1f} {wall_s:>7.2f} {reference if reference else "-":>12}  '
+                  + ', '.join(f'{package} {us / 1000:.0f}' for package, us in heaviest))
+            loaded = [package for package in forbidden if package in packages]
+            if loaded:
+                failures.append(f'{name} imports {loaded}')
+            if reference and import_ms > reference * (1 + args.tolerance):
+                failures.append(f'{name} imports in {import_ms:.0f} ms, {import_ms / reference - 1:.0%} over the '
+                                f'baseline of {reference:.0f} ms')
+
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,50 @@
+"""Wall-clock time and speedup of the hyperparameter search for growing numbers of worker processes.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_tuning --workers 1 2 4 --n_candidates 8
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+import yaml
+
+from src.modeling import split_data
+from src.process_data import clean_data
+from src.tuning import search
+
+# pylint: disable=locally-disabled, invalid-name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the parallel hyperparameter search')
+    parser.add_argument('--raw_data_path', default='data/external/raw_data.csv', help='Raw data to tune on')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--workers', default=[1, 2, 4], type=int, nargs='+', help='Worker counts to benchmark')
+    parser.add_argument('--n_candidates', default=8, type=int, help='Hyperparameter combinations to try')
+    parser.add_argument('--method', default='halving', choices=['random', 'halving'], help='Search method')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    train_config = config['modeling']['train_model']
+    tune_config = config['modeling']['tune_model']
+    data = clean_data(pd.read_csv(args.raw_data_path), config['process_data']['clean_data']['target'])
+    X_train, _, y_train, _ = split_data(data, train_config['used_features'], train_config['target'],
+                                        train_config['test_size'], train_config['random_state'])
+
+    print(f'{os.cpu_count()} cores, {args.n_candidates} candidates, {tune_config["n_splits"]} folds, '
+          f'{args.method} search')
+    print(f'{"workers":>8} {"seconds":>10} {"speedup":>8}')
+    baseline = None
+    for n_workers in args.workers:
+        start = time.perf_counter()
+        # no cache, so every run fits all folds
+        search(X_train, y_train, tune_config['search_space'], method=args.method, n_candidates=args.n_candidates,
+               n_splits=tune_config['n_splits'], scoring=tune_config['scoring'], n_workers=n_workers,
+               random_state=tune_config['random_state'], min_resource=tune_config['min_resource'],
+               max_resource=tune_config['max_resource'], factor=tune_config['factor'])
+        seconds = time.perf_counter() - start
+        baseline = baseline or seconds
+        print(f'{n_workers:>8} {seconds:>10.1f} {baseline / seconds:>8.2f}')
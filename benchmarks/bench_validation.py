@@ -0,0 +1,80 @@
+"""Throughput of validating a batch of records with `validate_batch` against `validate_record` called per record.
+
+Records are drawn from the raw data, with a fraction of them made invalid (a negative number, text in a numeric
+column or an unknown plan). Both are run on typed columns, as parsed from JSON or CSV, and on text columns, as posted
+from a form. The per-record loop runs on the first `--loop_rows` records only.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_validation --n_rows 1000000 --invalid_fraction 0.01
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from src.process_data import validate_batch, validate_record
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def make_records(data: pd.DataFrame, n_rows: int, invalid_fraction: float, seed: int = 0) -> pd.DataFrame:
+    """Sample `n_rows` records from `data` and spoil `invalid_fraction` of them, cycling through three faults."""
+    rng = np.random.default_rng(seed)
+    records = data.sample(n_rows, replace=True, random_state=seed).reset_index(drop=True)
+    records['id'] = np.arange(1, n_rows + 1)
+    bad = rng.choice(n_rows, int(n_rows * invalid_fraction), replace=False)
+    records.loc[bad[0::3], 'total_day_minutes'] = -1.0
+    records['total_eve_minutes'] = records['total_eve_minutes'].astype(object)
+    records.loc[bad[1::3], 'total_eve_minutes'] = 'n/a'
+    records.loc[bad[2::3], 'international_plan'] = 'Maybe'
+    return records
+
+
+def loop_validate(records: pd.DataFrame, int_cols: list, numeric_cols: list, categories: dict) -> int:
+    """Validate record by record like `/predict`, counting the records that raise."""
+    n_invalid = 0
+    for record in records.to_dict(orient='records'):
+        try:
+            validate_record(record, int_cols, numeric_cols)
+            for col, levels in categories.items():
+                if record[col] not in levels:
+                    raise ValueError(f'{col} must be one of {levels}')
+        except ValueError:
+            n_invalid += 1
+    return n_invalid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark vectorized batch validation')
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--data_path', default='data/external/raw_data.csv', help='Raw data to sample records from')
+    parser.add_argument('--n_rows', default=1000000, type=int, help='Records per batch')
+    parser.add_argument('--invalid_fraction', default=0.01, type=float, help='Fraction of invalid records')
+    parser.add_argument('--loop_rows', default=100000, type=int, help='Records validated one by one')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf8') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    columns = config['modeling']['train_model']['used_features']
+    validate_config = config['process_data']['validate_input']
+    categories = {'international_plan': ['No', 'Yes'], 'voice_mail_plan': ['No', 'Yes']}
+    data = pd.read_csv(args.data_path, usecols=['id'] + columns)
+    typed = make_records(data, args.n_rows, args.invalid_fraction)
+    inputs = {'typed': typed, 'text': typed.astype(str)}
+
+    print(f'{args.n_rows:,} records, {args.invalid_fraction:.1%} invalid')
+    print(f'{"input":>6} {"method":>10} {"records":>10} {"seconds":>8} {"records/s":>11} {"invalid":>8}')
+    for name, records in inputs.items():
+        start = time.perf_counter()
+        _, invalid, _ = validate_batch(records, categories=categories, **validate_config)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>6} {"batch":>10} {len(records):>10,} {elapsed:>8.2f} {len(records) / elapsed:>11,.0f} '
+              f'{invalid.sum():>8,}')
+        subset = records.head(args.loop_rows)
+        start = time.perf_counter()
+        n_invalid = loop_validate(subset, categories=categories, **validate_config)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>6} {"per record":>10} {len(subset):>10,} {elapsed:>8.2f} {len(subset) / elapsed:>11,.0f} '
+              f'{n_invalid:>8,}')
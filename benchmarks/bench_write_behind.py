@@ -0,0 +1,103 @@
+"""Throughput of persisting predicted customer records one commit per record against the write-behind queue.
+
+Concurrent callers, standing in for /predict requests, each save their share of synthetic customer records. With a
+commit per record every caller waits for its own upsert; with the write-behind queue callers only queue the record,
+and a background thread upserts the waiting records in batches. For the queue, `records/s` counts until all records
+are committed and `p99 submit ms` is how long a caller waited to hand its record over. The database is a fresh SQLite
+file unless `--engine_string` points elsewhere, e.g. at RDS (the churn table must exist there).
+
+Run from the root of the repo:
+    python -m benchmarks.bench_write_behind --n_records 100000 --batch_sizes 100 500 --wal
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from src.create_db import ChurnManager, create_db
+from src.write_behind import WriteBehindQueue
+
+# pylint: disable=locally-disabled, invalid-name, redefined-outer-name
+
+
+def make_records(n_records: int, seed: int = 0) -> List[Dict]:
+    """Synthetic rows of the churn table with ids 1 to `n_records`."""
+    rng = np.random.default_rng(seed)
+    yes_no = np.array(['No', 'Yes'])
+    return [{'id': i + 1,
+             'international_plan': str(yes_no[rng.integers(2)]),
+             'voice_mail_plan': str(yes_no[rng.integers(2)]),
+             'number_vmail_messages': int(rng.integers(50)),
+             'total_day_minutes': round(float(rng.uniform(0, 350)), 1),
+             'total_eve_minutes': round(float(rng.uniform(0, 350)), 1),
+             'total_night_minutes': round(float(rng.uniform(0, 350)), 1),
+             'total_intl_minutes': round(float(rng.uniform(0, 20)), 1),
+             'total_intl_calls': int(rng.integers(20)),
+             'customer_service_calls': int(rng.integers(10)),
+             'churn': str(yes_no[rng.integers(2)])} for i in range(n_records)]
+
+
+def run_callers(save: Callable[[Dict], object], records: List[Dict], n_threads: int) -> np.ndarray:
+    """Save the records from `n_threads` concurrent callers and return the seconds each save took."""
+    latencies = np.zeros(len(records))
+
+    def call(i: int) -> None:
+        start = time.perf_counter()
+        save(records[i])
+        latencies[i] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        list(pool.map(call, range(len(records))))
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark write-behind persistence of predicted records')
+    parser.add_argument('--n_records', default=100000, type=int, help='Records saved through the write-behind queue')
+    parser.add_argument('--sync_records', default=5000, type=int, help='Records saved with a commit each')
+    parser.add_argument('--n_threads', default=16, type=int, help='Number of concurrent callers')
+    parser.add_argument('--batch_sizes', default=[100, 500], type=int, nargs='+', help='Most records per commit')
+    parser.add_argument('--flush_interval_ms', default=50.0, type=float, help='Longest a record waits for a batch')
+    parser.add_argument('--submit_timeout', default=30.0, type=float,
+                        help='Longest a caller waits for room in a full queue; callers outpace the database here')
+    parser.add_argument('--wal', action='store_true', help='Also run with a write-ahead log in a temporary directory')
+    parser.add_argument('--engine_string', default=None, help='Database to write to; a temporary SQLite file if unset')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    engine_string = args.engine_string or f'sqlite:///{os.path.join(tmp_dir, "churn.db")}'
+    if args.engine_string is None:
+        create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    records = make_records(max(args.n_records, args.sync_records))
+
+    print(f'{args.n_threads} callers, {engine_string.split(":")[0]}')
+    print(f'{"mode":>22} {"records":>8} {"seconds":>8} {"records/s":>10} {"p99 submit ms":>14} {"commits":>8}')
+    start = time.perf_counter()
+    latencies = run_callers(lambda record: cm.upsert_customers([record]), records[:args.sync_records],
+                            args.n_threads)
+    elapsed = time.perf_counter() - start
+    print(f'{"commit per record":>22} {args.sync_records:>8,} {elapsed:>8.2f} {args.sync_records / elapsed:>10,.0f} '
+          f'{np.percentile(latencies, 99) * 1000:>14.2f} {args.sync_records:>8,}')
+
+    for wal in [False, True] if args.wal else [False]:
+        for batch_size in args.batch_sizes:
+            wal_dir = os.path.join(tmp_dir, 'wal') if wal else None
+            write_behind = WriteBehindQueue(cm.upsert_customers, max_batch_size=batch_size,
+                                            flush_interval_ms=args.flush_interval_ms,
+                                            submit_timeout=args.submit_timeout, wal_dir=wal_dir)
+            write_behind.start()
+            start = time.perf_counter()
+            latencies = run_callers(write_behind.submit, records[:args.n_records], args.n_threads)
+            write_behind.close()
+            elapsed = time.perf_counter() - start
+            mode = f'write-behind {batch_size}' + (' wal' if wal else '')
+            print(f'{mode:>22} {args.n_records:>8,} {elapsed:>8.2f} {args.n_records / elapsed:>10,.0f} '
+                  f'{np.percentile(latencies, 99) * 1000:>14.2f} {write_behind.batches:>8,}')
+    cm.close()
+    shutil.rmtree(tmp_dir)
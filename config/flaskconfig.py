@@ -6,7 +6,55 @@ APP_NAME = "churn-prediction"
 SQLALCHEMY_TRACK_MODIFICATIONS = True
 HOST = "0.0.0.0"
 SQLALCHEMY_ECHO = False  # If true, SQL for queries made will be printed
-MAX_ROWS_SHOW = 10
+MAX_ROWS_SHOW = 10  # Default number of customers per page
+MAX_PAGE_SIZE = 100  # Largest page size a client may request through the `limit` query parameter
+
+# Model registry: artifacts are loaded once per worker and hot-reloaded when the files change
+MODEL_PATH = "models/rf_model_flat.forest"  # Memory-mapped forest exported by train_model; .npz and .pkl also work
+FEATURE_SCHEMA_PATH = "models/feature_schema.json"
+CONFIG_PATH = "config/config.yaml"
+MODEL_RELOAD_INTERVAL = float(os.environ.get("MODEL_RELOAD_INTERVAL", 5))  # seconds between file checks
+# Load the model and score one record when the app is imported; with `gunicorn --preload` that happens once in the
+# master process, before the workers are forked, instead of in the first request of every worker
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "false").lower() == "true"
+
+# Micro-batching: concurrent /predict requests are coalesced into one model call
+BATCHING_ENABLED = os.environ.get("BATCHING_ENABLED", "true").lower() == "true"
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 64))  # Most records scored in one model call
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 2))  # Longest a record waits for others to join
+BATCH_QUEUE_DEPTH = int(os.environ.get("BATCH_QUEUE_DEPTH", 1024))  # Records waiting before requests are rejected
+
+# Prediction cache: probabilities of recently scored feature vectors, dropped whenever a new model is loaded
+PREDICTION_CACHE_ENABLED = os.environ.get("PREDICTION_CACHE_ENABLED", "true").lower() == "true"
+PREDICTION_CACHE_MAX_ENTRIES = int(os.environ.get("PREDICTION_CACHE_MAX_ENTRIES", 100000))  # LRU size cap per worker
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 3600))  # seconds an entry stays valid
+PREDICTION_CACHE_PATH = os.environ.get("PREDICTION_CACHE_PATH")  # SQLite file shared by workers, e.g. data/cache.db
+
+# Write-behind: /predict queues the customer record and returns, a background thread writes the queue in batches.
+# On by default when served through asgi.py
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+WRITE_BEHIND_QUEUE_DEPTH = int(os.environ.get("WRITE_BEHIND_QUEUE_DEPTH", 10000))  # Records waiting to be written
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500))  # Most records written in one commit
+WRITE_BEHIND_FLUSH_MS = float(os.environ.get("WRITE_BEHIND_FLUSH_MS", 50))  # Longest a record waits for a full batch
+# Directory of a local write-ahead log of the queued records, replayed after a crash; each worker writes its own files
+WRITE_BEHIND_WAL_DIR = os.environ.get("WRITE_BEHIND_WAL_DIR")  # e.g. data/wal
+WRITE_BEHIND_WAL_FSYNC = os.environ.get("WRITE_BEHIND_WAL_FSYNC", "false").lower() == "true"  # Sync to disk per record
+# What a request does when the queue is full: "block" for WRITE_BEHIND_TIMEOUT seconds, then fail, "reject" fails
+# at once, "drop" returns the prediction without saving the record
+WRITE_BEHIND_OVERFLOW = os.environ.get("WRITE_BEHIND_OVERFLOW", "block")
+WRITE_BEHIND_TIMEOUT = float(os.environ.get("WRITE_BEHIND_TIMEOUT", 1))
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 32))  # Requests handled at once per asgi.py worker
+
+# Batch prediction API
+API_MAX_RECORDS = 100000  # Largest number of records accepted in one /api/predict payload
+API_STREAM_CHUNK_SIZE = 1000  # Number of result rows serialized per streamed chunk
+
+# Database connection pool (ignored for SQLite); sessions are scoped to each request
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))  # Connections kept open per worker process
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))  # Extra connections opened under load
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 3600))  # Seconds before a connection is replaced
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"  # Test connections on checkout
 
 # RDS Database Connection Config credentials
 conn_type = "mysql+pymysql"
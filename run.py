@@ -2,40 +2,230 @@
  stage in the model pipeline and orchestrates their execution."""
 import os
 import argparse
+import json
 import logging.config
+import sys
+import time
+from typing import TYPE_CHECKING
 
-import pickle
-import pandas as pd
 import yaml
 
-from src.s3 import download_file_from_s3, upload_file_to_s3
-from src.process_data import clean_data
-from src.create_db import ChurnManager, create_db
-from src.modeling import train_model, make_predictions, eval_performance, \
-    save_model, save_train_test, save_model_eval
 from config.flaskconfig import SQLALCHEMY_DATABASE_URI
 
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from src.pipeline import Pipeline
+
+# pandas, scikit-learn, boto3 and SQLAlchemy are imported by the steps that use them, so that e.g. create_db or
+# upload_data do not wait for scikit-learn to load; every step takes the pipeline state, used or not
+# pylint: disable=locally-disabled, import-outside-toplevel, redefined-outer-name, unused-argument
+
 logging.config.fileConfig('config/logging/local.conf', disable_existing_loggers=False)
 logger = logging.getLogger('run-pipeline')
 
+PIPELINE_STEPS = ['acquire_data', 'clean_data', 'train_model', 'predict', 'evaluate']
+# tune_model is not part of 'all'; running it retrains the model with the best hyperparameters found
+PIPELINE_TARGETS = {'tune_model': ['tune_model', 'train_model']}
+# steps outside the model pipeline; pipeline steps write their metrics themselves as they finish
+DATA_STEPS = ['upload_data', 'sync_data', 'create_db', 'ingest_data', 'score_db', 'rebuild_segments']
+
+
+def build_pipeline(args: argparse.Namespace, config: dict) -> 'Pipeline':
+    """
+    Declare the model pipeline steps with the files they read and write and the configuration they depend on
+    Args:
+        args (obj: argparse.Namespace): parsed command line arguments
+        config (dict): pipeline configuration
+
+    Returns:
+        pipeline (obj: Pipeline): pipeline of acquire_data, clean_data, tune_model, train_model, predict and
+            evaluate
+    """
+    # every step imports what it needs when it runs, so e.g. acquire_data loads neither pandas nor scikit-learn
+    from src.artifacts import artifact_path
+    from src.pipeline import Pipeline, Step
+
+    modeling = config['modeling']
+    fmt = config['artifacts']['format']
+    raw_data_path = os.path.join(args.raw_data_dir, config['s3']['raw_data_filename'])
+    cleaned_data_path = artifact_path(args.cleaned_data_dir, config['process_data']['cleaned_data_filename'], fmt)
+    model_path = os.path.join(args.model_dir, modeling['model_filename'])
+    compiled_model_path = os.path.join(args.model_dir, modeling['compiled_model_filename'])
+    schema_path = os.path.join(args.model_dir, modeling['feature_schema_filename'])
+    X_train_path = artifact_path(args.X_train_dir, modeling['X_train_filename'], fmt)
+    X_test_path = artifact_path(args.X_test_dir, modeling['X_test_filename'], fmt)
+    y_train_path = artifact_path(args.y_train_dir, modeling['y_train_filename'], fmt)
+    y_test_path = artifact_path(args.y_test_dir, modeling['y_test_filename'], fmt)
+    pred_result_path = artifact_path(args.pred_result_dir, modeling['pred_result_filename'], fmt)
+    model_eval_path = os.path.join(args.model_eval_dir, modeling['model_eval_filename'])
+    best_params_path = os.path.join(args.model_dir, modeling['best_params_filename'])
+    tune_config = modeling['tune_model']
+    parallelism = config['parallelism']
+    n_jobs = parallelism['n_jobs'] if args.n_jobs is None else args.n_jobs
+    tuning_results_path = os.path.join(args.model_dir, tune_config['results_filename'])
+    # csv copies of selected tables, for people and for ingest_data
+    exports = {'cleaned_data': artifact_path(args.cleaned_data_dir, config['process_data']['cleaned_data_filename'],
+                                             'csv'),
+               'pred_result': artifact_path(args.pred_result_dir, modeling['pred_result_filename'], 'csv')}
+    exports = {name: path for name, path in exports.items()
+               if name in config['artifacts'].get('export_csv', []) and fmt != 'csv'}
+
+    clean_exports = [path for name, path in exports.items() if name == 'cleaned_data']
+
+    def dtypes(name: str) -> dict:
+        from src.schema import parse_dtypes
+        return parse_dtypes(config['schema'][name])
+
+    def save(name: str, data: 'pd.DataFrame', path: str) -> None:
+        from src.modeling import save_table
+        save_table(data, path)
+        if name in exports:
+            save_table(data, exports[name])
+
+    def acquire(state: dict) -> None:
+        from src.s3 import download_file_from_s3
+        # the download itself is skipped when the s3 object's ETag matches the local copy
+        download_file_from_s3(raw_data_path, args.s3_path, force=args.force, **config['s3']['transfer'])
+
+    def clean(state: dict) -> dict:
+        from src.process_data import clean_data, clean_data_streaming
+        from src.schema import enforce_schema, read_csv_with_schema
+        target = config['process_data']['clean_data']['target']
+        raw_dtypes, cleaned_dtypes = dtypes('raw_data'), dtypes('cleaned_data')
+        if args.chunksize:
+            # out-of-core: nothing is handed on in memory, train_model reads the cleaned file
+            clean_data_streaming(raw_data_path, [cleaned_data_path] + clean_exports, target, args.chunksize,
+                                 raw_dtypes=raw_dtypes, cleaned_dtypes=cleaned_dtypes,
+                                 **config['process_data']['clean_data_streaming'])
+            logger.info('Cleaned data streamed to %s', cleaned_data_path)
+            return {}
+        data = read_csv_with_schema(raw_data_path, raw_dtypes)
+        cleaned_data = enforce_schema(clean_data(data, target), cleaned_dtypes)
+        save('cleaned_data', cleaned_data, cleaned_data_path)
+        logger.info('Cleaned dataframe saved to %s', cleaned_data_path)
+        return {'cleaned_data': cleaned_data}
+
+    def load_cleaned_data(state: dict) -> 'pd.DataFrame':
+        from src.modeling import load_table
+        train_config = modeling['train_model']
+        if 'cleaned_data' in state:
+            return state['cleaned_data']
+        return load_table(cleaned_data_path, columns=train_config['used_features'] + [train_config['target']],
+                          dtypes=dtypes('cleaned_data'))
+
+    def tune(state: dict) -> dict:
+        from src.modeling import split_data
+        from src.tuning import search
+        data = load_cleaned_data(state)
+        train_config = modeling['train_model']
+        X_train, _, y_train, _ = split_data(data, train_config['used_features'], train_config['target'],
+                                            train_config['test_size'], train_config['random_state'])
+        search_config = {key: value for key, value in tune_config.items()
+                         if key not in ('cache_filename', 'results_filename', 'n_workers')}
+        cache_path = os.path.join(args.model_dir, tune_config['cache_filename'])
+        n_workers = n_jobs if tune_config['n_workers'] is None else tune_config['n_workers']
+        best_params, results = search(X_train, y_train, cache_path=cache_path, n_workers=n_workers,
+                                      blas_threads=parallelism['blas_threads'], **search_config)
+        results.to_csv(tuning_results_path, index=False)
+        with open(best_params_path, 'w', encoding='utf8') as f:
+            json.dump(best_params, f, indent=2)
+        logger.info('Best hyperparameters saved to %s', best_params_path)
+        return {'cleaned_data': data, 'best_params': best_params}
+
+    def train(state: dict) -> dict:
+        from src.forest import compile_forest
+        from src.modeling import train_model, save_model, save_train_test, build_feature_schema
+        train_config = modeling['train_model']
+        data = load_cleaned_data(state)
+        # hyperparameters found by tune_model, if it was run; delete the file to go back to the defaults
+        best_params = state.get('best_params')
+        if best_params is None and os.path.exists(best_params_path):
+            with open(best_params_path, 'r', encoding='utf8') as f:
+                best_params = json.load(f)
+        rf, X_train, X_test, y_train, y_test = train_model(data, model_params=best_params, n_jobs=n_jobs,
+                                                           **train_config)
+        save_model(rf, model_path)
+        compile_forest(rf).save(compiled_model_path)
+        build_feature_schema(data, train_config['used_features']).save(schema_path)
+        save_train_test(X_train, X_test, y_train, y_test, X_train_path, X_test_path, y_train_path, y_test_path)
+        logger.info('Model saved to %s', model_path)
+        return {'model': rf, 'X_test': X_test, 'y_test': y_test}
+
+    def predict(state: dict) -> dict:
+        from src.modeling import load_table, make_predictions
+        from src.registry import load_pickle
+        rf_model = state['model'] if 'model' in state else load_pickle(model_path)
+        X_test = state['X_test'] if 'X_test' in state else load_table(X_test_path)
+        pred_df = make_predictions(rf_model, X_test, n_jobs=n_jobs, shard_rows=parallelism['predict_shard_rows'],
+                                   blas_threads=parallelism['blas_threads'])
+        save('pred_result', pred_df, pred_result_path)
+        logger.info('Prediction results saved to %s', pred_result_path)
+        return {'pred_result': pred_df}
+
+    def evaluate(state: dict) -> None:
+        from src.modeling import eval_performance, load_table, save_model_eval
+        target = modeling['train_model']['target']
+        y_test = state['y_test'] if 'y_test' in state else \
+            load_table(y_test_path, columns=[target], dtypes=dtypes('cleaned_data'))
+        pred_result = state['pred_result'] if 'pred_result' in state else \
+            load_table(pred_result_path, columns=['pred_class'])
+        accuracy, class_report, conf_mat = eval_performance(pred_result, y_test)
+        save_model_eval(accuracy, class_report, conf_mat, model_eval_path)
+        logger.info('Model performance metrics saved to %s', model_eval_path)
+
+    steps = [Step('acquire_data', acquire, outputs=[raw_data_path], config=args.s3_path, always_run=True),
+             Step('clean_data', clean, inputs=[raw_data_path], outputs=[cleaned_data_path] + clean_exports,
+                  config={'clean_data': config['process_data']['clean_data'], 'schema': config['schema'],
+                          'chunksize': args.chunksize,
+                          'streaming': config['process_data']['clean_data_streaming'] if args.chunksize else None},
+                  requires=['acquire_data']),
+             Step('tune_model', tune, inputs=[cleaned_data_path], outputs=[best_params_path, tuning_results_path],
+                  config={'tune_model': tune_config, 'train_model': modeling['train_model'],
+                          'schema': config['schema']['cleaned_data']},
+                  requires=['clean_data']),
+             Step('train_model', train, inputs=[cleaned_data_path, best_params_path],
+                  outputs=[model_path, compiled_model_path, schema_path, X_train_path, X_test_path, y_train_path,
+                           y_test_path],
+                  config={'train_model': modeling['train_model'], 'schema': config['schema']['cleaned_data']},
+                  requires=['clean_data']),
+             Step('predict', predict, inputs=[model_path, X_test_path],
+                  outputs=[pred_result_path] + [path for name, path in exports.items() if name == 'pred_result'],
+                  requires=['train_model']),
+             Step('evaluate', evaluate, inputs=[y_test_path, pred_result_path], outputs=[model_eval_path],
+                  requires=['predict'])]
+    return Pipeline(steps, config['pipeline']['manifest_path'], metrics_dir=config['metrics']['dump_dir'])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Running individual step')
     # specify which step to run
     parser.add_argument('step', help='Which step to run',
-                        choices=['upload_data', 'acquire_data', 'clean_data',
-                                 'create_db', 'ingest_data', 'train_model',
-                                 'predict', 'evaluate', 'all'])
+                        choices=['upload_data', 'acquire_data', 'sync_data', 'clean_data',
+                                 'create_db', 'ingest_data', 'score_db', 'rebuild_segments', 'tune_model',
+                                 'train_model', 'predict', 'evaluate', 'all'])
     parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
 
     parser.add_argument('--s3_path', default='s3://2022-msia423-wu-ruofei/raw/raw_data.csv',
                         help='s3 data path to upload/download data')
 
+    parser.add_argument('--force', action='store_true',
+                        help='Run pipeline steps even if their outputs are up to date, and transfer data even if '
+                             'the s3 object and the local copy are unchanged')
+
     parser.add_argument('--local_data_path', default='data/external/raw_data.csv',
                         help='Local data path to upload data to s3')
 
     parser.add_argument('--raw_data_dir', default='data/raw',
                         help='Path to save raw data downloaded from s3')
 
+    parser.add_argument('--chunksize', default=None, type=int,
+                        help='Clean the raw data in chunks of this many rows with bounded memory')
+
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='Cores for model training, batch prediction and cross-validation; -1 for all. '
+                             'Overrides parallelism.n_jobs in the configuration file')
+
     parser.add_argument('--cleaned_data_dir', default='data/final',
                         help='Directory to save cleaned data')
 
@@ -70,77 +260,73 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # Load configuration file
-    with open(args.config, 'r') as f:
+    with open(args.config, 'r', encoding='utf8') as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
 
-    if args.step == 'upload_data':
-        upload_file_to_s3(args.local_data_path, args.s3_path)
-
-    elif args.step == 'acquire_data':
-        download_file_from_s3(os.path.join(args.raw_data_dir, config['s3']['raw_data_filename']), args.s3_path)
-        logger.info('Raw data acquired and saved to %s',
-                    os.path.join(args.raw_data_dir, config['s3']['raw_data_filename']))
-    elif args.step == 'clean_data':
-        try:
-            data = pd.read_csv(os.path.join(args.raw_data_dir, config['s3']['raw_data_filename']))
-        except FileNotFoundError:
-            logger.error('File not found, please run the previous acquire_data step')
-        else:
-            cleaned_data = clean_data(data, config['process_data']['clean_data']['target'])
-            cleaned_data.to_csv(os.path.join(args.cleaned_data_dir, config['process_data']['cleaned_data_filename']),
-                                index=False)
-            logger.info('Cleaned dataframe saved to %s',
-                        os.path.join(args.cleaned_data_dir, config['process_data']['cleaned_data_filename']))
-    elif args.step == 'create_db':
-        create_db(args.engine_string)
-
-    elif args.step == 'ingest_data':
-        cm = ChurnManager(engine_string=args.engine_string)
-        cm.add_customer_data(args.input_path)
-        cm.close()
-
-    elif args.step == 'train_model':
-        try:
-            data = pd.read_csv(os.path.join(args.cleaned_data_dir, config['process_data']['cleaned_data_filename']))
-        except FileNotFoundError:
-            logger.error('File not found, please run each step in order starting from acquire_data')
-        else:
-            rf, X_train, X_test, y_train, y_test = train_model(data, **config['modeling']['train_model'])
-            save_model(rf, os.path.join(args.model_dir, config['modeling']['model_filename']))
-            save_train_test(X_train, X_test, y_train, y_test,
-                            os.path.join(args.X_train_dir, config['modeling']['X_train_filename']),
-                            os.path.join(args.X_test_dir, config['modeling']['X_test_filename']),
-                            os.path.join(args.y_train_dir, config['modeling']['y_train_filename']),
-                            os.path.join(args.y_test_dir, config['modeling']['y_test_filename']))
-            logger.info('Model saved to %s', os.path.join(args.model_dir, config['modeling']['model_filename']))
-
-    elif args.step == 'predict':
-        try:
-            with open(os.path.join(args.model_dir, config['modeling']['model_filename']), 'rb') as f:
-                rf_model = pickle.load(f)
-        except FileNotFoundError:
-            logger.error('File not found, please check if model object is saved')
-
-        try:
-            X_test = pd.read_csv(os.path.join(args.X_test_dir, config['modeling']['X_test_filename']))
-        except FileNotFoundError:
-            logger.error('File not found, please check the directory')
-        else:
-            pred_df = make_predictions(rf_model, X_test)
-            # save prediction results
-            pred_df.to_csv(os.path.join(args.pred_result_dir, config['modeling']['pred_result_filename']), index=False)
-            logger.info('Prediction results saved to %s',
-                        os.path.join(args.pred_result_dir, config['modeling']['pred_result_filename']))
-
-    elif args.step == 'evaluate':
-        try:
-            y_test = pd.read_csv(os.path.join(args.y_test_dir, config['modeling']['y_test_filename']))
-            pred_result = pd.read_csv(os.path.join(args.pred_result_dir, config['modeling']['pred_result_filename']))
-        except FileNotFoundError:
-            logger.error('File not found, please run each step in order or check the directory')
+    from src.metrics import metrics
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        if args.step == 'upload_data':
+            from src.s3 import upload_file_to_s3
+            upload_file_to_s3(args.local_data_path, args.s3_path, force=args.force, **config['s3']['transfer'])
+
+        elif args.step == 'sync_data':
+            # --s3_path is the prefix to mirror into --raw_data_dir
+            from src.s3 import sync_prefix
+            sync_prefix(args.raw_data_dir, args.s3_path, force=args.force, **config['s3']['transfer'])
+
+        elif args.step == 'create_db':
+            from src.create_db import create_db
+            create_db(args.engine_string)
+
+        elif args.step == 'ingest_data':
+            from src.create_db import ChurnManager
+            from src.schema import parse_dtypes
+            cm = ChurnManager(engine_string=args.engine_string)
+            cm.add_customer_data(args.input_path, dtypes=parse_dtypes(config['schema']['cleaned_data']),
+                                 validate=config['process_data']['validate_input'],
+                                 **config['create_db']['add_customer_data'])
+            cm.close()
+
+        elif args.step == 'score_db':
+            from src.create_db import ChurnManager
+            from src.prediction_cache import PredictionCache
+            from src.registry import Artifact, load_model_with_schema
+            modeling_config = config['modeling']
+            # the model and schema the app serves, loaded and versioned like the app does, so scores written here and
+            # by the app carry the same model_version
+            (model, schema), model_version = Artifact(
+                os.path.join(args.model_dir, modeling_config['compiled_model_filename']), load_model_with_schema,
+                companions=[os.path.join(args.model_dir, modeling_config['feature_schema_filename'])]).get_versioned()
+            if hasattr(model, 'set_params'):
+                model.set_params(n_jobs=config['parallelism']['n_jobs'] if args.n_jobs is None else args.n_jobs)
+            cm = ChurnManager(engine_string=args.engine_string)
+            cache_config = config['create_db']['score_cache']
+            cm.score_customers(model, schema, model_version=model_version,
+                               cache=PredictionCache(**cache_config) if cache_config else None,
+                               **config['create_db']['score_customers'])
+            cm.close()
+
+        elif args.step == 'rebuild_segments':
+            from src.create_db import ChurnManager
+            cm = ChurnManager(engine_string=args.engine_string)
+            cm.rebuild_segments()
+            cm.close()
+
         else:
-            accuracy, class_report, conf_mat = eval_performance(pred_result, y_test)
-            save_model_eval(accuracy, class_report, conf_mat,
-                            os.path.join(args.model_eval_dir, config['modeling']['model_eval_filename']))
-            logger.info('Model performance metrics saved to %s',
-                        os.path.join(args.model_eval_dir, config['modeling']['model_eval_filename']))
+            # 'all' runs every model pipeline step in one process; a single step runs only that step
+            from src.parallel import limit_blas_threads
+            limit_blas_threads(config['parallelism']['blas_threads'])
+            pipeline = build_pipeline(args, config)
+            try:
+                pipeline.run(PIPELINE_STEPS if args.step == 'all' else PIPELINE_TARGETS.get(args.step, [args.step]),
+                             force=args.force)
+            except FileNotFoundError as e:
+                logger.error('File not found (%s), please run each step in order starting from acquire_data', e)
+                sys.exit(1)
+        status = 'ran'
+    finally:
+        if args.step in DATA_STEPS and config['metrics']['dump_dir'] is not None:
+            metrics.dump_json(os.path.join(config['metrics']['dump_dir'], f'{args.step}.json'), step=args.step,
+                              status=status, seconds=round(time.perf_counter() - start, 4))
@@ -0,0 +1,37 @@
+import os
+
+# kept apart from src.modeling, which imports pandas, so that declaring the pipeline's artifact paths stays cheap
+# pylint: disable=locally-disabled, invalid-name
+
+ARTIFACT_FORMATS = ('parquet', 'feather', 'csv')
+
+
+def artifact_path(directory: str, name: str, fmt: str) -> str:
+    """
+    Build the path of a tabular pipeline artifact
+    Args:
+        directory (str): directory of the artifact
+        name (str): file name of the artifact without extension
+        fmt (str): "parquet", "feather" or "csv"
+
+    Returns:
+        path (str): path with the extension of the format
+    """
+    if fmt not in ARTIFACT_FORMATS:
+        raise ValueError(f'Artifact format must be one of {ARTIFACT_FORMATS}')
+    return os.path.join(directory, f'{name}.{fmt}')
+
+
+def artifact_format(path: str) -> str:
+    """
+    Tell the format of a tabular pipeline artifact from its file extension
+    Args:
+        path (str): path ending in .parquet, .feather or .csv
+
+    Returns:
+        fmt (str): "parquet", "feather" or "csv"
+    """
+    fmt = os.path.splitext(path)[1].lstrip('.')
+    if fmt not in ARTIFACT_FORMATS:
+        raise ValueError(f'Cannot tell the artifact format of {path}, expected one of {ARTIFACT_FORMATS}')
+    return fmt
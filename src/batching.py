@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, cast
+
+import numpy as np
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('batching')
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-record predictions into one model call.
+
+    Callers put an encoded feature row on a bounded queue and wait on a future. A background thread takes
+    the first waiting row, keeps collecting until `max_batch_size` rows are gathered or `max_wait_ms` has
+    passed since the first one arrived, scores the whole batch with one `score_fn` call and hands every
+    caller its own row of the result.
+
+    A row may be submitted with the model to score it with, e.g. the model its features were encoded for. Rows of
+    one batch are then scored with their own model, one call per model, so a model reloaded while rows wait never
+    scores rows submitted for the previous one. Rows submitted without a model are scored by `score_fn`.
+    """
+
+    def __init__(self, score_fn: Optional[Callable[[np.ndarray], np.ndarray]] = None, max_batch_size: int = 64,
+                 max_wait_ms: float = 2.0, max_queue_depth: int = 1024, submit_timeout: float = 1.0):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_depth = max_queue_depth
+        self.submit_timeout = submit_timeout
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_depth)
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_pid: Optional[int] = None
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self.largest_batch = 0
+        self.total_wait_seconds = 0.0
+
+    def _ensure_worker(self) -> None:
+        # started lazily, and again after a fork, since threads do not survive into forked workers
+        if self._worker is not None and self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker_pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue_depth)
+            self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _score(self, items: list) -> None:
+        model = items[0][3]
+        # a row without a model was only accepted because score_fn is set
+        score_fn = model.predict_proba if model is not None else cast(Callable, self.score_fn)
+        try:
+            proba = score_fn(np.vstack([row for row, _, _, _ in items]))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error('Scoring a batch of %d records failed: %s', len(items), e)
+            for _, future, _, _ in items:
+                future.set_exception(e)
+            return
+        for i, (_, future, _, _) in enumerate(items):
+            future.set_result(proba[i])
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            by_model: Dict[int, list] = {}
+            for item in batch:
+                by_model.setdefault(id(item[3]), []).append(item)
+            for items in by_model.values():
+                self._score(items)
+            self.batches += 1
+            self.requests += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.total_wait_seconds += sum(started - enqueued for _, _, enqueued, _ in batch)
+
+    def submit(self, row: np.ndarray, model: Any = None) -> Future:
+        """
+        Queue one encoded record for scoring
+        Args:
+            row (obj: np.ndarray): encoded features of shape (1, n_features)
+            model (Any): model whose `predict_proba` scores the record; `score_fn` if None
+
+        Returns:
+            future (obj: Future): resolves to the class probabilities of the record
+
+        Raises:
+            ValueError: if neither a model nor `score_fn` is given
+            queue.Full: if the queue stays full for longer than `submit_timeout` seconds
+        """
+        if model is None and self.score_fn is None:
+            raise ValueError('A model is needed to score the record, the batcher has no score_fn')
+        self._ensure_worker()
+        future: Future = Future()
+        try:
+            self._queue.put((row, future, time.perf_counter(), model), timeout=self.submit_timeout)
+        except queue.Full:
+            self.rejected += 1
+            logger.error('Prediction queue is full (%d records waiting)', self.max_queue_depth)
+            raise
+        return future
+
+    def predict_proba(self, row: np.ndarray, timeout: Optional[float] = None, model: Any = None) -> np.ndarray:
+        """
+        Score one encoded record together with any concurrent callers and wait for the result
+        Args:
+            row (obj: np.ndarray): encoded features of shape (1, n_features)
+            timeout (float): seconds to wait for the result, None to wait indefinitely
+            model (Any): model whose `predict_proba` scores the record; `score_fn` if None
+
+        Returns:
+            proba (obj: np.ndarray): class probabilities of the record
+        """
+        return self.submit(row, model).result(timeout=timeout)
+
+    def stats(self) -> Dict:
+        """
+        Summarize batching settings and counters
+        Returns:
+            stats (dict): configuration, queue depth, batch counts and mean batch size and wait
+        """
+        return {'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'max_queue_depth': self.max_queue_depth,
+                'queue_depth': self._queue.qsize(),
+                'requests': self.requests,
+                'batches': self.batches,
+                'rejected': self.rejected,
+                'largest_batch': self.largest_batch,
+                'mean_batch_size': round(self.requests / self.batches, 3) if self.batches else 0.0,
+                'mean_wait_ms': round(self.total_wait_seconds / self.requests * 1000, 3) if self.requests else 0.0}
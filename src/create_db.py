@@ -1,16 +1,33 @@
+import bisect
+import json
 import logging
+import os
 import sqlite3
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, Float
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Float, Index
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from flask_sqlalchemy import SQLAlchemy
 
+from src.features import FeatureSchema
+from src.metrics import metrics
+from src.modeling import predict_batch
+from src.prediction_cache import PredictionCache
+from src.process_data import validate_batch
+from src.schema import iter_csv_with_schema, read_csv_with_schema
+
 logger = logging.getLogger('create-db')
 
-Base = declarative_base()
+# a class built at runtime, which mypy cannot use as a base class without the SQLAlchemy plugin
+Base: Any = declarative_base()
 
 
 class Customer(Base):
@@ -29,10 +46,122 @@ class Customer(Base):
     customer_service_calls = Column(Integer, unique=False, nullable=False)
     churn = Column(String(3), unique=False, nullable=False)
 
+    # secondary indexes for the filters of the paginated customer listing; each ends in id for keyset paging
+    __table_args__ = (Index('ix_churn_churn_id', 'churn', 'id'),
+                      Index('ix_churn_plans_id', 'international_plan', 'voice_mail_plan', 'id'),
+                      Index('ix_churn_service_calls_id', 'customer_service_calls', 'id'))
+
     def __repr__(self):
         return f'<Customer {self.id}>'
 
 
+class ChurnScore(Base):
+    """Creates a data model for the churn predictions of the customers in the churn table, written by score_db."""
+    __tablename__ = 'churn_scores'
+
+    id = Column(Integer, ForeignKey('churn.id'), primary_key=True)
+    pred_class = Column(String(3), unique=False, nullable=False)
+    pred_proba = Column(Float, unique=False, nullable=False)
+    model_version = Column(String(64), unique=False, nullable=False)
+    scored_at = Column(DateTime, unique=False, nullable=False)
+
+    def __repr__(self):
+        return f'<ChurnScore {self.id}>'
+
+
+# lower bounds of the customer service call buckets of churn_segments, the last one open-ended; after changing them,
+# rebuild the table with `run.py rebuild_segments`
+SERVICE_CALL_BUCKETS = (0, 1, 2, 3, 4)
+# columns of the churn table summed per segment
+SEGMENT_SUMS = ['number_vmail_messages', 'total_day_minutes', 'total_eve_minutes', 'total_night_minutes',
+                'total_intl_minutes', 'total_intl_calls', 'customer_service_calls']
+SEGMENT_DIMENSIONS = ['international_plan', 'voice_mail_plan', 'service_calls']
+
+
+class ChurnSegment(Base):
+    """Creates a data model for the number of customers, churned customers and column sums of the churn table per
+    segment: plan flags and bucket of customer service calls. ChurnManager keeps it up to date on every write to
+    the churn table."""
+    __tablename__ = 'churn_segments'
+
+    international_plan = Column(String(3), primary_key=True)
+    voice_mail_plan = Column(String(3), primary_key=True)
+    min_service_calls = Column(Integer, primary_key=True, autoincrement=False)
+    customers = Column(Integer, unique=False, nullable=False)
+    churned = Column(Integer, unique=False, nullable=False)
+    sum_number_vmail_messages = Column(Integer, unique=False, nullable=False)
+    sum_total_day_minutes = Column(Float, unique=False, nullable=False)
+    sum_total_eve_minutes = Column(Float, unique=False, nullable=False)
+    sum_total_night_minutes = Column(Float, unique=False, nullable=False)
+    sum_total_intl_minutes = Column(Float, unique=False, nullable=False)
+    sum_total_intl_calls = Column(Integer, unique=False, nullable=False)
+    sum_customer_service_calls = Column(Integer, unique=False, nullable=False)
+
+    def __repr__(self):
+        return f'<ChurnSegment {self.international_plan} {self.voice_mail_plan} {self.min_service_calls}>'
+
+
+def service_calls_label(min_service_calls: int) -> str:
+    """Name of the service call bucket starting at `min_service_calls`, e.g. "2" or "4+" for the last one."""
+    if min_service_calls == SERVICE_CALL_BUCKETS[-1]:
+        return f'{min_service_calls}+'
+    upper = SERVICE_CALL_BUCKETS[SERVICE_CALL_BUCKETS.index(min_service_calls) + 1] - 1
+    return str(min_service_calls) if upper == min_service_calls else f'{min_service_calls}-{upper}'
+
+
+def segment_deltas(records: List[Dict], replaced: Dict[int, Dict]) -> List[Dict]:
+    """Changes to churn_segments from upserting `records` into the churn table.
+
+    Every record adds itself to its segment and takes out the customer it replaces, which is the row already in the
+    table or an earlier record of the same batch with the same id.
+
+    Args:
+        records (List[dict]): customer records in the order they are upserted
+        replaced (dict): current rows of the churn table by customer id, for the ids of `records` that exist
+
+    Returns:
+        deltas (List[dict]): one row of churn_segments per changed segment, holding the changes of its counts and sums
+    """
+    current = dict(replaced)
+    deltas: Dict[Tuple, List[float]] = {}
+
+    def add(customer: Dict, sign: int) -> None:
+        calls = int(customer['customer_service_calls'])
+        key = (customer['international_plan'], customer['voice_mail_plan'],
+               SERVICE_CALL_BUCKETS[max(bisect.bisect_right(SERVICE_CALL_BUCKETS, calls) - 1, 0)])
+        delta = deltas.setdefault(key, [0] * (2 + len(SEGMENT_SUMS)))
+        delta[0] += sign
+        delta[1] += sign * (customer['churn'] == 'Yes')
+        for i, col in enumerate(SEGMENT_SUMS, start=2):
+            delta[i] += sign * customer[col]
+
+    for record in records:
+        cust_id = int(record['id'])
+        if cust_id in current:
+            add(current[cust_id], -1)
+        add(record, 1)
+        current[cust_id] = record
+    columns = ['customers', 'churned'] + [f'sum_{col}' for col in SEGMENT_SUMS]
+    return [{'international_plan': key[0], 'voice_mail_plan': key[1], 'min_service_calls': key[2],
+             **dict(zip(columns, delta))} for key, delta in deltas.items() if any(delta)]
+
+
+def segments_query():
+    """Full scan of the churn table computing the rows of churn_segments with one GROUP BY."""
+    table = Customer.__table__
+    # literal bounds, so the bucket renders the same in the select list and the GROUP BY on every backend
+    bucket = sqlalchemy.case([(table.c.customer_service_calls >= sqlalchemy.literal_column(str(bound)),
+                               sqlalchemy.literal_column(str(bound))) for bound in reversed(SERVICE_CALL_BUCKETS[1:])],
+                             else_=sqlalchemy.literal_column(str(SERVICE_CALL_BUCKETS[0])))
+    churned = sqlalchemy.case([(table.c.churn == 'Yes', 1)], else_=0)
+    return sqlalchemy.select([table.c.international_plan, table.c.voice_mail_plan,
+                              bucket.label('min_service_calls'),
+                              sqlalchemy.func.count().label('customers'),
+                              sqlalchemy.func.sum(churned).label('churned')]
+                             + [sqlalchemy.func.sum(table.c[col]).label(f'sum_{col}') for col in SEGMENT_SUMS]) \
+        .group_by(table.c.international_plan, table.c.voice_mail_plan, bucket)
+
+
 def create_db(engine_string: str) -> None:
     """Create database with customer data model from provided engine string.
 
@@ -44,55 +173,579 @@ def create_db(engine_string: str) -> None:
     engine = sqlalchemy.create_engine(engine_string)
 
     try:
+        existing_tables = set(sqlalchemy.inspect(engine).get_table_names())
         Base.metadata.create_all(engine)
-    except sqlalchemy.exe.OperationalError as e:
+        # create_all skips tables that already exist, so indexes added later are created separately
+        existing = {index['name'] for index in sqlalchemy.inspect(engine).get_indexes(Customer.__tablename__)}
+        for index in Customer.__table__.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                logger.info('Index %s created.', index.name)
+        if Customer.__tablename__ in existing_tables and ChurnSegment.__tablename__ not in existing_tables:
+            # a database from before churn_segments: fill the new table from the customers already there
+            cm = ChurnManager(engine_string=engine_string)
+            cm.rebuild_segments()
+            cm.close()
+    except sqlalchemy.exc.OperationalError as e:
         logger.error('Cannot connect to the database. Error: %s', e)
     else:
         logger.info('Database created.')
 
 
+def upsert_statement(table: sqlalchemy.Table, dialect_name: str, accumulate: bool = False):
+    """Build an insert-or-update statement for `table`, executed with one dict of column values per row.
+
+    Rows whose primary key already exists get all other columns overwritten, or with `accumulate` added to, in the
+    same statement as the inserts: `INSERT ... ON CONFLICT DO UPDATE` on SQLite (3.24+) and PostgreSQL,
+    `INSERT ... ON DUPLICATE KEY UPDATE` on MySQL. Other dialects fall back to a plain insert.
+
+    Args:
+        table (obj: sqlalchemy.Table): table to write to
+        dialect_name (str): name of the SQLAlchemy dialect of the connection, e.g. 'sqlite' or 'mysql'
+        accumulate (bool): add the values to the columns of existing rows instead of overwriting them
+
+    Returns:
+        statement: executable SQLAlchemy statement
+    """
+    keys = [col.name for col in table.primary_key.columns]
+    values = [col.name for col in table.columns if col.name not in keys]
+    if dialect_name == 'mysql':
+        stmt = mysql_insert(table)
+        return stmt.on_duplicate_key_update({col: table.c[col] + stmt.inserted[col] if accumulate
+                                             else stmt.inserted[col] for col in values})
+    if dialect_name == 'postgresql':
+        stmt = postgresql_insert(table)
+        return stmt.on_conflict_do_update(index_elements=keys, set_={
+            col: table.c[col] + stmt.excluded[col] if accumulate else stmt.excluded[col] for col in values})
+    if dialect_name == 'sqlite':
+        # SQLAlchemy 1.3 has no SQLite insert construct with ON CONFLICT, so the statement is spelled out
+        columns = [col.name for col in table.columns]
+        updates = [f'{col} = {col} + excluded.{col}' if accumulate else f'{col} = excluded.{col}' for col in values]
+        return sqlalchemy.text(
+            f'INSERT INTO {table.name} ({", ".join(columns)}) '
+            f'VALUES ({", ".join(":" + col for col in columns)}) '
+            f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET '
+            f'{", ".join(updates)}'
+        ).bindparams(*[sqlalchemy.bindparam(col.name, type_=col.type) for col in table.columns])
+    logger.warning('Upsert is not supported for %s, existing rows will raise IntegrityError', dialect_name)
+    return table.insert()
+
+
+def read_checkpoint(checkpoint_path: Optional[str], input_path: str) -> Dict:
+    """Read the ingest checkpoint of `input_path`; a missing checkpoint or one of another file starts over.
+
+    Args:
+        checkpoint_path (str): path to the json checkpoint file, None to disable checkpointing
+        input_path (str): path to the csv file being ingested
+
+    Returns:
+        checkpoint (dict): input file identity and number of committed rows
+    """
+    stat = os.stat(input_path)
+    fresh = {'input_path': os.path.abspath(input_path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+             'rows_committed': 0}
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return fresh
+    with open(checkpoint_path, 'r', encoding='utf8') as f:
+        checkpoint = json.load(f)
+    if any(checkpoint.get(key) != fresh[key] for key in ('input_path', 'size', 'mtime')):
+        logger.warning('Checkpoint %s belongs to another version of the input file, starting over', checkpoint_path)
+        return fresh
+    return checkpoint
+
+
+def write_checkpoint(checkpoint_path: Optional[str], checkpoint: Dict) -> None:
+    """Atomically replace the ingest checkpoint.
+
+    Args:
+        checkpoint_path (str): path to the json checkpoint file, None to disable checkpointing
+        checkpoint (dict): input file identity and number of committed rows
+
+    Returns: None
+    """
+    if checkpoint_path is None:
+        return
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that counts checkouts, checkouts that had to wait for a free connection, and timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+
+    def _do_get(self):
+        # every pooled connection is checked out and no overflow is left, so this checkout blocks
+        exhausted = self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            self.timeouts += 1
+            logger.error('Timed out waiting for a database connection: %s', self.status())
+            raise
+        finally:
+            if exhausted:
+                self.waits += 1
+                self.total_wait_seconds += time.perf_counter() - start
+        self.checkouts += 1
+        return connection
+
+    def stats(self) -> Dict:
+        """
+        Summarize pool usage
+        Returns:
+            stats (dict): pool size, connections in use and overflow, and checkout/wait/timeout counters
+        """
+        return {'pool': type(self).__name__,
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'checked_in': self.checkedin(),
+                'overflow': self.overflow(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'total_wait_ms': round(self.total_wait_seconds * 1000, 3)}
+
+
+def engine_options(engine_string: str, pool_size: int = 5, max_overflow: int = 10, pool_timeout: float = 30,
+                   pool_recycle: int = 3600, pool_pre_ping: bool = True) -> Dict:
+    """
+    Keyword arguments for `sqlalchemy.create_engine` that set up an instrumented connection pool.
+
+    SQLite connections are cheap to open and bound to the thread that opened them, so SQLite engines keep
+    SQLAlchemy's default pool and only get pre-ping.
+    Args:
+        engine_string (str): SQLAlchemy engine string of the database
+        pool_size (int): connections kept open in the pool
+        max_overflow (int): extra connections opened beyond `pool_size` under load
+        pool_timeout (float): seconds to wait for a free connection before raising
+        pool_recycle (int): seconds after which a connection is replaced, to stay below the server's idle timeout
+        pool_pre_ping (bool): test connections on checkout and transparently replace dropped ones
+
+    Returns:
+        options (dict): engine keyword arguments
+    """
+    if sqlalchemy.engine.url.make_url(engine_string).get_backend_name() == 'sqlite':
+        return {'pool_pre_ping': pool_pre_ping}
+    return {'poolclass': InstrumentedQueuePool,
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': pool_timeout,
+            'pool_recycle': pool_recycle,
+            'pool_pre_ping': pool_pre_ping}
+
+
 class ChurnManager:
-    def __init__(self, app=None, engine_string=None):
+    def __init__(self, app=None, engine_string=None, pool_options: Optional[Dict] = None):
+        """
+        Set up request-scoped sessions on a pooled engine, either through Flask-SQLAlchemy or from an engine string
+        Args:
+            app (obj: Flask): Flask app; pool settings are read from its DB_POOL_* configuration
+            engine_string (str): SQLAlchemy engine string, used if no app is given
+            pool_options (dict): keyword arguments of `engine_options` when initializing from an engine string
+        """
         if app:
+            app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(
+                app.config['SQLALCHEMY_DATABASE_URI'],
+                pool_size=app.config.get('DB_POOL_SIZE', 5),
+                max_overflow=app.config.get('DB_MAX_OVERFLOW', 10),
+                pool_timeout=app.config.get('DB_POOL_TIMEOUT', 30),
+                pool_recycle=app.config.get('DB_POOL_RECYCLE', 3600),
+                pool_pre_ping=app.config.get('DB_POOL_PRE_PING', True)))
             self.database = SQLAlchemy(app)
+            # Flask-SQLAlchemy removes this scoped session when the app context of each request tears down
             self.session = self.database.session
         elif engine_string:
-            engine = sqlalchemy.create_engine(engine_string)
-            session_maker = sqlalchemy.orm.sessionmaker(bind=engine)
-            self.session = session_maker()
+            engine = sqlalchemy.create_engine(engine_string, **engine_options(engine_string, **(pool_options or {})))
+            # one session per thread, all drawing connections from the engine's shared pool
+            self.session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=engine))
         else:
             raise ValueError('Need either an engine string or a Flask app to initialize')
 
+    def pool_stats(self) -> Dict:
+        """
+        Report the state of the connection pool behind the sessions
+        Returns:
+            stats (dict): pool statistics; only the pool class and its status for pools that are not instrumented
+        """
+        pool = self.session.get_bind().pool
+        if isinstance(pool, InstrumentedQueuePool):
+            return pool.stats()
+        return {'pool': type(pool).__name__, 'status': pool.status()}
+
+    def list_customers(self, limit: int, after_id: Optional[int] = None, churn: Optional[str] = None,
+                       international_plan: Optional[str] = None, voice_mail_plan: Optional[str] = None,
+                       min_service_calls: Optional[int] = None,
+                       max_service_calls: Optional[int] = None) -> Tuple[List[Customer], Optional[int]]:
+        """
+        Fetch one page of customers ordered by id, optionally filtered.
+
+        Pages are addressed by the last id of the previous page (keyset pagination) instead of an OFFSET, so
+        every page is an index seek and costs the same however deep into the table it is.
+        Args:
+            limit (int): number of customers per page
+            after_id (int): last customer id of the previous page; None for the first page
+            churn (str): only customers with this churn label ("Yes" or "No")
+            international_plan (str): only customers with ("Yes") or without ("No") international plan
+            voice_mail_plan (str): only customers with ("Yes") or without ("No") voice mail plan
+            min_service_calls (int): only customers with at least this many customer service calls
+            max_service_calls (int): only customers with at most this many customer service calls
+
+        Returns:
+            customers (List[Customer]): customers of the page
+            next_after_id (int): cursor of the next page; None if this is the last page
+        """
+        query = self.session.query(Customer)
+        if after_id is not None:
+            query = query.filter(Customer.id > after_id)
+        if churn is not None:
+            query = query.filter(Customer.churn == churn)
+        if international_plan is not None:
+            query = query.filter(Customer.international_plan == international_plan)
+        if voice_mail_plan is not None:
+            query = query.filter(Customer.voice_mail_plan == voice_mail_plan)
+        if min_service_calls is not None:
+            query = query.filter(Customer.customer_service_calls >= min_service_calls)
+        if max_service_calls is not None:
+            query = query.filter(Customer.customer_service_calls <= max_service_calls)
+        # one extra row tells whether another page follows
+        customers = query.order_by(Customer.id).limit(limit + 1).all()
+        if len(customers) > limit:
+            return customers[:limit], customers[limit - 1].id
+        return customers, None
+
     def close(self) -> None:
-        # closes session
-        self.session.close()
+        # closes the session of the calling thread and returns its connection to the pool
+        self.session.remove()
 
-    def add_customer_data(self, input_path: str) -> None:
-        session = self.session
-        # convert the raw dataframe to a list of dictionaries
-        raw_data_list = pd.read_csv(input_path).to_dict(orient='records')
-        data_list = []
-        for data in raw_data_list:
-            data_list.append(Customer(**data))
+    def add_customer_data(self, input_path: str, chunksize: Optional[int] = None,
+                          checkpoint_path: Optional[str] = None, dtypes: Optional[Dict] = None,
+                          validate: Optional[Dict] = None) -> int:
+        """
+        Add customer data from a csv file to the database.
+        Args:
+            input_path (str): path to the csv file with customer data
+            chunksize (int): number of rows read, inserted and committed at a time; if None, the whole file is
+                upserted with `upsert_customers`, in one Core statement and one commit
+            checkpoint_path (str): optional json file recording the committed chunks, so an interrupted streaming
+                ingest resumes after the last committed chunk
+            dtypes (dict): declared dtypes of the cleaned data (see `src.schema.parse_dtypes`); if given, the file
+                is checked against them and read with them
+            validate (dict): `int_cols` and `numeric_cols` to check with `src.process_data.validate_batch`; invalid
+                rows are logged and skipped instead of failing the ingest
 
+        Returns:
+            n_rows (int): number of records added
+        """
+        if chunksize is not None:
+            return self._stream_customer_data(input_path, chunksize, checkpoint_path, dtypes, validate)
+
+        # convert the raw dataframe to a list of dictionaries
+        columns = self._csv_columns(input_path)
+        if dtypes is not None:
+            data = read_csv_with_schema(input_path, self._ingest_dtypes(dtypes), columns)
+        else:
+            data = pd.read_csv(input_path, usecols=columns)
+        data_list = self._valid_records(data, validate)
         try:
-            session.add_all(data_list)
-            session.commit()
+            self.upsert_customers(data_list)
         except sqlalchemy.exc.OperationalError as e:
             logger.error('You might have connection error. Have you configured SQLALCHEMY_DATABASE_URI '
                          'variable correctly and connected to Northwestern VPN? Error: %s ', e)
+            return 0
         except sqlite3.OperationalError as e:
             logger.error('Error page returned. Not able to add customer data to local sqlite '
                          'database. Is it the right path? Error: %s ', e)
+            return 0
         else:
             logger.info('%d records were added to the table', len(data_list))
+            return len(data_list)
+
+    def upsert_customers(self, records: List[Dict]) -> None:
+        """
+        Insert customer records, overwriting existing customers with the same id, in one statement and commit.
+        The counts and sums of the segments they leave and join in churn_segments are updated in the same commit.
+        Args:
+            records (List[dict]): one dict of column values per customer
+
+        Returns:
+            None
+        """
+        if not records:
+            return
+        session = self.session
+        dialect_name = session.get_bind().dialect.name
+        with metrics.stage('db_write', records=len(records)):
+            try:
+                self._lock_segments(records, dialect_name)
+                replaced = self._current_customers([int(record['id']) for record in records])
+                session.execute(upsert_statement(Customer.__table__, dialect_name), records)
+                deltas = segment_deltas(records, replaced)
+                if deltas:
+                    session.execute(upsert_statement(ChurnSegment.__table__, dialect_name, accumulate=True), deltas)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
+    def _lock_segments(self, records: List[Dict], dialect_name: str) -> None:
+        # Writers take turns on the rows of churn_segments, so that each reads the customers it replaces only after
+        # the previous writer committed; locking rows of the churn table cannot do that for ids not inserted yet.
+        # The segments the records join are created first, in a commit of their own, so every writer locks at
+        # least its own segments, and of two concurrent writers one locks a segment the other holds and waits.
+        table = ChurnSegment.__table__
+        keys = [col.name for col in table.primary_key.columns]
+        # sorted, so that concurrent writers lock the segments they create in the same order
+        joined = sorted(({**{key: delta[key] for key in keys}, **{col.name: 0 for col in table.columns
+                                                                    if col.name not in keys}}
+                         for delta in segment_deltas(records, {})), key=lambda row: [row[key] for key in keys])
+        self.session.execute(upsert_statement(table, dialect_name, accumulate=True), joined)
+        self.session.commit()
+        self.session.execute(sqlalchemy.select(list(table.primary_key.columns))
+                             .order_by(*table.primary_key.columns).with_for_update()).fetchall()
+
+    def _current_customers(self, ids: List[int]) -> Dict[int, Dict]:
+        # rows about to be overwritten; the segment locks keep them from changing until the commit
+        table = Customer.__table__
+        columns = [table.c.id, table.c.international_plan, table.c.voice_mail_plan, table.c.churn] + \
+            [table.c[col] for col in SEGMENT_SUMS]
+        # one expanding parameter instead of a bound parameter per id, chunked to stay below SQLite's limit
+        query = sqlalchemy.select(columns).where(table.c.id.in_(sqlalchemy.bindparam('ids', expanding=True)))
+        current = {}
+        for start in range(0, len(ids), 500):
+            for row in self.session.execute(query, {'ids': ids[start:start + 500]}):
+                current[row['id']] = dict(row)
+        return current
+
+    def rebuild_segments(self) -> int:
+        """
+        Recompute churn_segments from the whole churn table in one pass, e.g. after the service call buckets
+        changed or the churn table was written to without ChurnManager.
+        Returns:
+            n_segments (int): number of segments written
+        """
+        table = ChurnSegment.__table__
+        start = time.perf_counter()
+        try:
+            self.session.execute(table.delete())
+            self.session.execute(table.insert().from_select([col.name for col in table.columns], segments_query()))
+            n_segments = self.session.query(ChurnSegment).count()
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        logger.info('%d churn segments rebuilt in %.2f s', n_segments, time.perf_counter() - start)
+        return n_segments
+
+    def segment_stats(self, by: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Churn rate and mean usage per segment, read from churn_segments rather than the churn table, so it costs
+        the same however many customers there are.
+        Args:
+            by (List[str]): dimensions to break down by, out of "international_plan", "voice_mail_plan" and
+                "service_calls"; all three if None, none for the totals
+
+        Returns:
+            segments (List[dict]): per segment its dimensions, number of customers and churned customers, churn rate
+                and the mean of every summed column
+        """
+        by = SEGMENT_DIMENSIONS if by is None else by
+        unknown = [dim for dim in by if dim not in SEGMENT_DIMENSIONS]
+        if unknown:
+            raise ValueError(f'Unknown dimensions {unknown}, expected some of {SEGMENT_DIMENSIONS}')
+        columns = ['customers', 'churned'] + [f'sum_{col}' for col in SEGMENT_SUMS]
+        groups: Dict[Tuple, List[float]] = {}
+        for segment in self.session.query(ChurnSegment).order_by(*ChurnSegment.__table__.primary_key.columns):
+            dims = {'international_plan': segment.international_plan, 'voice_mail_plan': segment.voice_mail_plan,
+                    'service_calls': service_calls_label(segment.min_service_calls)}
+            totals = groups.setdefault(tuple(dims[dim] for dim in by), [0] * len(columns))
+            for i, col in enumerate(columns):
+                totals[i] += getattr(segment, col)
+        segments = []
+        for key, totals in groups.items():
+            customers, churned = totals[0], totals[1]
+            if customers == 0:
+                continue
+            segments.append({**dict(zip(by, key)), 'customers': customers, 'churned': churned,
+                             'churn_rate': round(churned / customers, 4),
+                             **{f'mean_{col}': round(total / customers, 4)
+                                for col, total in zip(SEGMENT_SUMS, totals[2:])}})
+        return segments
+
+    def _upsert(self, table: sqlalchemy.Table, records: List[Dict]) -> None:
+        session = self.session
+        statement = upsert_statement(table, session.get_bind().dialect.name)
+        with metrics.stage('db_write', records=len(records)):
+            try:
+                session.execute(statement, records)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
+    @staticmethod
+    def _valid_records(chunk: pd.DataFrame, validate: Optional[Dict]) -> List[Dict]:
+        if validate is not None:
+            chunk, invalid, errors = validate_batch(chunk, **validate)
+            if invalid.any():
+                logger.warning('Skipped %d invalid rows, e.g. row %s: %s', invalid.sum(), errors.index[0],
+                               errors.iloc[0])
+        # object dtype hands native python values to the driver instead of numpy scalars
+        return chunk.astype(object).to_dict(orient='records')
+
+    @staticmethod
+    def _csv_columns(input_path: str) -> List[str]:
+        # only the columns of the churn table are loaded; the csv may carry more
+        header = pd.read_csv(input_path, nrows=0).columns
+        return [col.name for col in Customer.__table__.columns if col.name in header]
+
+    @staticmethod
+    def _ingest_dtypes(dtypes: Dict) -> Dict:
+        # floats stay float64: float32 values would reach the database as e.g. 265.1000061035156
+        return {col: np.dtype(np.float64) if getattr(dtype, 'kind', None) == 'f' else dtype
+                for col, dtype in dtypes.items()}
+
+    def _stream_customer_data(self, input_path: str, chunksize: int, checkpoint_path: Optional[str],
+                              dtypes: Optional[Dict] = None, validate: Optional[Dict] = None) -> int:
+        checkpoint = read_checkpoint(checkpoint_path, input_path)
+        skip = checkpoint['rows_committed']
+        if skip:
+            logger.info('Resuming ingest of %s after %d committed rows', input_path, skip)
+
+        columns = self._csv_columns(input_path)
+        if dtypes is not None:
+            reader = iter_csv_with_schema(input_path, self._ingest_dtypes(dtypes), chunksize, columns,
+                                          skiprows=range(1, skip + 1))
+        else:
+            reader = pd.read_csv(input_path, usecols=columns, chunksize=chunksize, skiprows=range(1, skip + 1))
+        n_rows = 0
+        start = time.perf_counter()
+        for chunk in reader:
+            records = self._valid_records(chunk, validate)
+            try:
+                self.upsert_customers(records)
+            except (sqlalchemy.exc.OperationalError, sqlite3.OperationalError) as e:
+                logger.error('Not able to insert chunk after %d rows; rerun to resume from the last committed '
+                             'chunk. Error: %s', checkpoint['rows_committed'], e)
+                raise
+            n_rows += len(records)
+            # skipped rows count as committed, they are not read again on resume
+            checkpoint['rows_committed'] += len(chunk)
+            write_checkpoint(checkpoint_path, checkpoint)
+            logger.debug('%d rows committed (%.0f rows/sec)', checkpoint['rows_committed'],
+                         n_rows / (time.perf_counter() - start))
+
+        elapsed = time.perf_counter() - start
+        logger.info('%d records were added to the table in %.1f s (%.0f rows/sec)', n_rows, elapsed,
+                    n_rows / elapsed if elapsed > 0 else 0.0)
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return n_rows
+
+    def iter_customer_batches(self, columns: List[str], batch_size: int,
+                              after_id: Optional[int] = None) -> Iterator[pd.DataFrame]:
+        """
+        Stream customers out of the churn table in id order, one keyset batch at a time.
+
+        Every batch is its own `id > last id` query, an index seek like the pages of `list_customers`, run on a
+        server-side cursor where the driver supports one, so no more than one batch is held in memory and no read
+        stays open while the caller writes.
+        Args:
+            columns (List[str]): columns to read besides id
+            batch_size (int): customers per batch
+            after_id (int): read only customers with a larger id, e.g. from a checkpoint; None for all
+
+        Returns:
+            batches (Iterator[pd.DataFrame]): id and the requested columns of up to `batch_size` customers each
+        """
+        table = Customer.__table__
+        selected = [table.c.id] + [table.c[col] for col in columns]
+        connection = self.session.get_bind().connect().execution_options(stream_results=True)
+        try:
+            while True:
+                query = sqlalchemy.select(selected).order_by(table.c.id).limit(batch_size)
+                if after_id is not None:
+                    query = query.where(table.c.id > after_id)
+                batch = pd.DataFrame(connection.execute(query).fetchall(), columns=['id'] + columns)
+                if batch.empty:
+                    return
+                yield batch
+                after_id = int(batch['id'].iloc[-1])
+        finally:
+            connection.close()
+
+    def score_customers(self, model: Any, schema: FeatureSchema, model_version: str, batch_size: int = 10000,
+                        checkpoint_path: Optional[str] = None, cache: Optional[PredictionCache] = None) -> int:
+        """
+        Score every customer of the churn table and upsert the predictions into the churn_scores table, batch by
+        batch with bounded memory. Every batch is committed with its checkpoint, so an interrupted run resumes after
+        the last committed customer id.
+        Args:
+            model (Any): trained model exposing `predict_proba` and `classes_`
+            schema (obj: FeatureSchema): feature schema saved with the model
+            model_version (str): version of the model recorded with every score; a checkpoint of another model
+                version is discarded
+            batch_size (int): customers read, scored and committed at a time
+            checkpoint_path (str): optional json file recording the last committed customer id
+            cache (obj: PredictionCache): optional cache of predictions; only the customers it misses are scored
+
+        Returns:
+            n_rows (int): number of customers scored by this run
+        """
+        checkpoint: Dict[str, Any] = {'model_version': model_version, 'last_id': None, 'rows_scored': 0}
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf8') as f:
+                saved = json.load(f)
+            if saved.get('model_version') == model_version:
+                checkpoint = saved
+                logger.info('Resuming scoring after customer id %s', checkpoint['last_id'])
+            else:
+                logger.warning('Checkpoint %s belongs to another model version, starting over', checkpoint_path)
+
+        scored_at = datetime.utcnow()
+        n_rows = 0
+        start = time.perf_counter()
+        for batch in self.iter_customer_batches(schema.columns, batch_size, checkpoint['last_id']):
+            pred = predict_batch(model, schema, batch, cache=cache, model_version=model_version)
+            scores = pd.DataFrame({'id': batch['id'], 'pred_class': pred['pred_class'],
+                                   'pred_proba': pred['pred_proba']})
+            # object dtype hands native python values to the driver instead of numpy scalars
+            records = [{**record, 'model_version': model_version, 'scored_at': scored_at}
+                       for record in scores.astype(object).to_dict(orient='records')]
+            try:
+                self._upsert(ChurnScore.__table__, records)
+            except (sqlalchemy.exc.OperationalError, sqlite3.OperationalError) as e:
+                logger.error('Not able to write scores after customer id %s; rerun to resume from there. Error: %s',
+                             checkpoint['last_id'], e)
+                raise
+            n_rows += len(batch)
+            checkpoint['last_id'] = int(batch['id'].iloc[-1])
+            checkpoint['rows_scored'] += len(batch)
+            write_checkpoint(checkpoint_path, checkpoint)
+            logger.debug('%d customers scored (%.0f rows/sec)', checkpoint['rows_scored'],
+                         n_rows / (time.perf_counter() - start))
+
+        elapsed = time.perf_counter() - start
+        logger.info('%d customers were scored with model %s in %.1f s (%.0f rows/sec)', n_rows, model_version,
+                    elapsed, n_rows / elapsed if elapsed > 0 else 0.0)
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return n_rows
 
     def add_one_record(self, cust_id: int, international_plan: str,
                        voice_mail_plan: str, number_vmail_messages: int, total_day_minutes: float,
                        total_eve_minutes: float, total_night_minutes: float, total_intl_minutes: float,
                        total_intl_calls: int, customer_service_calls: int, churn: str):
         """
-        Add one customer record to the database.
+        Add one customer record to the database, replacing the record of an existing customer id.
         Args:
             cust_id (int): customer id (unique)
             international_plan (str): whether a customer has international plan ("Yes" or "No")
@@ -109,24 +762,17 @@ class ChurnManager:
         Returns:
             None
         """
-        session = self.session
         try:
-            customer = Customer(id=cust_id, international_plan=international_plan, voice_mail_plan=voice_mail_plan,
-                                number_vmail_messages=number_vmail_messages, total_day_minutes=total_day_minutes,
-                                total_eve_minutes=total_eve_minutes, total_night_minutes=total_night_minutes,
-                                total_intl_minutes=total_intl_minutes, total_intl_calls=total_intl_calls,
-                                customer_service_calls=customer_service_calls, churn=churn)
-
+            self.upsert_customers([{'id': cust_id, 'international_plan': international_plan,
+                                    'voice_mail_plan': voice_mail_plan, 'number_vmail_messages': number_vmail_messages,
+                                    'total_day_minutes': total_day_minutes, 'total_eve_minutes': total_eve_minutes,
+                                    'total_night_minutes': total_night_minutes,
+                                    'total_intl_minutes': total_intl_minutes, 'total_intl_calls': total_intl_calls,
+                                    'customer_service_calls': customer_service_calls, 'churn': churn}])
         except sqlalchemy.exc.OperationalError as e:
             logger.error(
                 'Cannot connect to the database.  '
                 'Please check configuration of SQLALCHEMY_DATABASE_URI and VPN. Error: %s ', e)
-
-        # exception handling for non-unique customer id
-        except sqlalchemy.exc.IntegrityError:
-            logger.error('Customer id %d already exists in the database.', cust_id)
-
+            raise
         else:
-            session.add(customer)
-            session.commit()
             logger.info('One customer record added to database: customer id %s', cust_id)
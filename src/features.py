@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+from typing import Dict, List
+
+import numpy as np
+
+from src.metrics import metrics
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('features')
+
+
+class FeatureSchema:
+    """Frozen description of how raw input columns map onto the model's encoded feature columns.
+
+    The schema is captured from the training data, so serving encodes records exactly the way
+    `pd.get_dummies(drop_first=True)` did in `train_model`, without building any DataFrame.
+    """
+
+    def __init__(self, columns: List[str], categories: Dict[str, List[str]], features: List[str]):
+        self.columns = list(columns)
+        self.categories = {col: list(levels) for col, levels in categories.items()}
+        self.features = list(features)
+        self.numeric = [col for col in self.columns if col not in self.categories]
+
+        index = {feature: i for i, feature in enumerate(self.features)}
+        missing = [col for col in self.numeric if col not in index]
+        if missing:
+            raise ValueError(f'Numeric columns {missing} are not model features')
+        self.numeric_index = [(col, index[col]) for col in self.numeric]
+        # (column, level) -> feature position; the dropped first level maps to no column at all
+        self.dummy_index = {}
+        for col, levels in self.categories.items():
+            for level in levels[1:]:
+                name = f'{col}_{level}'
+                if name not in index:
+                    raise ValueError(f'Dummy column {name} is not a model feature')
+                self.dummy_index[(col, level)] = index[name]
+
+    @classmethod
+    def from_training(cls, X, features: List[str]) -> 'FeatureSchema':
+        """
+        Capture the schema from the training features before and after dummy coding
+        Args:
+            X (obj: pd.DataFrame): selected training features before `pd.get_dummies`
+            features (List[str]): encoded training columns, in the order the model was fit on
+
+        Returns:
+            schema (obj: FeatureSchema): frozen feature schema
+        """
+        categories = {}
+        for col in X.columns:
+            if hasattr(X[col], 'cat'):
+                categories[col] = [str(level) for level in X[col].cat.categories]
+            elif X[col].dtype == object:
+                # pd.get_dummies orders levels lexically and drop_first drops the first one
+                categories[col] = sorted(str(level) for level in X[col].dropna().unique())
+        return cls(list(X.columns), categories, features)
+
+    def to_dict(self) -> Dict:
+        """
+        Convert the schema to a json serializable dictionary
+        Returns:
+            schema (dict): column order, categorical levels and encoded feature names
+        """
+        return {'columns': self.columns,
+                'categories': self.categories,
+                'features': self.features}
+
+    def save(self, path: str) -> None:
+        """
+        Save the schema as json to the specified path
+        Args:
+            path (str): path to save the feature schema
+
+        Returns:
+            None
+        """
+        # renamed over the target once complete, so a worker reloading the schema never reads a partial file
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+        logger.info('Feature schema saved to %s', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'FeatureSchema':
+        """
+        Load a schema saved by `save`
+        Args:
+            path (str): path to the feature schema
+
+        Returns:
+            schema (obj: FeatureSchema): frozen feature schema
+        """
+        with open(path, 'r', encoding='utf8') as f:
+            return cls(**json.load(f))
+
+    def _check_level(self, col: str, value) -> None:
+        if value not in self.categories[col]:
+            logger.error('Error: %s must be one of %s', col, self.categories[col])
+            raise ValueError(f'{col} must be one of {self.categories[col]}')
+
+    def encode_record(self, record: Dict) -> np.ndarray:
+        """
+        Encode one record into a preallocated feature row
+        Args:
+            record (dict): mapping of input column to validated value
+
+        Returns:
+            row (obj: np.ndarray): encoded features of shape (1, n_features)
+        """
+        with metrics.stage('encoding'):
+            row = np.zeros((1, len(self.features)))
+            for col, i in self.numeric_index:
+                row[0, i] = record[col]
+            for col in self.categories:
+                value = record[col]
+                self._check_level(col, value)
+                dummy = self.dummy_index.get((col, value))
+                if dummy is not None:
+                    row[0, dummy] = 1.0
+            return row
+
+    def encode_batch(self, data) -> np.ndarray:
+        """
+        Encode a batch of records column by column into a preallocated feature matrix
+        Args:
+            data (obj: pd.DataFrame or dict of arrays): validated input columns
+
+        Returns:
+            X (obj: np.ndarray): encoded features of shape (n_records, n_features)
+        """
+        n = len(data[self.columns[0]])
+        with metrics.stage('encoding', records=n):
+            X = np.zeros((n, len(self.features)))
+            for col, i in self.numeric_index:
+                X[:, i] = np.asarray(data[col], dtype=float)
+            for col, levels in self.categories.items():
+                values = np.asarray(data[col], dtype=object)
+                unknown = ~np.isin(values, levels)
+                if unknown.any():
+                    logger.error('Error: %s must be one of %s', col, levels)
+                    raise ValueError(f'{col} must be one of {levels}')
+                for level in levels[1:]:
+                    X[:, self.dummy_index[(col, level)]] = values == level
+            return X
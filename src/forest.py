@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import List, Optional
+
+import numpy as np
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('forest')
+
+# memory-mapped forest file: magic, header length, json header, then the node arrays at aligned offsets
+FOREST_MAGIC = b'CHURNFOREST\x00'
+FOREST_FORMAT_VERSION = 1
+_HEADER_LENGTH = struct.Struct('<Q')
+_ALIGNMENT = 64
+# records walked through the trees at a time, so the per-record node and leaf arrays stay a few MB however large
+# the batch is
+PREDICT_CHUNK_ROWS = 4096
+
+
+def _padding(nbytes: int) -> int:
+    # zero bytes that align what follows to _ALIGNMENT
+    return -nbytes % _ALIGNMENT
+
+
+class FlatForest:
+    """A trained random forest flattened into contiguous node arrays.
+
+    All trees share one set of arrays; `roots` holds the index of each tree's root node. Leaves point to
+    themselves, so a batch can walk every tree at once for a fixed `max_depth` number of steps. Leaf values
+    are the per-tree class probabilities exactly as `DecisionTreeClassifier.predict_proba` computes them, and
+    they are accumulated tree by tree in estimator order, so the result is bit-for-bit identical to
+    `RandomForestClassifier.predict_proba`.
+    """
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, children_left: np.ndarray,
+                 children_right: np.ndarray, value: np.ndarray, roots: np.ndarray, classes: np.ndarray,
+                 max_depth: int, n_features: int, children: Optional[np.ndarray] = None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.value = value
+        self.roots = roots
+        self.classes_ = classes
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        # left and right child interleaved, so one gather picks the next node; a memory-mapped forest stores it
+        self._children = np.stack([children_left, children_right], axis=1).ravel() if children is None else children
+
+    @property
+    def n_estimators(self) -> int:
+        """Number of trees in the forest."""
+        return len(self.roots)
+
+    def predict_proba(self, X, chunk_rows: int = PREDICT_CHUNK_ROWS) -> np.ndarray:
+        """
+        Predict class probabilities for a batch of encoded records
+        Args:
+            X (obj: np.ndarray or pd.DataFrame): encoded features of shape (n_records, n_features)
+            chunk_rows (int): records walked through the trees at a time, which bounds the working memory to
+                about `chunk_rows` x n_trees x (n_classes + 2) x 8 bytes
+
+        Returns:
+            proba (obj: np.ndarray): class probabilities of shape (n_records, n_classes)
+        """
+        # the trees compare float32 features against float64 thresholds, like sklearn does
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f'X has shape {X.shape}, expected (n_records, {self.n_features})')
+        proba = np.empty((X.shape[0], len(self.classes_)))
+        for start in range(0, X.shape[0], chunk_rows):
+            proba[start:start + chunk_rows] = self._predict_chunk(X[start:start + chunk_rows])
+        return proba
+
+    def _predict_chunk(self, X: np.ndarray) -> np.ndarray:
+        n_records = X.shape[0]
+        X_flat = X.ravel()
+        row_offset = (np.arange(n_records) * self.n_features)[:, np.newaxis]
+        node = np.repeat(self.roots[np.newaxis, :], n_records, axis=0)
+        for _ in range(self.max_depth):
+            # written as "not <=" so NaN features go right exactly like sklearn's `<=` test
+            go_right = ~(X_flat[row_offset + self.feature[node]] <= self.threshold[node])
+            node = self._children[2 * node + go_right]
+
+        leaf_value = self.value[node]
+        proba = np.zeros((n_records, len(self.classes_)))
+        for t in range(self.n_estimators):
+            proba += leaf_value[:, t]
+        proba /= self.n_estimators
+        return proba
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Predict class labels for a batch of encoded records
+        Args:
+            X (obj: np.ndarray or pd.DataFrame): encoded features of shape (n_records, n_features)
+
+        Returns:
+            pred (obj: np.ndarray): predicted class labels
+        """
+        return self.classes_.take(self.predict_proba(X).argmax(axis=1))
+
+    def arrays(self) -> dict:
+        """
+        Collect the node arrays and metadata that fully describe the forest
+        Returns:
+            arrays (dict): mapping of attribute name to array
+        """
+        return {'feature': self.feature,
+                'threshold': self.threshold,
+                'children_left': self.children_left,
+                'children_right': self.children_right,
+                'value': self.value,
+                'roots': self.roots,
+                'classes': self.classes_,
+                'max_depth': np.array(self.max_depth),
+                'n_features': np.array(self.n_features)}
+
+    def save(self, path: str) -> None:
+        """
+        Save the flattened forest, as a memory-mappable forest file (.forest) or a numpy archive (.npz)
+        Args:
+            path (str): path to save the flattened forest
+
+        Returns:
+            None
+        """
+        if path.endswith('.npz'):
+            # renamed over the target once complete, so a worker reloading the forest never reads a partial file
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **self.arrays())
+            os.replace(tmp_path, path)
+        else:
+            self._save_mapped(path)
+        logger.info('Flattened random forest saved to %s', path)
+
+    def _save_mapped(self, path: str) -> None:
+        arrays = {name: np.ascontiguousarray(array) for name, array in self.arrays().items()
+                  if name not in ('max_depth', 'n_features')}
+        arrays['children'] = np.ascontiguousarray(self._children)
+        layout = {}
+        offset = 0
+        sha = hashlib.sha256()
+        for name, array in arrays.items():
+            layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += array.nbytes + _padding(array.nbytes)
+            sha.update(array.tobytes())
+            sha.update(bytes(_padding(array.nbytes)))
+        header = json.dumps({'format_version': FOREST_FORMAT_VERSION, 'max_depth': self.max_depth,
+                             'n_features': self.n_features, 'arrays': layout, 'sha256': sha.hexdigest()}).encode()
+        prefix = FOREST_MAGIC + _HEADER_LENGTH.pack(len(header)) + header
+        # written next to the target and renamed over it: workers that mapped the old file keep reading it intact,
+        # while rewriting it in place would change (or truncate) pages under their feet
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(prefix + bytes(_padding(len(prefix))))
+            for array in arrays.values():
+                f.write(array.tobytes())
+                f.write(bytes(_padding(array.nbytes)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, verify: bool = True) -> 'FlatForest':
+        """
+        Load a flattened forest saved by `save`. The node arrays of a forest file are memory-mapped read-only, so
+        loading takes milliseconds and all processes loading the same file share its pages
+        Args:
+            path (str): path to the flattened forest (.forest or .npz)
+            verify (bool): check the integrity hash of a forest file, which reads the whole file once
+
+        Returns:
+            forest (obj: FlatForest): flattened forest
+
+        Raises:
+            ValueError: if a forest file is not one, has an unsupported format version or fails the integrity check
+        """
+        if path.endswith('.npz'):
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {key: data[key] for key in data.files}
+            return cls(arrays['feature'], arrays['threshold'], arrays['children_left'], arrays['children_right'],
+                       arrays['value'], arrays['roots'], arrays['classes'], arrays['max_depth'].item(),
+                       arrays['n_features'].item())
+
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        prefix = len(FOREST_MAGIC) + _HEADER_LENGTH.size
+        if buffer[:len(FOREST_MAGIC)] != FOREST_MAGIC:
+            raise ValueError(f'{path} is not a forest file')
+        header_length, = _HEADER_LENGTH.unpack(buffer[len(FOREST_MAGIC):prefix])
+        header = json.loads(buffer[prefix:prefix + header_length])
+        if header['format_version'] != FOREST_FORMAT_VERSION:
+            raise ValueError(f'{path} has forest format version {header["format_version"]}, '
+                             f'expected {FOREST_FORMAT_VERSION}')
+        data_start = prefix + header_length + _padding(prefix + header_length)
+        if verify and hashlib.sha256(memoryview(buffer)[data_start:]).hexdigest() != header['sha256']:
+            raise ValueError(f'{path} failed the integrity check, the file is corrupt or incomplete')
+        # read-only views into the mapping; the pages are shared with every process mapping the file
+        arrays = {name: np.frombuffer(buffer, dtype=np.dtype(spec['dtype']), count=int(np.prod(spec['shape'])),
+                                      offset=data_start + spec['offset']).reshape(spec['shape'])
+                  for name, spec in header['arrays'].items()}
+        return cls(arrays['feature'], arrays['threshold'], arrays['children_left'], arrays['children_right'],
+                   arrays['value'], arrays['roots'], arrays['classes'], header['max_depth'], header['n_features'],
+                   children=arrays['children'])
+
+
+def forest_digest(path: str) -> str:
+    """
+    Compute the content hash of a forest file from its header alone. The header holds the sha256 of the node
+    arrays, which `FlatForest.load` checks, so the hash covers the whole file without reading the arrays
+    Args:
+        path (str): path to the forest file
+
+    Returns:
+        digest (str): hex sha256 of the header
+
+    Raises:
+        ValueError: if the file is not a forest file
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(len(FOREST_MAGIC) + _HEADER_LENGTH.size)
+        if prefix[:len(FOREST_MAGIC)] != FOREST_MAGIC or len(prefix) < len(FOREST_MAGIC) + _HEADER_LENGTH.size:
+            raise ValueError(f'{path} is not a forest file')
+        header_length, = _HEADER_LENGTH.unpack(prefix[len(FOREST_MAGIC):])
+        return hashlib.sha256(f.read(header_length)).hexdigest()
+
+
+def compile_forest(rf_model) -> FlatForest:
+    """
+    Flatten all trees of a fitted random forest into contiguous node arrays
+    Args:
+        rf_model (obj: RandomForestClassifier): fitted random forest model object
+
+    Returns:
+        forest (obj: FlatForest): flattened forest
+    """
+    features: List[np.ndarray] = []
+    thresholds: List[np.ndarray] = []
+    lefts: List[np.ndarray] = []
+    rights: List[np.ndarray] = []
+    values: List[np.ndarray] = []
+    roots = []
+    offset = 0
+    max_depth = 0
+    n_classes = len(rf_model.classes_)
+    classes = np.asarray(rf_model.classes_)
+    if classes.dtype == object:
+        # string labels are stored as a fixed width unicode array so the archive needs no pickle
+        classes = classes.astype(str)
+    for estimator in rf_model.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        is_leaf = tree.children_left == -1
+        node_ids = np.arange(n_nodes)
+
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+        lefts.append(np.where(is_leaf, node_ids, tree.children_left) + offset)
+        rights.append(np.where(is_leaf, node_ids, tree.children_right) + offset)
+
+        # same arithmetic as DecisionTreeClassifier.predict_proba
+        proba = tree.value[:, 0, :n_classes].copy()
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba /= normalizer
+        values.append(proba)
+
+        roots.append(offset)
+        offset += n_nodes
+        max_depth = max(max_depth, tree.max_depth)
+
+    forest = FlatForest(feature=np.concatenate(features).astype(np.intp),
+                        threshold=np.concatenate(thresholds).astype(np.float64),
+                        children_left=np.concatenate(lefts).astype(np.intp),
+                        children_right=np.concatenate(rights).astype(np.intp),
+                        value=np.concatenate(values),
+                        roots=np.array(roots, dtype=np.intp),
+                        classes=classes,
+                        max_depth=max_depth,
+                        n_features=rf_model.n_features_in_ if hasattr(rf_model, 'n_features_in_')
+                        else rf_model.n_features_)
+    logger.info('Flattened %d trees into %d nodes (max depth %d)', forest.n_estimators, offset, max_depth)
+    return forest
@@ -0,0 +1,231 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('metrics')
+
+# upper bounds of the latency buckets: 10 us to about 15 min, each 20% wider than the last, so a quantile read off
+# the buckets is within 10% of the exact one
+BUCKET_BOUNDS = tuple(1e-5 * 1.2 ** i for i in range(101))
+QUANTILES = (0.5, 0.95, 0.99)
+
+HELP = {
+    'churn_stage_seconds': 'Seconds spent in a stage of serving or the pipeline',
+    'churn_stage_records_total': 'Records that went through a stage',
+    'churn_stage_errors_total': 'Calls of a stage that raised',
+    'churn_s3_transfer_bytes_total': 'Bytes moved to or from s3',
+    'churn_http_request_seconds': 'Seconds to handle an HTTP request',
+    'churn_http_requests_total': 'HTTP requests handled, by status code',
+    'churn_pipeline_step_seconds': 'Seconds a pipeline step ran',
+    'churn_write_behind_records_total': 'Records of the write-behind queue, by whether they were written or lost',
+}
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    """Latency distribution in fixed logarithmic buckets; observing a value costs one bisect and two additions."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add one observation."""
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating within the bucket it falls in
+        Args:
+            q (float): quantile between 0 and 1, e.g. 0.95
+
+        Returns:
+            value (float): estimated quantile, within the smallest and largest observation; 0 without observations
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKET_BOUNDS[i - 1] if i > 0 else 0.0
+                upper = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+                value = lower + (upper - lower) * (rank - seen) / n
+                return min(max(value, self.min), self.max)
+            seen += n
+        return self.max
+
+
+class Metrics:
+    """Counters and latency histograms of this process, keyed by metric name and labels.
+
+    Exported in the Prometheus text format by `/metrics` (latencies as summaries with their p50, p95 and p99) and
+    dumped as JSON at the end of every `run.py` step. Every app worker process keeps its own metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[LabelKey, float] = {}
+        self._histograms: Dict[LabelKey, Histogram] = {}
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, object]) -> LabelKey:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Add to a counter
+        Args:
+            name (str): metric name, ending in _total
+            value (float): amount to add
+            **labels: label values of the counter, e.g. stage="validation"
+
+        Returns:
+            None
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """
+        Record a latency
+        Args:
+            name (str): metric name, ending in _seconds
+            seconds (float): observed latency
+            **labels: label values of the histogram, e.g. stage="inference"
+
+        Returns:
+            None
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Record the latency of the enclosed block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, stage: str, records: int = 1) -> Iterator[None]:
+        """
+        Time a stage of serving or the pipeline and count the records that went through it
+        Args:
+            stage (str): stage name, e.g. "validation", "encoding", "inference" or "db_write"
+            records (int): records handled by this call
+
+        Returns:
+            context manager; a call that raises is counted in churn_stage_errors_total
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('churn_stage_errors_total', stage=stage)
+            raise
+        finally:
+            self.observe('churn_stage_seconds', time.perf_counter() - start, stage=stage)
+        self.inc('churn_stage_records_total', records, stage=stage)
+
+    def reset(self) -> None:
+        """Drop all counters and histograms, e.g. between pipeline steps."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def snapshot(self) -> Dict:
+        """
+        Summarize all metrics
+        Returns:
+            snapshot (dict): counters with their values and histograms with count, sum, min, max, p50, p95 and p99
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                summary = {'name': name, 'labels': dict(labels), 'count': histogram.count,
+                           'sum': round(histogram.sum, 6), 'min': round(histogram.min, 6),
+                           'max': round(histogram.max, 6)}
+                summary.update({f'p{round(q * 100)}': round(histogram.quantile(q), 6) for q in QUANTILES})
+                histograms.append(summary)
+        return {'started_at': self.started_at, 'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format
+        Returns:
+            text (str): counters as counters, latency histograms as summaries with their quantiles, sum and count
+        """
+        lines: List[str] = []
+        snapshot = self.snapshot()
+        for kind, entries in (('counter', snapshot['counters']), ('summary', snapshot['histograms'])):
+            names = sorted({entry['name'] for entry in entries})
+            for name in names:
+                if name in HELP:
+                    lines.append(f'# HELP {name} {HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                for entry in (entry for entry in entries if entry['name'] == name):
+                    if kind == 'counter':
+                        lines.append(f'{name}{_labels(entry["labels"])} {entry["value"]}')
+                        continue
+                    for q in QUANTILES:
+                        labels = _labels({**entry['labels'], 'quantile': str(q)})
+                        lines.append(f'{name}{labels} {entry[f"p{round(q * 100)}"]}')
+                    lines.append(f'{name}_sum{_labels(entry["labels"])} {entry["sum"]}')
+                    lines.append(f'{name}_count{_labels(entry["labels"])} {entry["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self, path: str, **extra) -> None:
+        """
+        Write a snapshot of all metrics as json
+        Args:
+            path (str): json file to write
+            **extra: further fields of the dump, e.g. the step name and its status
+
+        Returns:
+            None
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump({**extra, **self.snapshot()}, f, indent=2)
+        logger.info('Metrics written to %s', path)
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{label}="{value}"' for label, value in zip(labels, escaped)) + '}'
+
+
+# metrics of this process, shared by the app, the pipeline and the modules they call
+metrics = Metrics()
@@ -1,17 +1,33 @@
 import logging
+import os
 
-from typing import List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 import pickle
 
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import confusion_matrix, accuracy_score, classification_report
 
-# pylint: disable=locally-disabled, invalid-name
+from src.artifacts import artifact_format
+from src.batching import MicroBatcher
+from src.features import FeatureSchema
+from src.metrics import metrics
+from src.parallel import limit_blas_threads, resolve_n_jobs
+from src.prediction_cache import PredictionCache
+from src.schema import check_columns, enforce_schema, read_csv_with_schema
+
+# scikit-learn and pyarrow are imported by the functions that need them: serving a flat forest needs neither, and
+# importing scikit-learn alone takes longer than the rest of the app's startup
+# pylint: disable=locally-disabled, invalid-name, import-outside-toplevel
+
+if TYPE_CHECKING:
+    from sklearn.ensemble import RandomForestClassifier
 
 logger = logging.getLogger('modeling')
 
+# model of a prediction worker process, set once by `_init_predict_worker` instead of being pickled with every shard
+_worker_model: Dict[str, 'RandomForestClassifier'] = {}
+
 
 def select_features(data: pd.DataFrame, features: List[str]) -> Union[None, pd.DataFrame]:
     """
@@ -62,20 +78,18 @@ def select_target(data: pd.DataFrame, target: str) -> Union[None, pd.DataFrame]:
     raise KeyError(f'{target} is not in the input dataframe.')
 
 
-def train_model(data: pd.DataFrame, used_features: List[str], target: str, test_size: float,
-                random_state: int) -> Tuple:
+def split_data(data: pd.DataFrame, used_features: List[str], target: str, test_size: float,
+               random_state: int) -> Tuple:
     """
-    Perform train test split, train the random forest model on training data, and save train data, test data as well
-    as trained model object
+    Dummy code the features and split them and the target into train and test sets
     Args:
         data (obj: pd.DataFrame): processed dataframe
         used_features (List[str]): features used in the random forest model
         target (str): target column name
         test_size (float): proportion of test data
-        random_state (int): random seed for train test split and random forest model
+        random_state (int): random seed for train test split
 
     Returns:
-        rf (obj: RandomForestClassifier): trained random forest model object
         X_train (obj: pd.DataFrame): train features
         X_test (obj: pd.DataFrame): test features
         y_train (obj: pd.DataFrame): train target
@@ -86,18 +100,48 @@ def train_model(data: pd.DataFrame, used_features: List[str], target: str, test_
     y = select_target(data, target)
 
     # train test split
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    from sklearn.model_selection import train_test_split
+    return train_test_split(X, y, test_size=test_size, random_state=random_state)
+
+
+def train_model(data: pd.DataFrame, used_features: List[str], target: str, test_size: float,
+                random_state: int, model_params: Optional[Dict] = None, n_jobs: Optional[int] = None) -> Tuple:
+    """
+    Perform train test split, train the random forest model on training data, and save train data, test data as well
+    as trained model object
+    Args:
+        data (obj: pd.DataFrame): processed dataframe
+        used_features (List[str]): features used in the random forest model
+        target (str): target column name
+        test_size (float): proportion of test data
+        random_state (int): random seed for train test split and random forest model
+        model_params (dict): random forest hyperparameters, e.g. the best ones found by `tune_model`; they
+            override the default balanced class weights
+        n_jobs (int): cores the trees are fit on; -1 for all of them
+
+    Returns:
+        rf (obj: RandomForestClassifier): trained random forest model object
+        X_train (obj: pd.DataFrame): train features
+        X_test (obj: pd.DataFrame): test features
+        y_train (obj: pd.DataFrame): train target
+        y_test (obj: pd.DataFrame): test target
+    """
+    X_train, X_test, y_train, y_test = split_data(data, used_features, target, test_size, random_state)
 
     # use random forest classifier model
-    rf = RandomForestClassifier(class_weight='balanced', random_state=random_state)
+    from sklearn.ensemble import RandomForestClassifier
+    rf = RandomForestClassifier(**{'class_weight': 'balanced', 'random_state': random_state, **(model_params or {}),
+                                   'n_jobs': n_jobs})
 
     # fit model to train data
     rf.fit(X_train, y_train)
+    # the saved model serves single records in the app, where starting threads costs more than the prediction
+    rf.set_params(n_jobs=None)
 
     return rf, X_train, X_test, y_train, y_test
 
 
-def save_model(model_obj: RandomForestClassifier, model_path: str) -> None:
+def save_model(model_obj: 'RandomForestClassifier', model_path: str) -> None:
     """
     Saves the model to the specified path
     Args:
@@ -107,16 +151,125 @@ def save_model(model_obj: RandomForestClassifier, model_path: str) -> None:
     Returns:
         None
     """
-    # save model
-    with open(model_path, 'wb') as f:
+    # written next to the target and renamed over it, so a worker reloading the model never reads a partial file
+    tmp_path = f'{model_path}.tmp'
+    with open(tmp_path, 'wb') as f:
         pickle.dump(model_obj, f)
+    os.replace(tmp_path, model_path)
     logger.info('Random forest model saved.')
 
 
+def save_table(data: Union[pd.DataFrame, pd.Series], path: str) -> None:
+    """
+    Save a table in the format given by the file extension. Parquet and Feather keep the dtypes (e.g. the boolean
+    dummy columns) that a CSV round trip loses
+    Args:
+        data (obj: pd.DataFrame or pd.Series): table to save; the index is not saved
+        path (str): path ending in .parquet, .feather or .csv
+
+    Returns:
+        None
+    """
+    fmt = artifact_format(path)
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    if fmt == 'parquet':
+        data.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        data.reset_index(drop=True).to_feather(path)
+    else:
+        data.to_csv(path, index=False)
+
+
+def load_table(path: str, columns: Optional[List[str]] = None, dtypes: Optional[Dict] = None) -> pd.DataFrame:
+    """
+    Load a table saved by `save_table`, reading only the requested columns
+    Args:
+        path (str): path ending in .parquet, .feather or .csv
+        columns (List[str]): columns to read; None for all columns
+        dtypes (dict): declared column dtypes (see `src.schema.parse_dtypes`); if given, the table is checked
+            against them and loaded with them
+
+    Returns:
+        data (obj: pd.DataFrame): loaded table
+    """
+    fmt = artifact_format(path)
+    if fmt == 'csv':
+        if dtypes is not None:
+            return read_csv_with_schema(path, dtypes, columns)
+        return pd.read_csv(path, usecols=columns)
+    if fmt == 'parquet':
+        data = pd.read_parquet(path, columns=columns)
+    else:
+        data = pd.read_feather(path, columns=columns)
+    if dtypes is not None:
+        check_columns(list(data.columns), dtypes, columns)
+        data = enforce_schema(data, dtypes)
+    return data
+
+
+class TableWriter:
+    """Writes a table chunk by chunk, in the format given by the file extension, without holding it in memory.
+
+    Parquet chunks become row groups and Feather chunks record batches. Every chunk is cast to the schema of the
+    first one, so a chunk where a text column happens to be all missing still fits.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fmt = artifact_format(path)
+        self.rows = 0
+        self._schema = None
+        self._writer = None
+        self._sink = None
+
+    def write(self, data: pd.DataFrame) -> None:
+        """
+        Append a chunk of rows
+        Args:
+            data (obj: pd.DataFrame): chunk with the same columns as the previous chunks
+
+        Returns:
+            None
+        """
+        if self.fmt == 'csv':
+            data.to_csv(self.path, index=False, mode='w' if self.rows == 0 else 'a', header=self.rows == 0)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(data, schema=self._schema, preserve_index=False)
+            writer = self._writer
+            if writer is None:
+                self._schema = table.schema
+                if self.fmt == 'parquet':
+                    writer = pq.ParquetWriter(self.path, self._schema)
+                else:
+                    self._sink = pa.OSFile(self.path, 'wb')
+                    writer = pa.ipc.new_file(self._sink, self._schema)
+                self._writer = writer
+            writer.write_table(table)
+        self.rows += len(data)
+
+    def close(self) -> None:
+        """Finish the file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def __enter__(self) -> 'TableWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def save_train_test(X_train: pd.DataFrame, X_test: pd.DataFrame, y_train: pd.DataFrame, y_test: pd.DataFrame,
                     X_train_path: str, X_test_path: str, y_train_path: str, y_test_path: str) -> None:
     """
-    Save train and test data to the specified path
+    Save train and test data to the specified path, in the format given by each path's extension
     Args:
         X_train (obj: pd.DataFrame): train features
         X_test (obj: pd.DataFrame): test features
@@ -130,41 +283,131 @@ def save_train_test(X_train: pd.DataFrame, X_test: pd.DataFrame, y_train: pd.Dat
     Returns:
         None
     """
-    X_train.to_csv(X_train_path, index=False)
-    X_test.to_csv(X_test_path, index=False)
-    y_train.to_csv(y_train_path, index=False)
-    y_test.to_csv(y_test_path, index=False)
+    save_table(X_train, X_train_path)
+    save_table(X_test, X_test_path)
+    save_table(y_train, y_train_path)
+    save_table(y_test, y_test_path)
 
 
-def pred_one_record(rf_model: RandomForestClassifier, columns: List[str], record_df: pd.DataFrame) -> int:
+def build_feature_schema(data: pd.DataFrame, used_features: List[str]) -> FeatureSchema:
+    """
+    Capture the column order, categorical levels and dummy columns produced by train_model
+    Args:
+        data (obj: pd.DataFrame): processed dataframe the model is trained on
+        used_features (List[str]): features used in the random forest model
+
+    Returns:
+        schema (obj: FeatureSchema): frozen feature schema for serving
+    """
+    X = select_features(data, used_features)
+    features = list(pd.get_dummies(data=X, drop_first=True).columns)
+    return FeatureSchema.from_training(X, features)
+
+
+def pred_one_record(rf_model: 'RandomForestClassifier', schema: FeatureSchema, record: Dict,
+                    batcher: Optional[MicroBatcher] = None, cache: Optional[PredictionCache] = None,
+                    model_version: Optional[str] = None) -> Union[int, str]:
     """
     Make predictions on a single input record
     Args:
         rf_model (obj: RandomForestClassifier): random forest model object
-        columns (List[str]): list of columns to be used in the prediction
-        record_df (obj: pd.DataFrame): input record
+        schema (obj: FeatureSchema): feature schema saved with the model
+        record (dict): validated input record
+        batcher (obj: MicroBatcher): optional micro-batcher that scores the record with `rf_model` together with
+            concurrent requests; the record is scored directly by `rf_model` if None
+        cache (obj: PredictionCache): optional cache of predictions, consulted before the model is called
+        model_version (str): version of `rf_model`; the prediction is cached under it, so it must be the version
+            of `rf_model` itself, not of whatever model is current when it is scored. Without it, `cache` is not used
 
     Returns:
-        pred (int): prediction if a customer is likely to churn 1: Yes, 0: No
+        pred (Union[int, str]): predicted churn label of the customer
     """
-    record_df = record_df[columns]
-    transformed_record = pd.get_dummies(record_df)
-    pred_class = rf_model.predict(transformed_record)[0]
+    row = schema.encode_record(record)
+    # with the micro-batcher, inference includes the wait for the batch to fill
+    with metrics.stage('inference'):
+        if cache is not None and model_version is not None:
+            score_fn = rf_model.predict_proba if batcher is None else \
+                lambda X: batcher.predict_proba(X, model=rf_model)[np.newaxis]
+            proba = cache.predict_proba(model_version, row, score_fn)[0]
+            return rf_model.classes_[proba.argmax()]
+        if batcher is not None:
+            proba = batcher.predict_proba(row, model=rf_model)
+            return rf_model.classes_[proba.argmax()]
+        pred_class = rf_model.predict(row)[0]
     return pred_class
 
 
-def make_predictions(rf_model: RandomForestClassifier, X_test: pd.DataFrame) -> pd.DataFrame:
+def predict_batch(rf_model: 'RandomForestClassifier', schema: FeatureSchema, record_df: pd.DataFrame,
+                  cache: Optional[PredictionCache] = None, model_version: Optional[str] = None) -> pd.DataFrame:
+    """
+    Make predictions on a batch of input records with a single call into the model
+    Args:
+        rf_model (obj: RandomForestClassifier): random forest model object
+        schema (obj: FeatureSchema): feature schema saved with the model
+        record_df (obj: pd.DataFrame): input records, one row per customer
+        cache (obj: PredictionCache): optional cache of predictions; only the records it misses are scored
+        model_version (str): version of `rf_model`; without it, `cache` is not used
+
+    Returns:
+        pred (obj: pd.DataFrame): predicted churn label and churn probability for every record
+    """
+    features = schema.encode_batch(record_df)
+    with metrics.stage('inference', records=len(features)):
+        if cache is not None and model_version is not None:
+            proba = cache.predict_proba(model_version, features, rf_model.predict_proba)
+        else:
+            proba = rf_model.predict_proba(features)
+    pred_class = rf_model.classes_.take(proba.argmax(axis=1))
+    return pd.DataFrame({'pred_class': pred_class, 'pred_proba': proba[:, -1]}, index=record_df.index)
+
+
+def _init_predict_worker(rf_model: 'RandomForestClassifier', blas_threads: Optional[int]) -> None:
+    limit_blas_threads(blas_threads)
+    # every worker predicts with one thread; the parallelism comes from the processes
+    _worker_model['rf'] = rf_model.set_params(n_jobs=None)
+
+
+def _predict_shard(X_shard: pd.DataFrame) -> np.ndarray:
+    return _worker_model['rf'].predict(X_shard)
+
+
+def _predict(rf_model: 'RandomForestClassifier', X_test: pd.DataFrame, n_jobs: int, shard_rows: int,
+             blas_threads: Optional[int]) -> np.ndarray:
+    if n_jobs > 1 and len(X_test) > shard_rows:
+        shards = [X_test.iloc[start:start + shard_rows] for start in range(0, len(X_test), shard_rows)]
+        logger.info('Predicting %d rows in %d shards across %d processes', len(X_test), len(shards), n_jobs)
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(shards)), initializer=_init_predict_worker,
+                                 initargs=(rf_model, blas_threads)) as executor:
+            ypred_test = np.concatenate(list(executor.map(_predict_shard, shards)))
+    else:
+        n_jobs_saved = rf_model.n_jobs
+        rf_model.set_params(n_jobs=n_jobs)
+        try:
+            ypred_test = rf_model.predict(X_test)
+        finally:
+            rf_model.set_params(n_jobs=n_jobs_saved)
+    return ypred_test
+
+
+def make_predictions(rf_model: 'RandomForestClassifier', X_test: pd.DataFrame, n_jobs: Optional[int] = None,
+                     shard_rows: int = 100000, blas_threads: Optional[int] = 1) -> pd.DataFrame:
     """
-    Make predictions on test set
+    Make predictions on test set. Test sets of more than `shard_rows` rows are split into row shards predicted
+    across a pool of `n_jobs` processes; smaller ones are predicted in this process with the trees spread over
+    `n_jobs` threads
     Args:
         rf_model (obj: RandomForestClassifier): random forest model object
         X_test (obj: pd.DataFrame): test features
+        n_jobs (int): cores to predict on; -1 for all of them
+        shard_rows (int): rows per shard of the process pool
+        blas_threads (int): BLAS and OpenMP threads in every worker process; None leaves the libraries' defaults
 
     Returns:
         pred (obj: pd.DataFrame): dataframe containing predicted churn labels
     """
-    # make predictions
-    ypred_test = rf_model.predict(X_test)
+    n_jobs = resolve_n_jobs(n_jobs)
+    with metrics.stage('inference', records=len(X_test)):
+        ypred_test = _predict(rf_model, X_test, n_jobs, shard_rows, blas_threads)
     pred_df = pd.DataFrame({'pred_class': ypred_test})
     return pred_df
 
@@ -184,6 +427,7 @@ def eval_performance(pred_res: pd.DataFrame, y_test: pd.DataFrame) -> Tuple:
     ypred_test = pred_res['pred_class']
 
     # compute model performance metrics
+    from sklearn.metrics import confusion_matrix, accuracy_score, classification_report
     confusion = confusion_matrix(y_test, ypred_test)
     accuracy = accuracy_score(y_test, ypred_test)
     class_report = classification_report(y_test, ypred_test)
@@ -0,0 +1,47 @@
+import logging
+import os
+from typing import Optional
+
+from threadpoolctl import threadpool_limits
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('parallel')
+
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def resolve_n_jobs(n_jobs: Optional[int]) -> int:
+    """
+    Turn a scikit-learn style n_jobs setting into a number of cores
+    Args:
+        n_jobs (int): number of cores; None or 1 for one, -1 for all of them, -2 for all but one, and so on
+
+    Returns:
+        n_jobs (int): number of cores, at least 1
+    """
+    cpu_count = os.cpu_count() or 1
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, cpu_count + 1 + n_jobs)
+    return n_jobs
+
+
+def limit_blas_threads(blas_threads: Optional[int]) -> None:
+    """
+    Cap the threads of the BLAS and OpenMP libraries loaded in this process, so that n_jobs processes or
+    joblib workers, each starting its own BLAS thread pool, do not oversubscribe the cores.
+    Used directly as the initializer of worker processes.
+    Args:
+        blas_threads (int): threads per process; None leaves the libraries' defaults
+
+    Returns:
+        None
+    """
+    if blas_threads is not None:
+        # libraries loaded later, e.g. in spawned worker processes, read their thread count from the environment
+        for var in BLAS_THREAD_VARS:
+            os.environ[var] = str(blas_threads)
+        threadpool_limits(limits=blas_threads)
+        logger.debug('BLAS and OpenMP libraries limited to %d threads in process %d', blas_threads, os.getpid())
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from src.metrics import metrics
+from src.registry import file_digest
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('pipeline')
+
+
+class Step:
+    """One stage of the model pipeline.
+
+    `run` receives the in-memory state shared by all steps of a run and returns the objects it produced
+    (e.g. the cleaned DataFrame), which are added to that state so downstream steps need not re-read them from
+    disk. A step must still write its `outputs`: they are what later runs compare against to skip the step.
+    """
+
+    def __init__(self, name: str, run: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+                 inputs: Sequence[str] = (), outputs: Sequence[str] = (), config: Any = None,
+                 requires: Sequence[str] = (), always_run: bool = False):
+        """
+        Args:
+            name (str): step name
+            run (Callable): function taking the shared state and returning a dict of produced objects
+            inputs (List[str]): files read by the step
+            outputs (List[str]): files written by the step
+            config (Any): configuration section of the step; changing it invalidates the outputs
+            requires (List[str]): steps that must run before this one
+            always_run (bool): never skip, for steps whose inputs are not local files (e.g. an s3 download)
+        """
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config = config
+        self.requires = list(requires)
+        self.always_run = always_run
+
+
+class Pipeline:
+    """Runs steps in dependency order in one process and skips steps whose outputs are up to date.
+
+    A step is up to date when its fingerprint (a hash of its name, configuration section and the content of its
+    input files) equals the one recorded in the run manifest when it last succeeded, and all its output files
+    still have the content recorded then. File digests are cached in the manifest by size and mtime, so
+    unchanged files are not re-hashed on every run.
+    """
+
+    def __init__(self, steps: List[Step], manifest_path: str, metrics_dir: Optional[str] = None):
+        """
+        Args:
+            steps (List[Step]): pipeline steps
+            manifest_path (str): json file recording the last successful run of every step
+            metrics_dir (str): directory to write the metrics of every step that runs to, as `<step>.json`; None to
+                not write them
+        """
+        self.steps = {step.name: step for step in steps}
+        self.manifest_path = manifest_path
+        self.metrics_dir = metrics_dir
+        self.order = self._topological_order()
+        try:
+            with open(manifest_path, 'r', encoding='utf8') as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.manifest = {}
+        self.manifest.setdefault('steps', {})
+        self.manifest.setdefault('digests', {})
+
+    def _topological_order(self) -> List[str]:
+        order: List[str] = []
+        visiting = set()
+
+        def visit(name: str) -> None:
+            if name in order:
+                return
+            if name not in self.steps:
+                raise ValueError(f'Unknown pipeline step {name}')
+            if name in visiting:
+                raise ValueError(f'Pipeline steps depend on each other in a cycle through {name}')
+            visiting.add(name)
+            for required in self.steps[name].requires:
+                visit(required)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.steps:
+            visit(name)
+        return order
+
+    def _digest(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.manifest['digests'].get(key)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+        digest = file_digest(path)
+        self.manifest['digests'][key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+        return digest
+
+    def fingerprint(self, step: Step) -> str:
+        """
+        Hash everything that determines the outputs of a step
+        Args:
+            step (obj: Step): pipeline step
+
+        Returns:
+            fingerprint (str): sha256 of the step name, its configuration and the content of its inputs; an input
+                that does not exist is hashed as missing, so optional inputs appearing or disappearing count as a change
+        """
+        sha = hashlib.sha256()
+        sha.update(step.name.encode())
+        sha.update(json.dumps(step.config, sort_keys=True, default=str).encode())
+        for path in step.inputs:
+            sha.update(path.encode())
+            sha.update(self._digest(path).encode() if os.path.exists(path) else b'missing')
+        return sha.hexdigest()
+
+    def is_up_to_date(self, step: Step) -> bool:
+        """
+        Check whether a step can be skipped
+        Args:
+            step (obj: Step): pipeline step
+
+        Returns:
+            up_to_date (bool): True if the inputs and configuration are unchanged and the outputs are intact
+        """
+        record = self.manifest['steps'].get(step.name)
+        if step.always_run or record is None or not step.outputs:
+            return False
+        try:
+            if record['fingerprint'] != self.fingerprint(step):
+                return False
+            return all(record['outputs'].get(path) == self._digest(path) for path in step.outputs)
+        except FileNotFoundError:
+            return False
+
+    def _save_manifest(self) -> None:
+        directory = os.path.dirname(self.manifest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def run(self, targets: Optional[Sequence[str]] = None, force: bool = False) -> List[Dict]:
+        """
+        Run the given steps, or every step, in dependency order, handing produced objects between them in memory.
+        The run stops at the first failing step.
+        Args:
+            targets (List[str]): steps to run; None for the whole pipeline
+            force (bool): run steps even if they are up to date
+
+        Returns:
+            timings (List[dict]): name, status ("ran", "skipped" or "failed") and seconds of every step
+        """
+        selected = set(self.order if targets is None else targets)
+        unknown = selected - set(self.steps)
+        if unknown:
+            raise ValueError(f'Unknown pipeline steps {sorted(unknown)}')
+        state: Dict[str, Any] = {}
+        timings: List[Dict] = []
+        started = time.time()
+        for name in [name for name in self.order if name in selected]:
+            step = self.steps[name]
+            start = time.perf_counter()
+            if not force and self.is_up_to_date(step):
+                logger.info('Step %s is up to date, skipped', name)
+                timings.append({'step': name, 'status': 'skipped', 'seconds': round(time.perf_counter() - start, 4)})
+                continue
+            logger.info('Running step %s', name)
+            if self.metrics_dir is not None:
+                metrics.reset()
+            try:
+                produced = step.run(state) or {}
+                # inputs written by an earlier step of this run are hashed here for the first time
+                fingerprint = self.fingerprint(step)
+                outputs = {path: self._digest(path) for path in step.outputs}
+            except Exception:  # pylint: disable=broad-except
+                timings.append({'step': name, 'status': 'failed', 'seconds': round(time.perf_counter() - start, 4)})
+                self.manifest['steps'].pop(name, None)
+                logger.error('Step %s failed, skipping the remaining steps', name)
+                self._dump_metrics(timings[-1])
+                self._record_run(started, timings)
+                raise
+            state.update(produced)
+            self.manifest['steps'][name] = {'fingerprint': fingerprint, 'outputs': outputs,
+                                            'finished_at': time.time()}
+            timings.append({'step': name, 'status': 'ran', 'seconds': round(time.perf_counter() - start, 4)})
+            logger.info('Step %s finished in %.2f s', name, timings[-1]['seconds'])
+            self._dump_metrics(timings[-1])
+            self._save_manifest()
+        self._record_run(started, timings)
+        return timings
+
+    def _dump_metrics(self, timing: Dict) -> None:
+        if self.metrics_dir is None:
+            return
+        metrics.observe('churn_pipeline_step_seconds', timing['seconds'], step=timing['step'])
+        metrics.dump_json(os.path.join(self.metrics_dir, f'{timing["step"]}.json'), **timing)
+
+    def _record_run(self, started: float, timings: List[Dict]) -> None:
+        self.manifest['last_run'] = {'started_at': started,
+                                     'total_seconds': round(time.time() - started, 4),
+                                     'steps': timings}
+        self._save_manifest()
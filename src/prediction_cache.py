@@ -0,0 +1,225 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, List, Optional, Tuple, cast
+
+import numpy as np
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('prediction-cache')
+
+
+class PredictionCache:
+    """LRU cache of class probabilities in front of the model, keyed on encoded feature vectors.
+
+    Entries expire `ttl_seconds` after they were stored, and the least recently used entry is evicted once
+    `max_entries` are held. Every entry belongs to the model version that computed it: the first lookup with a new
+    version (i.e. after the registry loaded a new model) drops all entries of the old one.
+
+    With `store_path`, entries are also written to a SQLite file that all worker processes on the host share, so
+    a vector scored by one worker is a hit in the others. The store is only consulted on a miss in memory.
+    """
+
+    def __init__(self, max_entries: int = 100000, ttl_seconds: float = 3600, store_path: Optional[str] = None,
+                 prune_every: int = 1000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.store_path = store_path
+        self.prune_every = prune_every
+        self._entries: 'OrderedDict[bytes, Tuple[np.ndarray, float]]' = OrderedDict()
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+        self._store: Optional[sqlite3.Connection] = None
+        self._store_pid: Optional[int] = None
+        self._puts = 0
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def keys(X: np.ndarray) -> List[bytes]:
+        """Cache keys of a batch of encoded feature vectors: the raw bytes of each row as float64."""
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        return [row.tobytes() for row in X]
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per process: sqlite connections must not be carried over a fork
+        if self._store is None or self._store_pid != os.getpid():
+            # only called once a store_path is known to be set
+            store_path = cast(str, self.store_path)
+            directory = os.path.dirname(store_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._store = sqlite3.connect(store_path, timeout=5, check_same_thread=False,
+                                          isolation_level=None)
+            # WAL lets workers read while another one writes
+            self._store.execute('PRAGMA journal_mode=WAL')
+            self._store.execute('CREATE TABLE IF NOT EXISTS prediction_cache (model_version TEXT NOT NULL, '
+                                'features BLOB NOT NULL, proba BLOB NOT NULL, expires_at REAL NOT NULL, '
+                                'PRIMARY KEY (model_version, features))')
+            self._store_pid = os.getpid()
+        return self._store
+
+    def _check_version(self, version: str) -> None:
+        if version == self._version:
+            return
+        if self._version is not None:
+            logger.info('Model version changed from %s to %s, dropping %d cached predictions', self._version,
+                        version, len(self._entries))
+            self.invalidations += 1
+            if self.store_path is not None:
+                try:
+                    self._connect().execute('DELETE FROM prediction_cache WHERE model_version != ?', (version,))
+                except sqlite3.OperationalError as e:
+                    logger.warning('Not able to prune the prediction cache store %s: %s', self.store_path, e)
+        self._entries.clear()
+        self._version = version
+
+    def get_many(self, version: str, X: np.ndarray) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        """
+        Look up the cached probabilities of a batch of encoded feature vectors
+        Args:
+            version (str): version of the model the caller would score with
+            X (obj: np.ndarray): encoded features of shape (n_records, n_features)
+
+        Returns:
+            proba (List[np.ndarray]): cached class probabilities per row, None for rows that were not cached
+            missing (List[int]): indices of the rows that were not cached
+        """
+        keys = self.keys(X)
+        found: List[Optional[np.ndarray]] = [None] * len(keys)
+        now = time.time()
+        with self._lock:
+            self._check_version(version)
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self._entries[key]
+                    self.expirations += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[i] = entry[0]
+            self.hits += sum(proba is not None for proba in found)
+            missing = [i for i, proba in enumerate(found) if proba is None]
+            if missing and self.store_path is not None:
+                for i, proba, expires_at in self._store_lookup(version, [keys[i] for i in missing], missing, now):
+                    found[i] = proba
+                    self._remember(keys[i], proba, expires_at)
+                    self.store_hits += 1
+                missing = [i for i in missing if found[i] is None]
+            self.misses += len(missing)
+        return found, missing
+
+    def _store_lookup(self, version: str, keys: List[bytes], rows: List[int],
+                      now: float) -> List[Tuple[int, np.ndarray, float]]:
+        found: List[Tuple[int, np.ndarray, float]] = []
+        try:
+            connection = self._connect()
+            # chunked to stay below SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                chunk = defaultdict(list)
+                for key, row in zip(keys[start:start + 500], rows[start:start + 500]):
+                    chunk[key].append(row)
+                placeholders = ', '.join('?' * len(chunk))
+                for features, proba, expires_at in connection.execute(
+                        f'SELECT features, proba, expires_at FROM prediction_cache WHERE model_version = ? '
+                        f'AND expires_at > ? AND features IN ({placeholders})', (version, now, *chunk)):
+                    found.extend((row, np.frombuffer(proba, dtype=np.float64), expires_at) for row in chunk[features])
+        except sqlite3.OperationalError as e:
+            # the shared store is an optimization: a locked or broken file must not fail the prediction
+            logger.warning('Not able to read the prediction cache store %s: %s', self.store_path, e)
+        return found
+
+    def _remember(self, key: bytes, proba: np.ndarray, expires_at: float) -> None:
+        self._entries[key] = (proba, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put_many(self, version: str, X: np.ndarray, proba: np.ndarray) -> None:
+        """
+        Store the probabilities the model computed for a batch of encoded feature vectors
+        Args:
+            version (str): version of the model that computed them
+            X (obj: np.ndarray): encoded features of shape (n_records, n_features)
+            proba (obj: np.ndarray): class probabilities of shape (n_records, n_classes)
+
+        Returns:
+            None
+        """
+        keys = self.keys(X)
+        proba = np.asarray(proba, dtype=np.float64)
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._check_version(version)
+            for key, row in zip(keys, proba):
+                self._remember(key, row.copy(), expires_at)
+            if self.store_path is not None:
+                self._store_put(version, keys, proba, expires_at)
+
+    def _store_put(self, version: str, keys: List[bytes], proba: np.ndarray, expires_at: float) -> None:
+        connection = self._connect()
+        try:
+            connection.executemany('INSERT OR REPLACE INTO prediction_cache VALUES (?, ?, ?, ?)',
+                                   [(version, key, row.tobytes(), expires_at) for key, row in zip(keys, proba)])
+            self._puts += len(keys)
+            if self._puts >= self.prune_every:
+                self._puts = 0
+                # drop expired entries, then the ones closest to expiry beyond the size cap
+                connection.execute('DELETE FROM prediction_cache WHERE expires_at <= ?', (time.time(),))
+                connection.execute('DELETE FROM prediction_cache WHERE rowid IN (SELECT rowid FROM prediction_cache '
+                                   'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        except sqlite3.OperationalError as e:
+            # the shared store is an optimization: a locked or broken file must not fail the prediction
+            logger.warning('Not able to write to the prediction cache store %s: %s', self.store_path, e)
+
+    def predict_proba(self, version: str, X: np.ndarray,
+                      score_fn: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        Class probabilities of a batch of encoded feature vectors, scoring only the rows that are not cached
+        Args:
+            version (str): version of the model behind `score_fn`
+            X (obj: np.ndarray): encoded features of shape (n_records, n_features)
+            score_fn (Callable): the model's `predict_proba`, or anything computing the same
+
+        Returns:
+            proba (obj: np.ndarray): class probabilities of shape (n_records, n_classes)
+        """
+        found, missing = self.get_many(version, X)
+        if missing:
+            computed = score_fn(X[missing])
+            self.put_many(version, X[missing], computed)
+            for i, row in zip(missing, computed):
+                found[i] = row
+        # every row is now either cached or computed
+        return np.vstack(cast(List[np.ndarray], found))
+
+    def stats(self) -> Dict:
+        """
+        Summarize cache settings and counters
+        Returns:
+            stats (dict): size, hit ratio, evictions, expirations and invalidations
+        """
+        lookups = self.hits + self.store_hits + self.misses
+        return {'model_version': self._version,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'store_path': self.store_path,
+                'hits': self.hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.store_hits) / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations}
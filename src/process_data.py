@@ -1,12 +1,24 @@
 import logging
-from typing import List
+import math
+import resource
+import time
+import tracemalloc
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from src.metrics import metrics
+from src.modeling import TableWriter
+from src.schema import enforce_schema, iter_csv_with_schema
+
 # pylint: disable=locally-disabled, invalid-name
 
 logger = logging.getLogger('process-data')
 
+# largest value the Integer columns of the churn table hold on every supported database (a signed 32-bit MySQL INT)
+MAX_INT_VALUE = 2 ** 31 - 1
+
 
 def clean_data(data: pd.DataFrame, target: str) -> pd.DataFrame:
     """
@@ -27,9 +39,107 @@ def clean_data(data: pd.DataFrame, target: str) -> pd.DataFrame:
     return data
 
 
+def compact_dtypes(data: pd.DataFrame) -> Dict[str, str]:
+    """
+    Pick fixed-width compact dtypes for the numeric columns of a dataframe
+    Args:
+        data (obj: pd.DataFrame): dataframe, e.g. the first chunk of a file
+
+    Returns:
+        dtypes (dict): int32 for integer columns and float32 for float columns
+    """
+    dtypes = {}
+    for col in data.columns:
+        if pd.api.types.is_integer_dtype(data[col]):
+            dtypes[col] = 'int32'
+        elif pd.api.types.is_float_dtype(data[col]):
+            dtypes[col] = 'float32'
+    return dtypes
+
+
+def iter_clean_chunks(raw_data_path: str, target: str, chunksize: int, columns: Optional[List[str]] = None,
+                      raw_dtypes: Optional[Dict] = None,
+                      cleaned_dtypes: Optional[Dict] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read the raw data in chunks and yield each chunk cleaned, projected and downcast
+    Args:
+        raw_data_path (str): path to the raw csv
+        target (str): target column name
+        chunksize (int): rows per chunk
+        columns (List[str]): columns to keep; None keeps all columns
+        raw_dtypes (dict): declared dtypes of the raw data; None downcasts to the dtypes picked for the first chunk
+        cleaned_dtypes (dict): declared dtypes of the cleaned data, used with `raw_dtypes`
+
+    Returns:
+        chunks (Iterator[pd.DataFrame]): cleaned chunks, all with the same dtypes
+    """
+    if raw_dtypes is not None:
+        for chunk in iter_csv_with_schema(raw_data_path, raw_dtypes, chunksize, columns):
+            yield enforce_schema(clean_data(chunk, target), cleaned_dtypes or {})
+        return
+    dtypes = None
+    for chunk in pd.read_csv(raw_data_path, chunksize=chunksize, usecols=columns):
+        chunk = clean_data(chunk, target)
+        if dtypes is None:
+            dtypes = compact_dtypes(chunk)
+        yield chunk.astype(dtypes)
+
+
+def clean_data_streaming(raw_data_path: str, output_paths: List[str], target: str, chunksize: int,
+                         columns: Optional[List[str]] = None, profile_memory: bool = True,
+                         raw_dtypes: Optional[Dict] = None, cleaned_dtypes: Optional[Dict] = None) -> Dict:
+    """
+    Clean a raw file of any size with bounded memory: chunks flow from the csv reader through cleaning into
+    incremental writers, so at most one chunk is held at a time
+    Args:
+        raw_data_path (str): path to the raw csv
+        output_paths (List[str]): paths to write the cleaned data to, each in the format of its extension
+        target (str): target column name
+        chunksize (int): rows per chunk
+        columns (List[str]): columns to keep; None keeps all columns
+        profile_memory (bool): trace allocations and log the memory used per chunk and at peak
+        raw_dtypes (dict): declared dtypes of the raw data
+        cleaned_dtypes (dict): declared dtypes of the cleaned data
+
+    Returns:
+        profile (dict): rows and chunks processed, seconds, peak traced memory and peak RSS in MB
+    """
+    if profile_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    writers = [TableWriter(path) for path in output_paths]
+    n_chunks = 0
+    try:
+        for chunk in iter_clean_chunks(raw_data_path, target, chunksize, columns, raw_dtypes, cleaned_dtypes):
+            for writer in writers:
+                writer.write(chunk)
+            n_chunks += 1
+            if profile_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                logger.debug('Chunk %d: %d rows, traced memory %.1f MB (peak %.1f MB)', n_chunks, len(chunk),
+                             current / 2 ** 20, peak / 2 ** 20)
+    finally:
+        for writer in writers:
+            writer.close()
+        peak = tracemalloc.get_traced_memory()[1] if profile_memory else 0
+        if profile_memory:
+            tracemalloc.stop()
+    profile = {'rows': writers[0].rows if writers else 0,
+               'chunks': n_chunks,
+               'seconds': round(time.perf_counter() - start, 3),
+               'peak_traced_mb': round(peak / 2 ** 20, 1),
+               # ru_maxrss is in kB on Linux
+               'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    logger.info('Cleaned %d rows in %d chunks of %d in %.1f s; peak traced memory %.1f MB, peak RSS %.1f MB',
+                profile['rows'], n_chunks, chunksize, profile['seconds'], profile['peak_traced_mb'],
+                profile['peak_rss_mb'])
+    return profile
+
+
 def validate_input(data: pd.DataFrame, int_cols: List[str], numeric_cols: List[str]) -> pd.DataFrame:
     """
-    Validate user input data
+    Validate user input data, either a single record or a batch of records, rejecting the whole input if any
+    record is invalid (see `validate_batch` to keep the valid records instead)
     Args:
         data (obj: pd.DataFrame): raw dataframe containing user input
         int_cols (List[str]): list of integer columns
@@ -38,26 +148,115 @@ def validate_input(data: pd.DataFrame, int_cols: List[str], numeric_cols: List[s
     Returns:
         data (obj: pd.DataFrame): validated user input data
     """
+    valid, invalid, errors = validate_batch(data, int_cols, numeric_cols)
+    if invalid.any():
+        logger.error('Error: %s', errors.iloc[0])
+        raise ValueError(errors.iloc[0])
+    return valid
 
-    for col in data.columns:
-        if col in int_cols:
-            try:
-                data[col] = data[col].astype(int)
-            except ValueError:
-                logger.error('Error: %s must be an integer', col)
-                raise ValueError(f'{col} must be an integer')
-            else:
-                if data[col].item() < 0:
-                    logger.error('Error: %s must be greater than or equal to 0', col)
-                    raise ValueError(f'{col} must be greater than or equal to 0')
-        elif col in numeric_cols:
-            try:
-                data[col] = data[col].astype(float)
-            except ValueError:
-                logger.error('Error: %s must be numeric', col)
-                raise ValueError(f'{col} must be numeric')
+
+def validate_batch(data: pd.DataFrame, int_cols: List[str], numeric_cols: List[str],
+                   categories: Optional[Dict[str, List[str]]] = None) -> Tuple[pd.DataFrame, np.ndarray, pd.Series]:
+    """
+    Validate a batch of records column by column without raising, so callers can reject the invalid records and
+    keep the others. A record is invalid if a value of an integer column is not a whole number or larger than
+    MAX_INT_VALUE, a value of a numeric column is not a finite number, either is negative or a boolean, or a
+    categorical value is not one of the allowed levels.
+    Args:
+        data (obj: pd.DataFrame): raw dataframe containing user input
+        int_cols (List[str]): list of integer columns
+        numeric_cols (List[str]): list of numeric columns
+        categories (dict): allowed levels of categorical columns, e.g. `FeatureSchema.categories`
+
+    Returns:
+        valid (obj: pd.DataFrame): the valid records, with their original index, integer columns as int64 and
+            numeric columns as float64
+        invalid (obj: np.ndarray): boolean mask of the invalid records, one entry per input record
+        errors (obj: pd.Series): "; " separated messages of the invalid records, indexed like `data`
+    """
+    with metrics.stage('validation', records=len(data)):
+        categories = categories or {}
+        messages = np.full(len(data), '', dtype=object)
+        converted = {}
+
+        def reject(mask: np.ndarray, message: str) -> None:
+            if mask.any():
+                messages[mask] += f'{message}; '
+
+        for col in data.columns:
+            if col in int_cols or col in numeric_cols:
+                values = data[col]
+                # True and False would pass as 1 and 0, which validate_record rejects as well
+                if pd.api.types.is_bool_dtype(values):
+                    values = pd.Series(np.nan, index=values.index)
+                elif not pd.api.types.is_numeric_dtype(values):
+                    values = values.mask(np.array([isinstance(value, (bool, np.bool_)) for value in values],
+                                                  dtype=bool))
+                    try:
+                        values = values.astype(np.float64)
+                    except (TypeError, ValueError):
+                        # the slower element-wise parse only for columns holding something that is not a number
+                        values = pd.to_numeric(values, errors='coerce')
+                numbers = values.to_numpy(dtype=np.float64, na_value=np.nan)
+                not_number = ~np.isfinite(numbers)
+                if col in int_cols:
+                    reject(not_number | (np.floor(numbers) != numbers), f'{col} must be an integer')
+                    reject(numbers > MAX_INT_VALUE, f'{col} must be at most {MAX_INT_VALUE}')
+                else:
+                    reject(not_number, f'{col} must be numeric')
+                # NaN compares False, so values rejected above are not reported twice
+                reject(numbers < 0, f'{col} must be greater than or equal to 0')
+                converted[col] = numbers
+            elif col in categories:
+                reject(~data[col].isin(categories[col]).to_numpy(), f'{col} must be one of {categories[col]}')
+
+        invalid = messages != ''
+        keep = ~invalid
+        valid = data.loc[keep].assign(**{col: numbers[keep].astype(np.int64) if col in int_cols else numbers[keep]
+                                         for col, numbers in converted.items()})
+        errors = pd.Series([message[:-2] for message in messages[invalid]], index=data.index[invalid], dtype=object)
+    return valid, invalid, errors
+
+
+def validate_record(record: Dict, int_cols: List[str], numeric_cols: List[str]) -> Dict:
+    """
+    Validate a single user input record without building a dataframe
+    Args:
+        record (dict): raw user input, mapping column name to value
+        int_cols (List[str]): list of integer columns
+        numeric_cols (List[str]): list of numeric columns
+
+    Returns:
+        record (dict): validated user input with integer and numeric values converted
+    """
+    with metrics.stage('validation'):
+        valid_record = dict(record)
+        for col, value in record.items():
+            if col in int_cols:
+                try:
+                    if isinstance(value, (bool, np.bool_)):
+                        # int() would take True and False as 1 and 0
+                        raise ValueError(f'{value!r} is not a number')
+                    valid_record[col] = int(value)
+                except (ValueError, OverflowError) as err:
+                    logger.error('Error: %s must be an integer', col)
+                    raise ValueError(f'{col} must be an integer') from err
+                # a larger value would overflow the database column and fail the insert
+                if valid_record[col] > MAX_INT_VALUE:
+                    logger.error('Error: %s must be at most %d', col, MAX_INT_VALUE)
+                    raise ValueError(f'{col} must be at most {MAX_INT_VALUE}')
+            elif col in numeric_cols:
+                try:
+                    valid_record[col] = math.nan if isinstance(value, (bool, np.bool_)) else float(value)
+                except ValueError:
+                    valid_record[col] = math.nan
+                # float() parses "nan" and "inf", which validate_batch rejects as well
+                if not math.isfinite(valid_record[col]):
+                    logger.error('Error: %s must be numeric', col)
+                    raise ValueError(f'{col} must be numeric')
             else:
-                if data[col].item() < 0:
-                    logger.error('Error: %s must be greater than or equal to 0', col)
-                    raise ValueError(f'{col} must be greater than or equal to 0')
-    return data
+                continue
+            if valid_record[col] < 0:
+                logger.error('Error: %s must be greater than or equal to 0', col)
+                raise ValueError(f'{col} must be greater than or equal to 0')
+        return valid_record
@@ -0,0 +1,299 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+import yaml
+
+from src.features import FeatureSchema
+from src.forest import FlatForest, forest_digest
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('registry')
+
+
+def load_pickle(path: str) -> Any:
+    """
+    Load a pickled object from the specified path
+    Args:
+        path (str): path to the pickle file
+
+    Returns:
+        obj (Any): unpickled object
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_model(path: str) -> Any:
+    """
+    Load a trained model, either a flattened forest (memory-mapped .forest or .npz) or a pickled model object
+    Args:
+        path (str): path to the model artifact
+
+    Returns:
+        model (Any): object exposing `predict`, `predict_proba` and `classes_`
+    """
+    if path.endswith(('.forest', '.npz')):
+        return FlatForest.load(path)
+    return load_pickle(path)
+
+
+def load_model_with_schema(model_path: str, schema_path: str) -> Tuple[Any, FeatureSchema]:
+    """
+    Load a trained model together with the feature schema it was trained with, checking that the two belong together
+    Args:
+        model_path (str): path to the model artifact
+        schema_path (str): path to the feature schema
+
+    Returns:
+        model (Any): object exposing `predict`, `predict_proba` and `classes_`
+        schema (obj: FeatureSchema): feature schema of the model
+
+    Raises:
+        ValueError: if the schema encodes another number of features, or other feature names, than the model
+            was fit on, e.g. because only one of the two files was rewritten yet
+    """
+    model = load_model(model_path)
+    schema = FeatureSchema.load(schema_path)
+    n_features = getattr(model, 'n_features', getattr(model, 'n_features_in_', None))
+    if n_features is not None and n_features != len(schema.features):
+        raise ValueError(f'{schema_path} has {len(schema.features)} features, {model_path} {n_features}')
+    names = getattr(model, 'feature_names_in_', None)
+    if names is not None and list(names) != schema.features:
+        raise ValueError(f'{schema_path} does not list the features {model_path} was fit on')
+    return model, schema
+
+
+def load_yaml(path: str) -> Dict:
+    """
+    Load a yaml configuration file from the specified path
+    Args:
+        path (str): path to the yaml file
+
+    Returns:
+        config (dict): parsed configuration
+    """
+    with open(path, 'r', encoding='utf8') as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def file_digest(path: str) -> str:
+    """
+    Compute the sha256 content hash of a file
+    Args:
+        path (str): path to the file
+
+    Returns:
+        digest (str): hex digest of the file content
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def content_digest(path: str) -> str:
+    """
+    Compute the content hash of an artifact file. A forest file is hashed by its header, which holds the sha256 of
+    its node arrays, since loading it checks the arrays against that hash anyway; other files are hashed in full
+    Args:
+        path (str): path to the file
+
+    Returns:
+        digest (str): hex digest of the file content
+    """
+    if path.endswith('.forest'):
+        return forest_digest(path)
+    return file_digest(path)
+
+
+class Artifact:
+    """A file-backed object that is loaded once per process and hot-reloaded when the file changes.
+
+    The file is stat-ed at most once every `check_interval` seconds. When its mtime or size changed, the
+    file is re-hashed (see `content_digest`) and, if the content differs, loaded again and swapped in atomically:
+    readers always see either the old or the new object, never a partially loaded one.
+
+    An object built from several files, e.g. a model and its feature schema, lists the others as `companions`:
+    they are passed to the loader after `path`, a change to any of them reloads the object, and its version is
+    the hash of all of them. If a reload fails, e.g. on a half-written file, the loaded object keeps being served
+    and the reload is tried again at the next check.
+    """
+
+    def __init__(self, path: str, loader: Callable[..., Any], check_interval: float = 1.0,
+                 companions: Sequence[str] = ()):
+        self.path = path
+        self.companions = list(companions)
+        self.loader = loader
+        self.check_interval = check_interval
+        # (object, content digest, (mtime_ns, size) of every file) swapped as one reference
+        self._current: Optional[Tuple[Any, str, Tuple[Tuple[int, int], ...]]] = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.last_load_seconds = 0.0
+        self.total_load_seconds = 0.0
+        self.loaded_at: Optional[float] = None
+
+    def _stat(self) -> Tuple[Tuple[int, int], ...]:
+        stats = [os.stat(path) for path in [self.path, *self.companions]]
+        return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+
+    def _digest(self) -> str:
+        if not self.companions:
+            return content_digest(self.path)
+        return hashlib.sha256(''.join(content_digest(path) for path in [self.path, *self.companions]).encode()) \
+            .hexdigest()
+
+    def _load(self, stat: Tuple[Tuple[int, int], ...]) -> None:
+        digest = self._digest()
+        if self._current is not None and self._current[1] == digest:
+            # file was touched or rewritten with identical content; keep the loaded object
+            self._current = (self._current[0], digest, stat)
+            return
+        start = time.perf_counter()
+        obj = self.loader(self.path, *self.companions)
+        elapsed = time.perf_counter() - start
+        if self._current is not None:
+            self.reloads += 1
+            logger.info('Reloaded %s (version %s -> %s)', self.path, self._current[1][:12], digest[:12])
+        else:
+            logger.info('Loaded %s (version %s) in %.1f ms', self.path, digest[:12], elapsed * 1000)
+        self.misses += 1
+        self.last_load_seconds = elapsed
+        self.total_load_seconds += elapsed
+        self.loaded_at = time.time()
+        self._current = (obj, digest, stat)
+
+    def _refresh(self) -> None:
+        now = time.monotonic()
+        if self._current is not None and now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            if self._current is not None and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            try:
+                stat = self._stat()
+            except FileNotFoundError:
+                if self._current is None:
+                    raise
+                logger.warning('%s disappeared, keep serving version %s', self.path, self._current[1][:12])
+                return
+            if self._current is None or self._current[2] != stat:
+                try:
+                    self._load(stat)
+                except Exception as e:  # pylint: disable=broad-except
+                    if self._current is None:
+                        raise
+                    logger.warning('Reloading %s failed, keep serving version %s: %s', self.path,
+                                   self._current[1][:12], e)
+
+    def get(self) -> Any:
+        """
+        Return the loaded object, loading or reloading it from disk if needed
+        Returns:
+            obj (Any): the loaded object
+
+        Raises:
+            FileNotFoundError: if the file does not exist and nothing was loaded before
+        """
+        return self.get_versioned()[0]
+
+    def get_versioned(self) -> Tuple[Any, str]:
+        """
+        Return the loaded object together with its version, both from the same load, so results computed with the
+        object can be tagged with the right version even while a reload swaps it
+        Returns:
+            obj (Any): the loaded object
+            version (str): short content hash of the file the object was loaded from
+
+        Raises:
+            FileNotFoundError: if the file does not exist and nothing was loaded before
+        """
+        misses = self.misses
+        self._refresh()
+        if self.misses == misses:
+            self.hits += 1
+        current = self._current
+        if current is None:
+            # _refresh raises when there is nothing to load
+            raise FileNotFoundError(self.path)
+        return current[0], current[1][:12]
+
+    @property
+    def version(self) -> Optional[str]:
+        """Short content hash of the currently loaded file, None if nothing is loaded yet."""
+        current = self._current
+        return current[1][:12] if current is not None else None
+
+    def stats(self) -> Dict:
+        """
+        Summarize load timings and cache counters
+        Returns:
+            stats (dict): path, version, hit/miss/reload counters and load timings
+        """
+        return {'path': self.path,
+                'companions': self.companions,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'last_load_ms': round(self.last_load_seconds * 1000, 3),
+                'total_load_ms': round(self.total_load_seconds * 1000, 3),
+                'loaded_at': self.loaded_at}
+
+
+class ModelRegistry:
+    """Holds the trained model, its feature schema and the pipeline configuration for the lifetime of a
+    worker process.
+
+    The model and its feature schema are one artifact, loaded and swapped together, so a request never encodes
+    records with the schema of one model and scores them with another.
+    """
+
+    def __init__(self, model_path: str, config_path: str, schema_path: str, check_interval: float = 1.0):
+        self.model_artifact = Artifact(model_path, load_model_with_schema, check_interval, companions=[schema_path])
+        self.config_artifact = Artifact(config_path, load_yaml, check_interval)
+
+    @property
+    def model(self) -> Any:
+        """Active trained model object."""
+        return self.model_artifact.get()[0]
+
+    @property
+    def config(self) -> Dict:
+        """Active pipeline configuration."""
+        return self.config_artifact.get()
+
+    @property
+    def schema(self) -> FeatureSchema:
+        """Feature schema saved alongside the active model."""
+        return self.model_artifact.get()[1]
+
+    @property
+    def version(self) -> Optional[str]:
+        """Version (short content hash) of the active model and its feature schema."""
+        return self.model_artifact.version
+
+    def versioned_model(self) -> Tuple[Any, FeatureSchema, str]:
+        """Active trained model object, its feature schema and their version, all from the same load."""
+        (model, schema), version = self.model_artifact.get_versioned()
+        return model, schema, version
+
+    def stats(self) -> Dict:
+        """
+        Summarize the registry state
+        Returns:
+            stats (dict): statistics of the model and configuration artifacts
+        """
+        return {'model': self.model_artifact.stats(),
+                'config': self.config_artifact.stats()}
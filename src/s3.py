@@ -1,12 +1,28 @@
+import hashlib
+import json
 import logging
+import os
 import re
+import threading
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from src.metrics import metrics
 
 logger = logging.getLogger('s3-interaction')
 
+MB = 1024 * 1024
+MANIFEST_FILENAME = '.s3_manifest.json'
+
+_clients: typing.Dict[int, typing.Any] = {}
+_client_pid = None
+_client_lock = threading.Lock()
+
 
 def parse_s3(s3path: str) -> typing.Tuple[str, str]:
     """
@@ -17,59 +33,304 @@ def parse_s3(s3path: str) -> typing.Tuple[str, str]:
     Returns:
         s3bucket (str): bucket name
         s3_path (str): file path
+
+    Raises:
+        ValueError: if the path is not of the form s3://bucket/key
     """
-    regex = r"s3://([\w._-]+)/([\w./_-]+)"
+    regex = r"^s3://([^/]+)/(.*)$"
 
     m = re.match(regex, s3path)
+    if m is None:
+        raise ValueError(f'{s3path} is not an s3 path of the form s3://bucket/key')
     s3bucket = m.group(1)
     s3path = m.group(2)
 
     return s3bucket, s3path
 
 
-def upload_file_to_s3(local_path: str, s3path: str) -> None:
+def get_s3_client(max_pool_connections: int = 32):
     """
-    Upload raw data to s3
+    Return the s3 client shared by all transfers of this process with the same pool size, creating it on first use
     Args:
-        local_path (str): local path to raw data
-        s3path (str): s3 path
+        max_pool_connections (int): size of the client's HTTP connection pool, at least the transfer concurrency
 
     Returns:
-        None
+        client (obj: botocore.client.S3): s3 client
     """
-    s3bucket, s3_just_path = parse_s3(s3path)
+    global _client_pid  # pylint: disable=global-statement
+    # clients are thread safe but must not be shared with forked processes
+    client = _clients.get(max_pool_connections) if _client_pid == os.getpid() else None
+    if client is None:
+        with _client_lock:
+            if _client_pid != os.getpid():
+                _clients.clear()
+                _client_pid = os.getpid()
+            client = _clients.get(max_pool_connections)
+            if client is None:
+                config = Config(max_pool_connections=max_pool_connections)
+                client = boto3.session.Session().client('s3', config=config)
+                _clients[max_pool_connections] = client
+    return client
+
+
+def reset_s3_client() -> None:
+    """Drop the shared s3 clients, e.g. after credentials or the endpoint changed."""
+    with _client_lock:
+        _clients.clear()
+
+
+def transfer_config(chunk_size_mb: int = 8, max_concurrency: int = 10) -> TransferConfig:
+    """
+    Build the multipart transfer settings
+    Args:
+        chunk_size_mb (int): part size in MB; files larger than one part are transferred in parts (S3 minimum is 5)
+        max_concurrency (int): number of threads transferring parts of one file
+
+    Returns:
+        config (obj: TransferConfig): boto3 transfer configuration
+    """
+    return TransferConfig(multipart_threshold=chunk_size_mb * MB, multipart_chunksize=chunk_size_mb * MB,
+                          max_concurrency=max_concurrency, use_threads=True)
+
+
+def local_etag(local_path: str, chunk_size: int) -> str:
+    """
+    Compute the ETag S3 assigns to a file uploaded with the given part size
+    Args:
+        local_path (str): path to the local file
+        chunk_size (int): multipart threshold and part size in bytes
+
+    Returns:
+        etag (str): md5 of the file, or md5 of the part md5s suffixed with the part count for multipart uploads
+    """
+    digests = []
+    with open(local_path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digests.append(hashlib.md5(block).digest())
+    if os.path.getsize(local_path) <= chunk_size:
+        return digests[0].hex() if digests else hashlib.md5(b'').hexdigest()
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+
+class TransferCache:
+    """Manifest of the ETag each local file had when it was last transferred.
+
+    Entries are tied to the local file's size and mtime, so a file changed since its last transfer never
+    matches. A matching entry lets a transfer be skipped from a single HEAD request without hashing the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    @staticmethod
+    def _stat(local_path: str) -> typing.Tuple[int, int]:
+        stat = os.stat(local_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, local_path: str, s3path: str) -> typing.Optional[str]:
+        """
+        Return the cached ETag of a local file if it did not change since it was recorded
+        Args:
+            local_path (str): path to the local file
+            s3path (str): s3 path the file was transferred to or from
+
+        Returns:
+            etag (str): cached ETag, None if there is no matching entry
+        """
+        entry = self.entries.get(os.path.abspath(local_path))
+        if entry is None or entry['s3path'] != s3path or not os.path.exists(local_path):
+            return None
+        if (entry['size'], entry['mtime_ns']) != self._stat(local_path):
+            return None
+        return entry['etag']
+
+    def record(self, local_path: str, s3path: str, etag: str) -> None:
+        """
+        Remember the ETag of a local file that was just transferred
+        Args:
+            local_path (str): path to the local file
+            s3path (str): s3 path the file was transferred to or from
+            etag (str): ETag of the s3 object
+
+        Returns:
+            None
+        """
+        size, mtime_ns = self._stat(local_path)
+        with self._lock:
+            self.entries[os.path.abspath(local_path)] = {'s3path': s3path, 'etag': etag, 'size': size,
+                                                         'mtime_ns': mtime_ns}
+
+    def save(self) -> None:
+        """Write the manifest atomically."""
+        with self._lock:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
 
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(s3bucket)
 
+def _remote_object(client, s3bucket: str, key: str) -> typing.Optional[typing.Tuple[str, int]]:
     try:
-        bucket.upload_file(local_path, s3_just_path)
+        head = client.head_object(Bucket=s3bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return head['ETag'].strip('"'), head['ContentLength']
+
+
+def _unchanged(local_path: str, s3path: str, remote: typing.Optional[typing.Tuple[str, int]],
+               cache: TransferCache, config: TransferConfig) -> bool:
+    if remote is None or not os.path.exists(local_path):
+        return False
+    etag, size = remote
+    if os.path.getsize(local_path) != size:
+        return False
+    if cache.lookup(local_path, s3path) == etag:
+        return True
+    # not transferred by us (or touched since): compare content, which only matches same-part-size uploads
+    if local_etag(local_path, config.multipart_chunksize) == etag:
+        cache.record(local_path, s3path, etag)
+        return True
+    return False
+
+
+def _transfer(direction: str, local_path: str, s3bucket: str, key: str, cache: TransferCache,
+              config: TransferConfig, force: bool) -> bool:
+    s3path = f's3://{s3bucket}/{key}'
+    client = get_s3_client(max(32, config.max_concurrency))
+    remote = _remote_object(client, s3bucket, key)
+    if not force and _unchanged(local_path, s3path, remote, cache, config):
+        logger.info('%s is unchanged since the last transfer, skipped', s3path)
+        return False
+    if direction == 'upload':
+        with metrics.stage('s3_upload'):
+            client.upload_file(local_path, s3bucket, key, Config=config)
+        remote = _remote_object(client, s3bucket, key)
+        if remote is None:
+            raise FileNotFoundError(f'{s3path} does not exist after the upload')
+        logger.info('Data uploaded from %s to %s', local_path, s3path)
+    else:
+        if remote is None:
+            raise FileNotFoundError(f'{s3path} does not exist')
+        if os.path.dirname(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with metrics.stage('s3_download'):
+            client.download_file(s3bucket, key, local_path, Config=config)
+        logger.info('Data downloaded from %s to %s', s3path, local_path)
+    metrics.inc('churn_s3_transfer_bytes_total', os.path.getsize(local_path), direction=direction)
+    cache.record(local_path, s3path, remote[0])
+    return True
+
+
+def _default_cache(local_path: str) -> TransferCache:
+    return TransferCache(os.path.join(os.path.dirname(os.path.abspath(local_path)), MANIFEST_FILENAME))
+
+
+def upload_file_to_s3(local_path: str, s3path: str, chunk_size_mb: int = 8, max_concurrency: int = 10,
+                      force: bool = False) -> bool:
+    """
+    Upload raw data to s3, skipping the upload if the object already holds the same content
+    Args:
+        local_path (str): local path to raw data
+        s3path (str): s3 path
+        chunk_size_mb (int): multipart part size in MB
+        max_concurrency (int): number of threads uploading parts
+        force (bool): upload even if the object is unchanged
+
+    Returns:
+        uploaded (bool): whether the file was uploaded
+    """
+    cache = _default_cache(local_path)
+    try:
+        uploaded = _transfer('upload', local_path, *parse_s3(s3path), cache,
+                             transfer_config(chunk_size_mb, max_concurrency), force)
     except botocore.exceptions.NoCredentialsError:
         logger.error('Please provide AWS credentials via AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY env variables.')
+        return False
     except FileNotFoundError:
         logger.error('Please check if your local path contains the data you want to upload.')
-    else:
-        logger.info('Data uploaded from %s to %s', local_path, s3path)
+        return False
+    cache.save()
+    return uploaded
 
 
-def download_file_from_s3(local_path: str, s3path: str) -> None:
+def download_file_from_s3(local_path: str, s3path: str, chunk_size_mb: int = 8, max_concurrency: int = 10,
+                          force: bool = False) -> bool:
     """
-    Download data from s3 and save to local path
+    Download data from s3 and save to local path, skipping the download if the local copy is up to date
     Args:
         local_path (str): local path to save data
         s3path (str): s3 path
+        chunk_size_mb (int): multipart part size in MB
+        max_concurrency (int): number of threads downloading parts
+        force (bool): download even if the local copy is unchanged
 
     Returns:
-        None
+        downloaded (bool): whether the file was downloaded
     """
-    s3bucket, s3_just_path = parse_s3(s3path)
-
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(s3bucket)
-
+    cache = _default_cache(local_path)
     try:
-        bucket.download_file(s3_just_path, local_path)
+        downloaded = _transfer('download', local_path, *parse_s3(s3path), cache,
+                               transfer_config(chunk_size_mb, max_concurrency), force)
     except botocore.exceptions.NoCredentialsError:
         logger.error('Please provide AWS credentials via AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY env variables.')
+        return False
+    cache.save()
+    return downloaded
+
+
+def sync_prefix(local_dir: str, s3prefix: str, direction: str = 'download', chunk_size_mb: int = 8,
+                max_concurrency: int = 10, max_workers: int = 8, force: bool = False) -> typing.Dict[str, int]:
+    """
+    Mirror every object under an s3 prefix into a local directory, or every local file up to the prefix.
+    Files are transferred in parallel and unchanged files are skipped.
+    Args:
+        local_dir (str): local directory
+        s3prefix (str): s3 path of the prefix, e.g. s3://bucket/raw/
+        direction (str): "download" (s3 to local) or "upload" (local to s3)
+        chunk_size_mb (int): multipart part size in MB
+        max_concurrency (int): number of threads transferring parts of one file
+        max_workers (int): number of files transferred at the same time
+        force (bool): transfer even unchanged files
+
+    Returns:
+        counts (dict): number of files transferred and skipped
+    """
+    if direction not in ('download', 'upload'):
+        raise ValueError('direction must be "download" or "upload"')
+    s3bucket, prefix = parse_s3(s3prefix)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    if direction == 'download':
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        keys = [obj['Key'] for page in paginator.paginate(Bucket=s3bucket, Prefix=prefix)
+                for obj in page.get('Contents', []) if not obj['Key'].endswith('/')]
+        relative_paths = [key[len(prefix):] for key in keys]
     else:
-        logger.info('Data downloaded from %s to %s', s3path, local_path)
\ No newline at end of file
+        relative_paths = [os.path.relpath(os.path.join(root, name), local_dir)
+                          for root, _, names in os.walk(local_dir) for name in names if name != MANIFEST_FILENAME]
+    os.makedirs(local_dir, exist_ok=True)
+    cache = TransferCache(os.path.join(local_dir, MANIFEST_FILENAME))
+    config = transfer_config(chunk_size_mb, max_concurrency)
+
+    def transfer(relative_path: str) -> bool:
+        # the key goes to the transfer as listed, it is not parsed out of an s3:// path again
+        key = prefix + relative_path.replace(os.sep, '/')
+        return _transfer(direction, os.path.join(local_dir, relative_path), s3bucket, key, cache, config, force)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            transferred = sum(executor.map(transfer, relative_paths))
+    finally:
+        cache.save()
+    counts = {'transferred': transferred, 'skipped': len(relative_paths) - transferred}
+    logger.info('Synced %s %s %s: %d transferred, %d skipped', s3prefix, 'to' if direction == 'download' else
+                'from', local_dir, counts['transferred'], counts['skipped'])
+    return counts
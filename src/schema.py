@@ -0,0 +1,167 @@
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('schema')
+
+
+def parse_dtypes(spec: Dict[str, Union[str, List]]) -> Dict[str, Any]:
+    """
+    Turn a dtype declaration from the configuration into pandas dtypes
+    Args:
+        spec (dict): column name to a numpy dtype name (e.g. "float32", "int16"), "category", or a list of the
+            allowed levels of a categorical column
+
+    Returns:
+        dtypes (dict): column name to dtype
+    """
+    dtypes = {}
+    for col, dtype in spec.items():
+        if isinstance(dtype, list):
+            dtypes[col] = pd.CategoricalDtype(categories=dtype)
+        elif dtype == 'category':
+            dtypes[col] = pd.CategoricalDtype()
+        else:
+            dtypes[col] = np.dtype(dtype)
+    return dtypes
+
+
+def _drift(message: str) -> ValueError:
+    logger.error('Schema drift: %s', message)
+    return ValueError(f'Schema drift: {message}')
+
+
+def check_columns(columns: List[str], dtypes: Dict[str, Any], projection: Optional[List[str]] = None) -> None:
+    """
+    Check the columns of a file or dataframe against the declared schema
+    Args:
+        columns (List[str]): columns present in the data
+        dtypes (dict): declared column dtypes
+        projection (List[str]): columns that will be used; None for all declared columns
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: if a used column is missing or not declared, or, without projection, if the data has
+            columns that are not declared
+    """
+    wanted = list(dtypes) if projection is None else projection
+    undeclared = [col for col in wanted if col not in dtypes]
+    missing = [col for col in wanted if col not in columns]
+    unexpected = [col for col in columns if col not in dtypes] if projection is None else []
+    if undeclared:
+        raise _drift(f'columns {undeclared} are not declared in the schema')
+    if missing:
+        raise _drift(f'columns {missing} are missing')
+    if unexpected:
+        raise _drift(f'unexpected columns {unexpected}')
+
+
+def enforce_schema(data: pd.DataFrame, dtypes: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Cast the declared columns of a dataframe to their compact dtypes, refusing any value the dtype cannot hold
+    Args:
+        data (obj: pd.DataFrame): dataframe holding (at least) the declared columns it is checked against
+        dtypes (dict): declared column dtypes; columns of the dataframe that are not declared are left as they are
+
+    Returns:
+        data (obj: pd.DataFrame): dataframe with the declared dtypes
+
+    Raises:
+        ValueError: if a value is outside the range of an integer dtype, is not numeric, is missing in an integer
+            column or is not a declared level of a categorical column
+    """
+    casts = {}
+    for col in data.columns:
+        dtype = dtypes.get(col)
+        if dtype is None or data[col].dtype == dtype:
+            continue
+        values = data[col]
+        if isinstance(dtype, pd.CategoricalDtype):
+            if dtype.categories is not None:
+                present = values.cat.categories if hasattr(values, 'cat') else pd.Index(values.dropna().unique())
+                unknown = present.difference(dtype.categories)
+                if len(unknown):
+                    raise _drift(f'{col} has values {list(unknown)[:5]} outside {list(dtype.categories)}')
+        elif dtype.kind in 'iu':
+            if not pd.api.types.is_integer_dtype(values):
+                if values.isna().any() or not pd.api.types.is_numeric_dtype(values):
+                    raise _drift(f'{col} must hold {dtype} values without missing entries')
+                if not (values == values.round()).all():
+                    raise _drift(f'{col} must hold whole numbers')
+            info = np.iinfo(dtype)
+            if len(values) and (values.min() < info.min or values.max() > info.max):
+                raise _drift(f'{col} has values outside the range of {dtype} [{info.min}, {info.max}]')
+        elif dtype.kind == 'f' and not pd.api.types.is_numeric_dtype(values):
+            raise _drift(f'{col} must hold numbers, found {values.dtype}')
+        casts[col] = dtype
+    return data.astype(casts) if casts else data
+
+
+def _csv_dtypes(dtypes: Dict[str, Any], columns: List[str]) -> Dict[str, Any]:
+    # integers are parsed as int64 and range-checked before the downcast: pandas wraps overflowing values silently
+    parse: Dict[str, Any] = {}
+    for col in columns:
+        dtype = dtypes[col]
+        if isinstance(dtype, pd.CategoricalDtype):
+            parse[col] = 'category'
+        elif dtype.kind in 'iu':
+            parse[col] = np.int64
+        else:
+            parse[col] = dtype
+    return parse
+
+
+def read_csv_with_schema(path: str, dtypes: Dict[str, Any], columns: Optional[List[str]] = None,
+                         **kwargs) -> pd.DataFrame:
+    """
+    Read a csv straight into the declared compact dtypes, failing fast if the file does not match the schema
+    Args:
+        path (str): path to the csv
+        dtypes (dict): declared column dtypes, e.g. from `parse_dtypes`
+        columns (List[str]): columns to read; None reads all declared columns and rejects undeclared ones
+        **kwargs: further arguments of `pd.read_csv`
+
+    Returns:
+        data (obj: pd.DataFrame): dataframe with the declared dtypes
+    """
+    check_columns(list(pd.read_csv(path, nrows=0).columns), dtypes, columns)
+    usecols = list(dtypes) if columns is None else columns
+    try:
+        data = pd.read_csv(path, usecols=usecols, dtype=_csv_dtypes(dtypes, usecols), **kwargs)
+    except (ValueError, OverflowError) as e:
+        raise _drift(f'{path} does not parse with the declared dtypes ({e})') from e
+    return enforce_schema(data, dtypes)
+
+
+def iter_csv_with_schema(path: str, dtypes: Dict[str, Any], chunksize: int, columns: Optional[List[str]] = None,
+                         **kwargs) -> Iterator[pd.DataFrame]:
+    """
+    Read a csv in chunks straight into the declared compact dtypes, failing fast if the file does not match
+    the schema
+    Args:
+        path (str): path to the csv
+        dtypes (dict): declared column dtypes, e.g. from `parse_dtypes`
+        chunksize (int): rows per chunk
+        columns (List[str]): columns to read; None reads all declared columns and rejects undeclared ones
+        **kwargs: further arguments of `pd.read_csv`
+
+    Returns:
+        chunks (Iterator[pd.DataFrame]): chunks with the declared dtypes
+    """
+    check_columns(list(pd.read_csv(path, nrows=0).columns), dtypes, columns)
+    usecols = list(dtypes) if columns is None else columns
+    reader = pd.read_csv(path, usecols=usecols, dtype=_csv_dtypes(dtypes, usecols), chunksize=chunksize, **kwargs)
+    while True:
+        try:
+            chunk = next(reader)
+        except StopIteration:
+            return
+        except (ValueError, OverflowError) as e:
+            raise _drift(f'{path} does not parse with the declared dtypes ({e})') from e
+        yield enforce_schema(chunk, dtypes)
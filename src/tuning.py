@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.parallel import limit_blas_threads, resolve_n_jobs
+
+# scikit-learn is imported by the functions that fit and split, so that importing this module stays cheap
+# pylint: disable=locally-disabled, invalid-name, import-outside-toplevel
+
+logger = logging.getLogger('tuning')
+
+# training data of a worker process, set once by `_init_worker` instead of being pickled with every task
+_worker_data: Dict[str, Any] = {}
+
+
+def sample_candidates(search_space: Dict, n_candidates: int, random_state: int) -> List[Dict]:
+    """
+    Draw random hyperparameter combinations from a search space
+    Args:
+        search_space (dict): parameter name to either a list of choices or a range {low, high} (integers if both
+            bounds are integers), optionally with `log: true` to sample the range on a log scale
+        n_candidates (int): number of distinct combinations to draw
+        random_state (int): random seed
+
+    Returns:
+        candidates (List[dict]): hyperparameter combinations
+    """
+    rng = np.random.default_rng(random_state)
+    candidates: List[Dict] = []
+    seen = set()
+    # a small discrete space may hold fewer distinct combinations than requested
+    for _ in range(n_candidates * 20):
+        if len(candidates) == n_candidates:
+            break
+        params = {}
+        for name, space in search_space.items():
+            if isinstance(space, list):
+                params[name] = space[rng.integers(len(space))]
+            elif space.get('log'):
+                value = math.exp(rng.uniform(math.log(space['low']), math.log(space['high'])))
+                params[name] = int(round(value)) if isinstance(space['low'], int) and isinstance(space['high'], int) \
+                    else value
+            elif isinstance(space['low'], int) and isinstance(space['high'], int):
+                params[name] = int(rng.integers(space['low'], space['high'] + 1))
+            else:
+                params[name] = float(rng.uniform(space['low'], space['high']))
+        key = json.dumps(params, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            candidates.append(params)
+    return candidates
+
+
+def data_fingerprint(X: pd.DataFrame, y: pd.Series) -> str:
+    """
+    Hash the training data, so cached fold results are never reused for different data
+    Args:
+        X (obj: pd.DataFrame): training features
+        y (obj: pd.Series): training target
+
+    Returns:
+        fingerprint (str): sha256 of the feature names and the row hashes of features and target
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(list(map(str, X.columns))).encode())
+    sha.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+    sha.update(pd.util.hash_pandas_object(pd.Series(np.asarray(y)), index=False).values.tobytes())
+    return sha.hexdigest()
+
+
+class FoldCache:
+    """Append-only json lines file of cross-validation fold scores, keyed by everything that determines them.
+
+    Every finished fold is appended and flushed right away, so a search that is interrupted resumes with only the
+    folds that were not finished yet.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.scores: Dict[str, float] = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as f:
+                lines = f.read().split('\n')
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut short by the interruption
+                    continue
+                self.scores[entry['key']] = entry['score']
+            if lines[-1]:
+                # start the next entry on a line of its own
+                with open(path, 'a', encoding='utf8') as f:
+                    f.write('\n')
+
+    @staticmethod
+    def key(params: Dict, fold: int, context: Dict) -> str:
+        """Stable hash of a candidate, fold and search context."""
+        return hashlib.sha256(json.dumps({'params': params, 'fold': fold, **context}, sort_keys=True,
+                                         default=str).encode()).hexdigest()
+
+    def add(self, key: str, score: float) -> None:
+        """
+        Record and persist the score of a fold
+        Args:
+            key (str): fold key from `key`
+            score (float): validation score of the fold
+
+        Returns:
+            None
+        """
+        self.scores[key] = score
+        if self.path is not None:
+            with open(self.path, 'a', encoding='utf8') as f:
+                f.write(json.dumps({'key': key, 'score': score}) + '\n')
+
+
+# training features, target, folds, scorer name and random seed passed to `_init_worker`
+_WorkerArgs = Tuple[np.ndarray, np.ndarray, List[Tuple[np.ndarray, np.ndarray]], str, int]
+
+
+def _init_worker(X: np.ndarray, y: np.ndarray, folds: List[Tuple[np.ndarray, np.ndarray]], scoring: str,
+                 random_state: int, blas_threads: Optional[int]) -> None:
+    limit_blas_threads(blas_threads)
+    _worker_data.update(X=X, y=y, folds=folds, scoring=scoring, random_state=random_state)
+
+
+def _score_fold(params: Dict, fold: int) -> float:
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import get_scorer
+    train_index, valid_index = _worker_data['folds'][fold]
+    X, y = _worker_data['X'], _worker_data['y']
+    # one core per fit: parallelism comes from running folds in separate processes
+    rf = RandomForestClassifier(**{'class_weight': 'balanced', 'random_state': _worker_data['random_state'],
+                                   **params, 'n_jobs': 1})
+    rf.fit(X[train_index], y[train_index])
+    return float(get_scorer(_worker_data['scoring'])(rf, X[valid_index], y[valid_index]))
+
+
+def _evaluate(candidates: List[Dict], n_folds: int, cache: FoldCache, context: Dict, n_workers: int,
+              init_args: _WorkerArgs, blas_threads: Optional[int]) -> List[List[float]]:
+    tasks = {(i, fold): FoldCache.key(params, fold, context)
+             for i, params in enumerate(candidates) for fold in range(n_folds)}
+    pending = [task for task, key in tasks.items() if key not in cache.scores]
+    if len(pending) < len(tasks):
+        logger.info('%d of %d folds found in the cache', len(tasks) - len(pending), len(tasks))
+    if n_workers == 1:
+        # in this process the BLAS thread limit is left to the caller
+        _init_worker(*init_args, blas_threads=None)
+        for i, fold in pending:
+            cache.add(tasks[(i, fold)], _score_fold(candidates[i], fold))
+    elif pending:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(*init_args, blas_threads)) as executor:
+            futures = {executor.submit(_score_fold, candidates[i], fold): (i, fold) for i, fold in pending}
+            for future in as_completed(futures):
+                cache.add(tasks[futures[future]], future.result())
+    return [[cache.scores[tasks[(i, fold)]] for fold in range(n_folds)] for i in range(len(candidates))]
+
+
+def search(X_train: pd.DataFrame, y_train: pd.Series, search_space: Dict, method: str = 'halving',
+           n_candidates: int = 24, n_splits: int = 5, scoring: str = 'roc_auc', n_workers: Optional[int] = 1,
+           random_state: int = 42, min_resource: int = 25, max_resource: int = 200, factor: int = 2,
+           cache_path: Optional[str] = None, blas_threads: Optional[int] = 1) -> Tuple[Dict, pd.DataFrame]:
+    """
+    Cross-validated random or successive-halving search over random forest hyperparameters.
+
+    Random search scores every candidate with `max_resource` trees. Successive halving scores all candidates with
+    `min_resource` trees, keeps the best 1/`factor` of them, multiplies the number of trees by `factor` and repeats
+    until one candidate is left or `max_resource` trees are reached. The folds of a round are fit in parallel
+    across `n_workers` processes, and every fold score is cached in `cache_path` so a rerun resumes.
+    Args:
+        X_train (obj: pd.DataFrame): training features
+        y_train (obj: pd.Series): training target
+        search_space (dict): search space, see `sample_candidates`
+        method (str): "random" or "halving"
+        n_candidates (int): number of hyperparameter combinations to try
+        n_splits (int): number of stratified cross-validation folds
+        scoring (str): scikit-learn scorer name
+        n_workers (int): number of worker processes; None or -1 for one per core
+        random_state (int): seed for sampling, fold assignment and the forests
+        min_resource (int): number of trees in the first halving round
+        max_resource (int): number of trees in the last halving round and in random search
+        factor (int): halving factor
+        cache_path (str): json lines file caching fold scores; None disables caching
+        blas_threads (int): BLAS and OpenMP threads in every worker process; None leaves the libraries' defaults
+
+    Returns:
+        best_params (dict): hyperparameters of the best candidate, including its number of trees
+        results (obj: pd.DataFrame): mean and standard deviation of the score of every candidate in every round
+    """
+    if method not in ('random', 'halving'):
+        raise ValueError('method must be "random" or "halving"')
+    from sklearn.model_selection import StratifiedKFold
+    n_workers = resolve_n_jobs(-1 if n_workers is None else n_workers)
+    candidates = sample_candidates(search_space, n_candidates, random_state)
+    folds = list(StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+                 .split(X_train, y_train))
+    init_args: _WorkerArgs = (np.asarray(X_train, dtype=np.float32), np.asarray(y_train), folds, scoring, random_state)
+    context = {'data': data_fingerprint(X_train, y_train), 'n_splits': n_splits, 'scoring': scoring,
+               'random_state': random_state}
+    cache = FoldCache(cache_path)
+
+    survivors = list(range(len(candidates)))
+    resource = max_resource if method == 'random' or 'n_estimators' in search_space else min_resource
+    rows = []
+    round_ = 0
+    start = time.perf_counter()
+    while True:
+        params = [candidates[i] if 'n_estimators' in search_space else {**candidates[i], 'n_estimators': resource}
+                  for i in survivors]
+        scores = _evaluate(params, n_splits, cache, context, n_workers, init_args, blas_threads)
+        for i, p, fold_scores in zip(survivors, params, scores):
+            rows.append({'round': round_, 'candidate': i, 'n_estimators': p['n_estimators'],
+                         'mean_score': float(np.mean(fold_scores)), 'std_score': float(np.std(fold_scores)),
+                         'params': json.dumps(p, sort_keys=True)})
+        logger.info('Round %d: %d candidates with %d trees scored, best %s %.4f', round_, len(survivors), resource,
+                    scoring, max(np.mean(s) for s in scores))
+        if method == 'random' or len(survivors) <= 1 or resource >= max_resource:
+            break
+        ranked = sorted(zip(survivors, scores), key=lambda item: -np.mean(item[1]))
+        survivors = [i for i, _ in ranked[:max(1, math.ceil(len(survivors) / factor))]]
+        resource = min(resource * factor, max_resource)
+        round_ += 1
+
+    results = pd.DataFrame(rows)
+    last_round = results[results['round'] == results['round'].max()]
+    best = last_round.loc[last_round['mean_score'].idxmax()]
+    logger.info('Search of %d candidates took %.1f s with %d workers; best %s %.4f with %s', len(candidates),
+                time.perf_counter() - start, n_workers, scoring, best['mean_score'], best['params'])
+    return json.loads(best['params']), results
@@ -0,0 +1,437 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from typing import IO, Callable, Dict, List, Optional, Set, Tuple
+
+from src.metrics import metrics
+
+# pylint: disable=locally-disabled, invalid-name
+
+logger = logging.getLogger('write-behind')
+
+OVERFLOW_POLICIES = ('block', 'reject', 'drop')
+
+# put on the queue by `close` to stop the worker once everything before it is written
+_STOP = object()
+
+
+def _is_linked(f: IO, path: str) -> bool:
+    # whether the open file is still the one at `path`, rather than a file deleted since it was opened
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+class WriteAheadLog:
+    """Local log of the records a WriteBehindQueue has accepted but not written yet, replayed after a crash.
+
+    Every process appends to its own segment files in `directory`, one JSON line per record, and holds an exclusive
+    lock on the segment it appends to. Once all records of the current segment are written, the segment is emptied;
+    a segment is closed after `segment_records` records, so written records are also removed under sustained load,
+    and deleted once all its records are written. Segments left behind by a process that crashed, or by a batch that
+    could not be written, are no longer locked and are replayed by the next queue started on the directory.
+
+    A record the queue turns away after it was logged is cancelled with a tombstone line, a JSON list holding the
+    record's position in the segment, so that replay skips it.
+
+    Lines are flushed to the operating system as they are written, which survives a crash of the process; with
+    `fsync` they are also forced to disk, which survives a crash of the host at the cost of a disk sync per record.
+    """
+
+    def __init__(self, directory: str, segment_records: int = 10000, fsync: bool = False):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file: Optional[IO] = None
+        self._path: Optional[str] = None
+        self._pid: Optional[int] = None
+        self._records_in_segment = 0
+        self._pending: Dict[str, int] = {}
+        self._kept: Set[str] = set()
+
+    def _open(self) -> Tuple[IO, str]:
+        os.makedirs(self.directory, exist_ok=True)
+        # named by creation time, so segments sort in the order their records were accepted
+        path = os.path.join(self.directory, f'{time.time_ns():020d}-{os.getpid()}.wal')
+        # locked before it gets its .wal name, so no other process takes it for a crashed one and replays it
+        f = open(path + '.new', 'a', encoding='utf8')  # pylint: disable=consider-using-with
+        fcntl.flock(f, fcntl.LOCK_EX)
+        os.rename(path + '.new', path)
+        self._file, self._path = f, path
+        self._records_in_segment = 0
+        self._pending[path] = 0
+        return f, path
+
+    def _rotate(self) -> None:
+        f, path = self._file, self._path
+        if f is None or path is None:
+            return
+        f.close()
+        if self._pending[path] == 0 and path not in self._kept:
+            os.remove(path)
+            del self._pending[path]
+        self._file, self._path = None, None
+
+    def _write_line(self, f: IO, entry) -> None:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def append(self, record: Dict) -> Tuple[str, int]:
+        """
+        Log one record before it is queued
+        Args:
+            record (dict): column values of the record
+
+        Returns:
+            segment (str): path of the segment holding the record, to report it written with `written`
+            position (int): position of the record in the segment, to cancel it with `cancel`
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked worker appends to segments of its own; closing its copy of the parent's segment
+                # leaves the parent's lock in place
+                if self._file is not None:
+                    self._file.close()
+                self._file, self._path, self._pid = None, None, os.getpid()
+                self._pending, self._kept = {}, set()
+            f, path = self._file, self._path
+            if f is None or path is None or self._records_in_segment >= self.segment_records:
+                self._rotate()
+                f, path = self._open()
+            self._write_line(f, record)
+            position = self._records_in_segment
+            self._records_in_segment += 1
+            self._pending[path] += 1
+            return path, position
+
+    def cancel(self, segment: str, position: int) -> None:
+        """
+        Take back a logged record that was not queued, so that it is never written
+        Args:
+            segment (str): path of the segment holding the record, as returned by `append`
+            position (int): position of the record in the segment, as returned by `append`
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if segment == self._path and self._file is not None:
+                self._write_line(self._file, [position])
+            elif self._pending[segment] > 1 or segment in self._kept:
+                # the segment was closed since, but stays on disk for its other records
+                with open(segment, 'a', encoding='utf8') as f:
+                    self._write_line(f, [position])
+            self._release({segment: 1}, keep=False)
+
+    def written(self, segments: Dict[str, int], keep: bool = False) -> None:
+        """
+        Release records that left the queue
+        Args:
+            segments (dict): number of records per segment
+            keep (bool): keep the segments on disk, to be replayed at the next start, e.g. because the batch
+                could not be written
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._release(segments, keep)
+
+    def _release(self, segments: Dict[str, int], keep: bool) -> None:
+        for path, n_records in segments.items():
+            self._pending[path] -= n_records
+            if keep:
+                self._kept.add(path)
+        if keep and self._path in segments:
+            # stop appending to a kept segment and unlock it, so that the next start replays it
+            self._rotate()
+        for path in [path for path, n in self._pending.items() if n == 0 and path != self._path]:
+            if path not in self._kept:
+                os.remove(path)
+            del self._pending[path]
+        if self._file is not None and self._path is not None and self._pending[self._path] == 0 \
+                and self._records_in_segment:
+            self._file.truncate(0)
+            self._records_in_segment = 0
+
+    def replay(self, write_fn: Callable[[List[Dict]], None], batch_size: int) -> int:
+        """
+        Write the records of segments no running process holds, oldest first, and delete them
+        Args:
+            write_fn (Callable): writes a batch of records
+            batch_size (int): most records per `write_fn` call
+
+        Returns:
+            n_records (int): records replayed
+        """
+        n_records = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.wal'))):
+            try:
+                f = open(path, 'r+', encoding='utf8')  # pylint: disable=consider-using-with
+            except FileNotFoundError:
+                # replayed and deleted by another process since it was listed
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if not _is_linked(f, path):
+                    # another process replayed and deleted it between the open and the lock
+                    continue
+                records, cancelled = [], set()
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a segment may be cut short by the crash
+                        logger.warning('Skipping a damaged line of %s', path)
+                        continue
+                    if isinstance(entry, list):
+                        cancelled.update(entry)
+                    else:
+                        records.append(entry)
+                records = [record for i, record in enumerate(records) if i not in cancelled]
+                try:
+                    for start in range(0, len(records), batch_size):
+                        write_fn(records[start:start + batch_size])
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error('Replaying %s failed, it is kept for the next start: %s', path, e)
+                    continue
+                os.remove(path)
+            logger.info('Replayed %d records from %s', len(records), path)
+            n_records += len(records)
+        return n_records
+
+    def close(self) -> None:
+        """Close the current segment, deleting it if all its records are written."""
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._rotate()
+
+
+class WriteBehindQueue:
+    """Persists records in the background, in batches, so requests do not wait on the database.
+
+    Callers put a record on a bounded queue and return at once. A background thread takes the first waiting record
+    and keeps collecting until `max_batch_size` records are gathered or `flush_interval_ms` has passed since the
+    first one arrived, then writes them with one `write_fn` call, i.e. one multi-row statement and one commit. A
+    batch whose write fails is retried `max_retries` times, then logged and dropped (or left in the write-ahead log).
+
+    When `max_queue_depth` records are waiting, `overflow` decides what happens to the next one: 'block' waits up
+    to `submit_timeout` seconds for room and then rejects it, 'reject' rejects it at once, and 'drop' discards it
+    and carries on. Rejected records raise `queue.Full` to the caller.
+
+    The records still waiting are written when the process exits normally. With `wal_dir`, every record is also
+    logged to a local WriteAheadLog before it is queued, so records accepted by a process that crashed, and
+    batches that could not be written, are written by the next queue started on the same directory.
+    """
+
+    def __init__(self, write_fn: Callable[[List[Dict]], None], max_queue_depth: int = 10000,
+                 max_batch_size: int = 500, flush_interval_ms: float = 50.0, overflow: str = 'block',
+                 submit_timeout: float = 1.0, max_retries: int = 2, retry_interval: float = 0.5,
+                 wal_dir: Optional[str] = None, wal_fsync: bool = False, shutdown_timeout: float = 30.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow must be one of {OVERFLOW_POLICIES}, not {overflow!r}')
+        self.write_fn = write_fn
+        self.max_queue_depth = max_queue_depth
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.overflow = overflow
+        self.submit_timeout = submit_timeout
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.wal = WriteAheadLog(wal_dir, segment_records=max_queue_depth, fsync=wal_fsync) if wal_dir else None
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_depth)
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_pid: Optional[int] = None
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.failed = 0
+        self.replayed = 0
+        self.largest_batch = 0
+
+    def _ensure_worker(self) -> None:
+        # started lazily, and again after a fork, since threads do not survive into forked workers
+        if self._worker is not None and self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker_pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue_depth)
+            self._worker = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+            atexit.register(self.close, self.shutdown_timeout)
+
+    def start(self) -> None:
+        """Start the background thread now rather than on the first record, replaying the write-ahead log."""
+        self._ensure_worker()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        if batch[0] is _STOP:
+            return batch
+        deadline = batch[0][2] + self.flush_interval
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is _STOP:
+                break
+        return batch
+
+    def _run(self) -> None:
+        if self.wal is not None:
+            try:
+                self.replayed += self.wal.replay(self._write_batch, self.max_batch_size)
+            except Exception as e:  # pylint: disable=broad-except
+                # the segments stay on disk for the next start; new records are still written
+                logger.error('Replaying the write-ahead log in %s failed: %s', self.wal.directory, e)
+        while True:
+            batch = self._collect()
+            items = [item for item in batch if item is not _STOP]
+            if items:
+                written = self._write([record for record, _, _ in items])
+                if self.wal is not None:
+                    self.wal.written(Counter(segment for _, segment, _ in items), keep=not written)
+            for _ in batch:
+                self._queue.task_done()
+            if batch[-1] is _STOP:
+                if self.wal is not None:
+                    self.wal.close()
+                return
+
+    def _write_batch(self, records: List[Dict]) -> None:
+        self.write_fn(records)
+        self.batches += 1
+        self.written += len(records)
+        self.largest_batch = max(self.largest_batch, len(records))
+        metrics.inc('churn_write_behind_records_total', len(records), outcome='written')
+
+    def _write(self, records: List[Dict]) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write_batch(records)
+            except Exception as e:  # pylint: disable=broad-except
+                if attempt < self.max_retries:
+                    logger.warning('Writing a batch of %d records failed, retrying: %s', len(records), e)
+                    time.sleep(self.retry_interval * 2 ** attempt)
+                    continue
+                self.failed += len(records)
+                metrics.inc('churn_write_behind_records_total', len(records), outcome='failed')
+                logger.error('Writing a batch of %d records failed %d times, records %s: %s', len(records),
+                             attempt + 1, 'kept in the write-ahead log' if self.wal is not None else 'dropped', e)
+                return False
+            return True
+        return False
+
+    def submit(self, record: Dict) -> bool:
+        """
+        Queue one record to be written
+        Args:
+            record (dict): column values of the record
+
+        Returns:
+            accepted (bool): False if the queue was full and the record dropped under the 'drop' policy
+
+        Raises:
+            queue.Full: if the queue is full under the 'reject' policy, or stays full for longer than
+                `submit_timeout` seconds under the 'block' policy
+        """
+        self._ensure_worker()
+        segment, position = self.wal.append(record) if self.wal is not None else (None, 0)
+        try:
+            if self.overflow == 'block':
+                self._queue.put((record, segment, time.perf_counter()), timeout=self.submit_timeout)
+            else:
+                self._queue.put_nowait((record, segment, time.perf_counter()))
+        except queue.Full:
+            if self.wal is not None and segment is not None:
+                # the caller is told the record was not accepted, so it must not be replayed after a crash either
+                self.wal.cancel(segment, position)
+            if self.overflow == 'drop':
+                self.dropped += 1
+                metrics.inc('churn_write_behind_records_total', outcome='dropped')
+                logger.warning('Write-behind queue is full (%d records waiting), record dropped', self.max_queue_depth)
+                return False
+            self.rejected += 1
+            metrics.inc('churn_write_behind_records_total', outcome='rejected')
+            logger.error('Write-behind queue is full (%d records waiting)', self.max_queue_depth)
+            raise
+        self.submitted += 1
+        return True
+
+    def flush(self) -> None:
+        """Wait until every record submitted so far is written (or has failed)."""
+        if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
+            self._queue.join()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Write the records still waiting and stop the background thread
+        Args:
+            timeout (float): seconds to wait for room on the queue and for the thread to finish, None to wait until
+                everything is written
+
+        Returns:
+            None
+        """
+        if self._worker is None or self._worker_pid != os.getpid() or not self._worker.is_alive():
+            return
+        waiting = self._queue.qsize()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.error('Write-behind queue stayed full for %s seconds, %d records waiting', timeout, waiting)
+            return
+        self._worker.join(None if deadline is None else max(deadline - time.perf_counter(), 0))
+        if self._worker.is_alive():
+            logger.error('Write-behind queue did not drain within %s seconds, %d records waiting', timeout,
+                         self._queue.qsize())
+            return
+        logger.info('Write-behind queue closed after writing %d waiting records', waiting)
+        self._worker = None
+
+    def stats(self) -> Dict:
+        """
+        Summarize write-behind settings and counters
+        Returns:
+            stats (dict): configuration, queue depth, records written, replayed, rejected, dropped and failed, and
+                batch sizes
+        """
+        return {'max_queue_depth': self.max_queue_depth,
+                'max_batch_size': self.max_batch_size,
+                'flush_interval_ms': self.flush_interval * 1000,
+                'overflow': self.overflow,
+                'wal_dir': self.wal.directory if self.wal is not None else None,
+                'queue_depth': self._queue.qsize(),
+                'submitted': self.submitted,
+                'written': self.written,
+                'replayed': self.replayed,
+                'batches': self.batches,
+                'rejected': self.rejected,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'largest_batch': self.largest_batch,
+                'mean_batch_size': round(self.written / self.batches, 3) if self.batches else 0.0}
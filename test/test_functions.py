@@ -1,8 +1,47 @@
+import fcntl
+import glob
+import json
+import os
+import pickle
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
 import pytest
 import pandas as pd
+import sqlalchemy.dialects.mysql
+import yaml
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
 
-from src.process_data import clean_data
-from src.modeling import select_target, select_features
+from src.artifacts import artifact_path
+from src.batching import MicroBatcher
+from src.create_db import ChurnManager, ChurnScore, ChurnSegment, Customer, InstrumentedQueuePool, \
+    SEGMENT_SUMS, create_db, engine_options, read_checkpoint, write_checkpoint, upsert_statement
+from src.features import FeatureSchema
+from src.forest import FlatForest, compile_forest
+from src.metrics import Histogram, Metrics, metrics
+from src.pipeline import Pipeline, Step
+from src.prediction_cache import PredictionCache
+from src.process_data import clean_data, clean_data_streaming, compact_dtypes, validate_batch, validate_input, \
+    validate_record
+from src.modeling import select_target, select_features, train_model, predict_batch, \
+    build_feature_schema, save_table, load_table, save_train_test, split_data, make_predictions, \
+    pred_one_record
+from src.parallel import resolve_n_jobs
+from src.registry import Artifact, ModelRegistry, content_digest, load_model_with_schema, load_pickle
+from src.s3 import download_file_from_s3, get_s3_client, local_etag, parse_s3, reset_s3_client, sync_prefix, \
+    upload_file_to_s3
+from src.schema import enforce_schema, iter_csv_with_schema, parse_dtypes, read_csv_with_schema
+from src.tuning import FoldCache, sample_candidates, search
+from src.write_behind import WriteAheadLog, WriteBehindQueue
 
 # pylint: disable=locally-disabled, invalid-name
 
@@ -84,3 +123,1517 @@ def test_clean_data_invalid_input():
     raw_data = pd.read_csv("test/unit_test_data/raw_data_test.csv")
     with pytest.raises(KeyError):
         clean_data(raw_data, 'invalid_churn')
+
+
+def test_artifact_loaded_once(tmp_path):
+    """
+    Test that an Artifact loads its file once and serves later calls from memory
+    """
+    path = tmp_path / 'obj.pkl'
+    with open(path, 'wb') as f:
+        pickle.dump({'a': 1}, f)
+    artifact = Artifact(str(path), load_pickle, check_interval=0)
+    assert artifact.get() == {'a': 1}
+    assert artifact.get() == {'a': 1}
+    assert artifact.misses == 1
+    assert artifact.hits == 1
+
+
+def test_artifact_hot_reload(tmp_path):
+    """
+    Test that an Artifact swaps in a new object and version when the file changes
+    """
+    path = tmp_path / 'obj.pkl'
+    with open(path, 'wb') as f:
+        pickle.dump({'a': 1}, f)
+    artifact = Artifact(str(path), load_pickle, check_interval=0)
+    artifact.get()
+    old_version = artifact.version
+    with open(path, 'wb') as f:
+        pickle.dump({'a': 2, 'b': 3}, f)
+    assert artifact.get() == {'a': 2, 'b': 3}
+    assert artifact.version != old_version
+    assert artifact.reloads == 1
+
+
+def test_artifact_missing_file(tmp_path):
+    """
+    Test that an Artifact raises FileNotFoundError when nothing can be loaded
+    """
+    artifact = Artifact(str(tmp_path / 'missing.pkl'), load_pickle, check_interval=0)
+    with pytest.raises(FileNotFoundError):
+        artifact.get()
+
+
+def test_registry_swaps_model_and_schema_together(tmp_path):
+    """
+    Test that the registry reloads model and feature schema as one version and keeps serving the last matching pair
+    while the files on disk do not belong together
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    model_path, schema_path = str(tmp_path / 'rf_model_flat.npz'), str(tmp_path / 'feature_schema.json')
+    config_path = str(tmp_path / 'config.yaml')
+    with open(config_path, 'w', encoding='utf8') as f:
+        yaml.safe_dump({'a': 1}, f)
+
+    def train(columns):
+        rf, _, _, _, _ = train_model(data, columns, 'churn', 0.2, 42, model_params={'n_estimators': 2})
+        return compile_forest(rf), build_feature_schema(data, columns)
+
+    forest, schema = train(['international_plan', 'total_day_minutes'])
+    forest.save(model_path)
+    schema.save(schema_path)
+    registry = ModelRegistry(model_path, config_path, schema_path, check_interval=0)
+    model, loaded_schema, version = registry.versioned_model()
+    assert model.n_features == len(loaded_schema.features) == 2
+
+    new_forest, new_schema = train(['international_plan', 'total_day_minutes', 'customer_service_calls'])
+    new_forest.save(model_path)
+    model, loaded_schema, mismatched_version = registry.versioned_model()
+    assert mismatched_version == version and len(loaded_schema.features) == 2
+    new_schema.save(schema_path)
+    model, loaded_schema, new_version = registry.versioned_model()
+    assert new_version != version
+    assert model.n_features == len(loaded_schema.features) == 3
+    assert registry.model_artifact.reloads == 1
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_predict_batch_matches_model():
+    """
+    Test that predict_batch returns the model's own predictions for every record
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    columns = ['international_plan', 'voice_mail_plan', 'total_day_minutes', 'customer_service_calls']
+    rf, X_train, X_test, _, _ = train_model(data, columns, 'churn', 0.2, 42)
+    schema = build_feature_schema(data, columns)
+    output_test = predict_batch(rf, schema, data.loc[X_test.index])
+    assert (output_test['pred_class'].values == rf.predict(X_test)).all()
+    assert (output_test['pred_proba'].values == rf.predict_proba(X_test)[:, -1]).all()
+
+
+def test_feature_schema_encode_record():
+    """
+    Test that the feature schema encodes a single record exactly like train_model's dummy coding
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    columns = ['international_plan', 'voice_mail_plan', 'number_vmail_messages', 'total_day_minutes']
+    schema = build_feature_schema(data, columns)
+    output_true = pd.get_dummies(data[columns], drop_first=True)
+    assert schema.features == list(output_true.columns)
+    for i in range(5):
+        output_test = schema.encode_record(data.iloc[i].to_dict())
+        assert output_test.tolist() == [output_true.iloc[i].astype(float).tolist()]
+
+
+def test_feature_schema_roundtrip(tmp_path):
+    """
+    Test that a saved feature schema loads back with the same encoding
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    columns = ['international_plan', 'voice_mail_plan', 'total_day_minutes']
+    schema = build_feature_schema(data, columns)
+    schema.save(str(tmp_path / 'schema.json'))
+    loaded = FeatureSchema.load(str(tmp_path / 'schema.json'))
+    assert loaded.to_dict() == schema.to_dict()
+    assert (loaded.encode_batch(data) == schema.encode_batch(data)).all()
+
+
+def test_feature_schema_invalid_category():
+    """
+    Test that the feature schema rejects unknown categorical values
+    """
+    schema = FeatureSchema(['international_plan', 'total_day_minutes'], {'international_plan': ['No', 'Yes']},
+                           ['total_day_minutes', 'international_plan_Yes'])
+    with pytest.raises(ValueError):
+        schema.encode_record({'international_plan': 'Maybe', 'total_day_minutes': 1.0})
+
+
+def test_validate_record_valid_input():
+    """
+    Test validate_record function with valid input
+    """
+    output_test = validate_record({'id': '3', 'total_day_minutes': '1.5', 'voice_mail_plan': 'Yes'},
+                                  ['id'], ['total_day_minutes'])
+    assert output_test == {'id': 3, 'total_day_minutes': 1.5, 'voice_mail_plan': 'Yes'}
+
+
+def test_validate_record_invalid_input():
+    """
+    Test validate_record function with negative, non-numeric and non-finite input
+    """
+    with pytest.raises(ValueError):
+        validate_record({'id': '-1'}, ['id'], [])
+    with pytest.raises(ValueError):
+        validate_record({'total_day_minutes': 'abc'}, [], ['total_day_minutes'])
+    for value in ('nan', 'inf', '-inf', float('inf')):
+        with pytest.raises(ValueError, match='must be numeric'):
+            validate_record({'total_day_minutes': value}, [], ['total_day_minutes'])
+        with pytest.raises(ValueError, match='must be an integer'):
+            validate_record({'id': value}, ['id'], [])
+    for value in (str(2 ** 31), '9' * 400):
+        with pytest.raises(ValueError, match='must be at most'):
+            validate_record({'id': value}, ['id'], [])
+    for value in (True, False, np.True_):
+        with pytest.raises(ValueError, match='must be numeric'):
+            validate_record({'total_day_minutes': value}, [], ['total_day_minutes'])
+        with pytest.raises(ValueError, match='must be an integer'):
+            validate_record({'id': value}, ['id'], [])
+
+
+def test_validate_batch_masks_invalid_rows():
+    """
+    Test that validate_batch reports every invalid row with its messages and keeps the valid rows converted
+    """
+    data = pd.DataFrame({'id': ['1', '-2', 'x', '4.5', '5'],
+                         'total_day_minutes': [1.5, None, -3.0, 2.0, '7'],
+                         'international_plan': ['Yes', 'No', 'Maybe', 'No', 'No']})
+    valid, invalid, errors = validate_batch(data, ['id'], ['total_day_minutes'],
+                                            categories={'international_plan': ['No', 'Yes']})
+    assert invalid.tolist() == [False, True, True, True, False]
+    assert valid.index.tolist() == [0, 4]
+    assert valid['id'].tolist() == [1, 5] and valid['id'].dtype == np.int64
+    assert valid['total_day_minutes'].tolist() == [1.5, 7.0]
+    assert errors[1] == 'id must be greater than or equal to 0; total_day_minutes must be numeric'
+    assert errors[2] == ("id must be an integer; total_day_minutes must be greater than or equal to 0; "
+                         "international_plan must be one of ['No', 'Yes']")
+    assert errors[3] == 'id must be an integer'
+    with pytest.raises(ValueError, match='id must be greater than or equal to 0'):
+        validate_input(data.iloc[[1]], ['id'], [])
+    _, invalid, errors = validate_batch(pd.DataFrame({'id': [2 ** 31 - 1, 2 ** 31, 1e30]}), ['id'], [])
+    assert invalid.tolist() == [False, True, True]
+    assert errors[1] == f'id must be at most {2 ** 31 - 1}'
+
+
+def test_validate_batch_rejects_booleans():
+    """
+    Test that validate_batch rejects booleans in boolean columns and mixed into other columns, like validate_record
+    """
+    data = pd.DataFrame({'id': [True, False], 'total_day_minutes': [1.5, True]})
+    valid, invalid, errors = validate_batch(data, ['id'], ['total_day_minutes'])
+    assert invalid.tolist() == [True, True] and valid.empty
+    assert errors[0] == 'id must be an integer'
+    assert errors[1] == 'id must be an integer; total_day_minutes must be numeric'
+    data = pd.DataFrame({'id': [1, True, '3'], 'total_day_minutes': ['2.5', 1.0, False]})
+    valid, invalid, errors = validate_batch(data, ['id'], ['total_day_minutes'])
+    assert invalid.tolist() == [False, True, True]
+    assert valid['id'].tolist() == [1] and valid['total_day_minutes'].tolist() == [2.5]
+    assert errors[2] == 'total_day_minutes must be numeric'
+
+
+def test_add_customer_data_skips_invalid_rows(tmp_path):
+    """
+    Test that ingest with validation skips invalid rows and adds the others
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv", nrows=100)
+    data.loc[[3, 50], 'total_day_minutes'] = -1.0
+    input_path = tmp_path / 'customers.csv'
+    data.to_csv(input_path, index=False)
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    assert cm.add_customer_data(str(input_path), chunksize=30,
+                                validate={'int_cols': ['id'], 'numeric_cols': ['total_day_minutes']}) == 98
+    assert cm.session.query(Customer).get(int(data['id'][3])) is None
+    cm.close()
+
+
+def test_flat_forest_identical_to_random_forest():
+    """
+    Test that the flattened forest reproduces RandomForestClassifier.predict_proba bit for bit
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    columns = ['international_plan', 'voice_mail_plan', 'total_day_minutes', 'total_eve_minutes',
+               'customer_service_calls']
+    rf, X_train, X_test, _, _ = train_model(data, columns, 'churn', 0.2, 42)
+    forest = compile_forest(rf)
+    assert np.array_equal(forest.predict_proba(X_test.values), rf.predict_proba(X_test))
+    assert np.array_equal(forest.predict_proba(X_test.values, chunk_rows=7), rf.predict_proba(X_test))
+    assert (forest.predict(X_test.values[:1]) == rf.predict(X_test.iloc[:1])).all()
+
+
+@pytest.mark.parametrize('filename', ['forest.npz', 'forest.forest'])
+def test_flat_forest_save_load(tmp_path, filename):
+    """
+    Test that a saved flattened forest loads back with identical predictions
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    rf, _, X_test, _, _ = train_model(data, ['total_day_minutes', 'customer_service_calls'], 'churn', 0.2, 42)
+    forest = compile_forest(rf)
+    forest.save(str(tmp_path / filename))
+    loaded = FlatForest.load(str(tmp_path / filename))
+    assert np.array_equal(loaded.predict_proba(X_test.values), rf.predict_proba(X_test))
+    assert list(loaded.classes_) == list(rf.classes_)
+
+
+def test_flat_forest_memory_mapped_checks(tmp_path):
+    """
+    Test that a forest file is mapped read-only and rejected if it is corrupt or of another format version
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    rf, _, _, _, _ = train_model(data, ['total_day_minutes', 'customer_service_calls'], 'churn', 0.2, 42)
+    path = str(tmp_path / 'rf_model_flat.forest')
+    compile_forest(rf).save(path)
+    loaded = FlatForest.load(path)
+    assert not loaded.value.flags.writeable and not loaded.feature.flags.owndata
+    digest = content_digest(path)
+    with open(path, 'rb') as f:
+        content = bytearray(f.read())
+    corrupt = content.copy()
+    corrupt[-1] ^= 1
+    with open(path, 'wb') as f:
+        f.write(corrupt)
+    # the header still claims the old arrays: same version, and the load refuses the file
+    assert content_digest(path) == digest
+    with pytest.raises(ValueError, match='integrity'):
+        FlatForest.load(path)
+    with open(path, 'wb') as f:
+        f.write(content.replace(b'"format_version": 1', b'"format_version": 9'))
+    with pytest.raises(ValueError, match='format version'):
+        FlatForest.load(path)
+
+
+def test_flat_forest_invalid_shape():
+    """
+    Test that the flattened forest rejects input with the wrong number of features
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    rf, _, _, _, _ = train_model(data, ['total_day_minutes', 'customer_service_calls'], 'churn', 0.2, 42)
+    with pytest.raises(ValueError):
+        compile_forest(rf).predict_proba(np.zeros((1, 3)))
+
+
+def test_micro_batcher_coalesces_requests():
+    """
+    Test that concurrent submissions are scored in shared batches and each caller gets its own row back
+    """
+    calls = []
+
+    def score(X):
+        calls.append(len(X))
+        return X * 2
+
+    batcher = MicroBatcher(score, max_batch_size=8, max_wait_ms=50)
+    futures = [batcher.submit(np.array([[float(i)]])) for i in range(8)]
+    results = [future.result(timeout=5) for future in futures]
+    assert [result.tolist() for result in results] == [[float(i) * 2] for i in range(8)]
+    assert sum(calls) == 8
+    assert len(calls) < 8
+    assert batcher.stats()['requests'] == 8
+
+
+def test_micro_batcher_propagates_errors():
+    """
+    Test that a failing model call is raised to every caller of the batch
+    """
+    def score(X):
+        raise ValueError('bad input')
+
+    batcher = MicroBatcher(score, max_batch_size=4, max_wait_ms=1)
+    with pytest.raises(ValueError):
+        batcher.predict_proba(np.zeros((1, 2)), timeout=5)
+
+
+def test_micro_batcher_scores_rows_with_their_own_model():
+    """
+    Test that rows submitted with different models in one batch are each scored by their own model
+    """
+    class Model:
+        def __init__(self, factor):
+            self.factor = factor
+            self.calls = 0
+
+        def predict_proba(self, X):
+            self.calls += 1
+            return X * self.factor
+
+    old, new = Model(2), Model(3)
+    batcher = MicroBatcher(max_batch_size=8, max_wait_ms=50)
+    futures = [batcher.submit(np.array([[float(i)]]), model=old if i % 2 else new) for i in range(6)]
+    results = [future.result(timeout=5)[0] for future in futures]
+    assert results == [float(i) * (2 if i % 2 else 3) for i in range(6)]
+    assert old.calls == new.calls == batcher.stats()['batches'] == 1
+    with pytest.raises(ValueError):
+        batcher.submit(np.zeros((1, 1)))
+
+
+def test_write_behind_writes_waiting_records_in_batches(tmp_path):
+    """
+    Test that records queued while a write is in progress are upserted together with the next write
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    writing, release = threading.Event(), threading.Event()
+    batches = []
+
+    def write(records):
+        writing.set()
+        release.wait(5)
+        batches.append(len(records))
+        cm.upsert_customers(records)
+
+    columns = [col.name for col in Customer.__table__.columns]
+    customers = pd.read_csv('test/unit_test_data/final_data_test.csv')[columns].head(10).to_dict(orient='records')
+    write_behind = WriteBehindQueue(write, max_batch_size=500)
+    assert write_behind.submit(customers[0])
+    assert writing.wait(5)
+    for customer in customers[1:]:
+        write_behind.submit(customer)
+    release.set()
+    write_behind.close()
+    assert batches == [1, 9]
+    assert cm.session.query(Customer).count() == 10
+    assert write_behind.stats()['written'] == 10
+    cm.close()
+
+
+@pytest.mark.parametrize('overflow', ['block', 'reject', 'drop'])
+def test_write_behind_backpressure(overflow):
+    """
+    Test that a full queue blocks, rejects or drops records by policy and that a failed write is retried
+    """
+    writing, release = threading.Event(), threading.Event()
+    written, attempts = [], []
+
+    def write(records):
+        writing.set()
+        release.wait(5)
+        attempts.append(len(records))
+        if len(attempts) == 1:
+            raise sqlalchemy.exc.OperationalError('INSERT', {}, Exception('database is locked'))
+        written.extend(records)
+
+    write_behind = WriteBehindQueue(write, max_queue_depth=2, overflow=overflow, submit_timeout=0.05,
+                                    retry_interval=0.01)
+    write_behind.submit({'id': 0})
+    assert writing.wait(5)
+    assert write_behind.submit({'id': 1}) and write_behind.submit({'id': 2})
+    if overflow == 'drop':
+        assert not write_behind.submit({'id': 3})
+    else:
+        with pytest.raises(queue.Full):
+            write_behind.submit({'id': 3})
+    release.set()
+    write_behind.close()
+    assert [record['id'] for record in written] == [0, 1, 2]
+    stats = write_behind.stats()
+    assert (stats['rejected'], stats['dropped']) == ((0, 1) if overflow == 'drop' else (1, 0))
+    assert stats['failed'] == 0
+
+
+def test_write_behind_flushes_full_batches_before_the_interval():
+    """
+    Test that a full batch is written without waiting for the flush interval, and the rest when the queue closes
+    """
+    batches, full_batch = [], threading.Event()
+
+    def write(records):
+        batches.append([record['id'] for record in records])
+        full_batch.set()
+
+    write_behind = WriteBehindQueue(write, max_batch_size=3, flush_interval_ms=60000)
+    for i in range(4):
+        write_behind.submit({'id': i})
+    assert full_batch.wait(5)
+    write_behind.close(timeout=5)
+    assert batches == [[0, 1, 2], [3]]
+
+
+def test_write_behind_replays_log_of_crashed_process(tmp_path):
+    """
+    Test that records a crashed process accepted but never wrote are replayed from its write-ahead log, once
+    """
+    wal_dir = str(tmp_path / 'wal')
+    crash = ('import os, threading\n'
+             'from src.write_behind import WriteBehindQueue\n'
+             f'write_behind = WriteBehindQueue(lambda records: threading.Event().wait(), wal_dir={wal_dir!r})\n'
+             'for i in range(5):\n'
+             '    write_behind.submit({"id": i})\n'
+             'os._exit(1)\n')
+    assert subprocess.run([sys.executable, '-c', crash], check=False).returncode == 1
+
+    written = []
+    write_behind = WriteBehindQueue(written.extend, wal_dir=wal_dir)
+    write_behind.start()
+    write_behind.submit({'id': 5})
+    write_behind.close(timeout=5)
+    assert [record['id'] for record in written] == [0, 1, 2, 3, 4, 5]
+    assert write_behind.stats()['replayed'] == 5
+    assert os.listdir(wal_dir) == []
+
+
+def test_write_behind_does_not_replay_rejected_records(tmp_path):
+    """
+    Test that records the queue rejected are cancelled in the write-ahead log and not replayed after a crash
+    """
+    wal_dir = str(tmp_path / 'wal')
+    crash = ('import os, queue, threading\n'
+             'from src.write_behind import WriteBehindQueue\n'
+             'writing = threading.Event()\n'
+             'def write(records):\n'
+             '    writing.set()\n'
+             '    threading.Event().wait()\n'
+             f'write_behind = WriteBehindQueue(write, max_queue_depth=2, overflow="reject", wal_dir={wal_dir!r})\n'
+             'write_behind.submit({"id": 0})\n'
+             'writing.wait(5)\n'
+             'for i in range(1, 5):\n'
+             '    try:\n'
+             '        write_behind.submit({"id": i})\n'
+             '    except queue.Full:\n'
+             '        pass\n'
+             'assert write_behind.stats()["rejected"] == 2\n'
+             'os._exit(1)\n')
+    assert subprocess.run([sys.executable, '-c', crash], check=False).returncode == 1
+
+    written = []
+    write_behind = WriteBehindQueue(written.extend, wal_dir=wal_dir)
+    write_behind.start()
+    write_behind.close(timeout=5)
+    assert [record['id'] for record in written] == [0, 1, 2]
+    assert os.listdir(wal_dir) == []
+
+
+def test_write_ahead_log_skips_segments_replayed_by_another_process(tmp_path, monkeypatch):
+    """
+    Test that replay skips segments another process deleted after they were listed, or after they were opened
+    """
+    wal_dir = tmp_path / 'wal'
+    wal_dir.mkdir()
+    for name in ('1.wal', '2.wal', '3.wal'):
+        (wal_dir / name).write_text(json.dumps({'id': name}) + '\n')
+    listed = sorted(glob.glob(str(wal_dir / '*.wal')))
+    os.remove(listed[0])
+    monkeypatch.setattr('src.write_behind.glob.glob', lambda pattern: listed)
+    flock = fcntl.flock
+
+    def replayed_elsewhere(f, operation):
+        # the other process deletes the segment after this one opened it, then releases its lock
+        if f.name == listed[1]:
+            os.remove(f.name)
+        flock(f, operation)
+
+    monkeypatch.setattr('src.write_behind.fcntl.flock', replayed_elsewhere)
+    written = []
+    assert WriteAheadLog(str(wal_dir)).replay(written.extend, batch_size=10) == 1
+    assert written == [{'id': '3.wal'}]
+
+
+def test_write_behind_keeps_writing_when_replay_fails(tmp_path, monkeypatch):
+    """
+    Test that a write-ahead log that cannot be replayed does not stop the queue from writing new records
+    """
+    def fail(*args):
+        raise OSError('disk error')
+
+    monkeypatch.setattr(WriteAheadLog, 'replay', fail)
+    written = []
+    write_behind = WriteBehindQueue(written.extend, wal_dir=str(tmp_path / 'wal'))
+    write_behind.submit({'id': 0})
+    write_behind.close(timeout=5)
+    assert written == [{'id': 0}]
+
+
+def test_write_behind_close_gives_up_on_a_full_queue():
+    """
+    Test that closing a queue that stays full returns after the timeout instead of blocking
+    """
+    release = threading.Event()
+    write_behind = WriteBehindQueue(lambda records: release.wait(5), max_queue_depth=1, overflow='reject')
+    write_behind.submit({'id': 0})
+    while write_behind.stats()['queue_depth']:
+        time.sleep(0.01)
+    write_behind.submit({'id': 1})
+    start = time.perf_counter()
+    write_behind.close(timeout=0.1)
+    assert time.perf_counter() - start < 1
+    release.set()
+    write_behind.close(timeout=5)
+    assert write_behind.stats()['written'] == 2
+
+
+def test_add_customer_data_streaming(tmp_path):
+    """
+    Test that streaming ingest inserts every row of the csv in chunks and removes its checkpoint
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    n_rows = cm.add_customer_data("test/unit_test_data/final_data_test.csv", chunksize=500,
+                                  checkpoint_path=checkpoint_path)
+    assert n_rows == 2666
+    assert cm.session.query(Customer).count() == 2666
+    assert not os.path.exists(checkpoint_path)
+    cm.close()
+
+
+def test_add_customer_data_resume(tmp_path):
+    """
+    Test that streaming ingest resumes after the rows recorded in its checkpoint
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    input_path = str(tmp_path / 'data.csv')
+    pd.read_csv("test/unit_test_data/final_data_test.csv").to_csv(input_path, index=False)
+    first_rows = str(tmp_path / 'first_rows.csv')
+    pd.read_csv(input_path, nrows=1000).to_csv(first_rows, index=False)
+
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data(first_rows, chunksize=1000)
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    checkpoint = read_checkpoint(checkpoint_path, input_path)
+    checkpoint['rows_committed'] = 1000
+    write_checkpoint(checkpoint_path, checkpoint)
+
+    assert cm.add_customer_data(input_path, chunksize=500, checkpoint_path=checkpoint_path) == 1666
+    assert cm.session.query(Customer).count() == 2666
+    cm.close()
+
+
+def test_add_one_record_upserts(tmp_path):
+    """
+    Test that submitting an existing customer id updates the record instead of raising IntegrityError
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_one_record(1, 'No', 'Yes', 25, 265.1, 197.4, 244.7, 10.0, 3, 1, 'No')
+    cm.add_one_record(1, 'Yes', 'Yes', 25, 265.1, 197.4, 244.7, 10.0, 3, 4, 'Yes')
+    customers = cm.session.query(Customer).all()
+    assert len(customers) == 1
+    assert (customers[0].international_plan, customers[0].customer_service_calls, customers[0].churn) == \
+        ('Yes', 4, 'Yes')
+    cm.close()
+
+
+def test_add_customer_data_rerun(tmp_path):
+    """
+    Test that ingesting the same file twice leaves one row per customer
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv")
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv", chunksize=1000)
+    assert cm.session.query(Customer).count() == 2666
+    cm.close()
+
+
+def test_upsert_statement_mysql():
+    """
+    Test that the MySQL upsert statement updates every non-key column on duplicate keys
+    """
+    statement = upsert_statement(Customer.__table__, 'mysql')
+    sql = str(statement.compile(dialect=sqlalchemy.dialects.mysql.dialect()))
+    assert 'ON DUPLICATE KEY UPDATE' in sql
+    assert 'churn = VALUES(churn)' in sql
+
+
+def test_upsert_statement_mysql_accumulates():
+    """
+    Test that the accumulating MySQL upsert adds the new values to the stored counts and sums
+    """
+    statement = upsert_statement(ChurnSegment.__table__, 'mysql', accumulate=True)
+    sql = str(statement.compile(dialect=sqlalchemy.dialects.mysql.dialect()))
+    assert 'customers = (churn_segments.customers + VALUES(customers))' in sql
+
+
+def test_churn_segments_match_rebuild(tmp_path):
+    """
+    Test that churn_segments kept up to date on every write equals rebuilding it from the churn table, including
+    records that overwrite existing customers and repeat an id within one batch
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv", chunksize=1000)
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    records = data.head(3).to_dict(orient='records')
+    cm.upsert_customers([{**records[0], 'churn': 'Yes', 'customer_service_calls': 7},
+                         {**records[1], 'international_plan': 'Yes'},
+                         {**records[0], 'voice_mail_plan': 'No', 'customer_service_calls': 0}])
+    cm.add_one_record(int(records[2]['id']), 'Yes', 'Yes', 25, 265.1, 197.4, 244.7, 10.0, 3, 2, 'Yes')
+
+    def snapshot():
+        return {(s.international_plan, s.voice_mail_plan, s.min_service_calls):
+                [s.customers, s.churned] + [round(getattr(s, f'sum_{col}'), 6) for col in SEGMENT_SUMS]
+                for s in cm.session.query(ChurnSegment)}
+
+    incremental = snapshot()
+    assert cm.rebuild_segments() == len(incremental)
+    assert snapshot() == incremental
+    totals, = cm.segment_stats(by=[])
+    assert totals['customers'] == 2666
+    assert totals['churned'] == cm.session.query(Customer).filter(Customer.churn == 'Yes').count()
+    cm.close()
+
+
+def test_upsert_customers_locks_segments_before_reading_customers(tmp_path):
+    """
+    Test that an upsert creates the segments it joins in a commit of its own and locks every segment before it
+    reads the customers it replaces, so concurrent writers of the same new customer take turns
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    record = pd.read_csv("test/unit_test_data/final_data_test.csv").head(1).to_dict(orient='records')[0]
+    statements = []
+    sqlalchemy.event.listen(cm.session.get_bind(), 'before_cursor_execute',
+                            lambda conn, cursor, statement, *args: statements.append(' '.join(statement.split())))
+    sqlalchemy.event.listen(cm.session.get_bind(), 'commit', lambda conn: statements.append('COMMIT'))
+    cm.upsert_customers([record])
+    assert [statement.split()[0] for statement in statements] == ['INSERT', 'COMMIT', 'SELECT', 'SELECT', 'INSERT',
+                                                                  'INSERT', 'COMMIT']
+    assert statements[0].startswith('INSERT INTO churn_segments')
+    assert statements[2].endswith('FROM churn_segments ORDER BY churn_segments.international_plan, '
+                                  'churn_segments.voice_mail_plan, churn_segments.min_service_calls')
+    assert statements[3].startswith('SELECT churn.id')
+    assert cm.segment_stats(by=[])[0]['customers'] == 1
+    cm.close()
+
+
+def test_segment_stats_by_dimension(tmp_path):
+    """
+    Test that segment statistics roll up to the requested dimensions and reject unknown ones
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv")
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    segments = cm.segment_stats(by=['international_plan'])
+    expected = (data['churn'] == 'Yes').groupby(data['international_plan']).mean().round(4).to_dict()
+    assert {s['international_plan']: s['churn_rate'] for s in segments} == expected
+    labels = {s['service_calls'] for s in cm.segment_stats(by=['service_calls'])}
+    assert labels <= {'0', '1', '2', '3', '4+'}
+    with pytest.raises(ValueError):
+        cm.segment_stats(by=['state'])
+    cm.close()
+
+
+def test_list_customers_keyset_pages(tmp_path):
+    """
+    Test that following the keyset cursor visits every filtered customer exactly once in id order
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv")
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    expected = data[(data['churn'] == 'Yes') & (data['customer_service_calls'] >= 2)]['id'].tolist()
+
+    ids, after_id = [], None
+    while True:
+        customers, after_id = cm.list_customers(50, after_id=after_id, churn='Yes', min_service_calls=2)
+        ids.extend(customer.id for customer in customers)
+        if after_id is None:
+            break
+    assert ids == expected
+    cm.close()
+
+
+def test_create_db_adds_missing_indexes(tmp_path):
+    """
+    Test that create_db adds the listing indexes to a churn table created without them
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    engine = sqlalchemy.create_engine(engine_string)
+    engine.execute('CREATE TABLE churn (id INTEGER PRIMARY KEY, churn VARCHAR(3), international_plan VARCHAR(3), '
+                   'voice_mail_plan VARCHAR(3), customer_service_calls INTEGER)')
+    create_db(engine_string)
+    names = {index['name'] for index in sqlalchemy.inspect(engine).get_indexes('churn')}
+    assert {index.name for index in Customer.__table__.indexes} <= names
+
+
+def test_engine_options_by_backend():
+    """
+    Test that server databases get an instrumented queue pool and SQLite keeps its default pool
+    """
+    options = engine_options('mysql+pymysql://user:pw@host:3306/db', pool_size=3, pool_recycle=600)
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert options['pool_size'] == 3 and options['pool_recycle'] == 600 and options['pool_pre_ping']
+    assert engine_options('sqlite:///data/customer.db') == {'pool_pre_ping': True}
+
+
+def test_instrumented_pool_counts_waits_and_timeouts(tmp_path):
+    """
+    Test that a checkout from an exhausted pool is counted as a wait and a timeout
+    """
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "churn.db"}', poolclass=InstrumentedQueuePool,
+                                      pool_size=1, max_overflow=0, pool_timeout=0.05,
+                                      connect_args={'check_same_thread': False})
+    connection = engine.connect()
+    with pytest.raises(sqlalchemy.exc.TimeoutError):
+        engine.connect()
+    stats = engine.pool.stats()
+    assert (stats['checked_out'], stats['checkouts'], stats['waits'], stats['timeouts']) == (1, 1, 1, 1)
+    connection.close()
+    assert engine.pool.stats()['checked_out'] == 0
+
+
+def test_churn_manager_scoped_sessions(tmp_path):
+    """
+    Test that each thread gets its own session and close removes the session of the calling thread
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    session = cm.session()
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(cm.session()))
+    thread.start()
+    thread.join()
+    assert sessions[0] is not session
+    assert cm.session() is session
+    cm.close()
+    assert cm.session() is not session
+    assert cm.pool_stats()['pool'] == 'NullPool'
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    """
+    Local s3 stand-in with an empty bucket; the shared client is recreated inside the mock
+    """
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        reset_s3_client()
+        get_s3_client().create_bucket(Bucket='churn-test')
+        yield 'churn-test'
+    reset_s3_client()
+
+
+def test_s3_upload_skips_unchanged(s3_bucket, tmp_path):
+    """
+    Test that a multipart upload stores the locally computed ETag and an unchanged file is not uploaded again
+    """
+    local_path = tmp_path / 'raw_data.csv'
+    local_path.write_bytes(os.urandom(11 * 1024 * 1024))
+    s3path = f's3://{s3_bucket}/raw/raw_data.csv'
+    assert upload_file_to_s3(str(local_path), s3path, chunk_size_mb=5)
+    head = get_s3_client().head_object(Bucket=s3_bucket, Key='raw/raw_data.csv')
+    assert head['ETag'].strip('"') == local_etag(str(local_path), 5 * 1024 * 1024)
+    assert not upload_file_to_s3(str(local_path), s3path, chunk_size_mb=5)
+    assert upload_file_to_s3(str(local_path), s3path, chunk_size_mb=5, force=True)
+
+
+def test_s3_download_skips_unchanged(s3_bucket, tmp_path):
+    """
+    Test that a download is skipped while the object and the local copy are unchanged
+    """
+    get_s3_client().put_object(Bucket=s3_bucket, Key='raw/raw_data.csv', Body=b'id,churn\n1,No\n')
+    local_path = str(tmp_path / 'raw' / 'raw_data.csv')
+    s3path = f's3://{s3_bucket}/raw/raw_data.csv'
+    assert download_file_from_s3(local_path, s3path)
+    assert not download_file_from_s3(local_path, s3path)
+    get_s3_client().put_object(Bucket=s3_bucket, Key='raw/raw_data.csv', Body=b'id,churn\n1,Yes\n')
+    assert download_file_from_s3(local_path, s3path)
+    with open(local_path, 'rb') as f:
+        assert f.read() == b'id,churn\n1,Yes\n'
+
+
+def test_s3_sync_prefix(s3_bucket, tmp_path):
+    """
+    Test that syncing a prefix mirrors all objects and transfers only what changed on the next sync
+    """
+    for key in ['raw/a.csv', 'raw/b.csv', 'raw/nested/c.csv', 'other/d.csv']:
+        get_s3_client().put_object(Bucket=s3_bucket, Key=key, Body=key.encode())
+    local_dir = str(tmp_path / 'raw')
+    assert sync_prefix(local_dir, f's3://{s3_bucket}/raw') == {'transferred': 3, 'skipped': 0}
+    assert os.path.exists(os.path.join(local_dir, 'nested', 'c.csv'))
+    get_s3_client().put_object(Bucket=s3_bucket, Key='raw/b.csv', Body=b'changed')
+    assert sync_prefix(local_dir, f's3://{s3_bucket}/raw/') == {'transferred': 1, 'skipped': 2}
+    assert sync_prefix(local_dir, f's3://{s3_bucket}/copy/', direction='upload') == {'transferred': 3, 'skipped': 0}
+
+
+@pytest.mark.parametrize('s3path, expected', [
+    ('s3://bucket/raw/date=2024-01/x.csv', ('bucket', 'raw/date=2024-01/x.csv')),
+    ('s3://bucket/raw/my file.csv', ('bucket', 'raw/my file.csv')),
+    ('s3://my.bucket/', ('my.bucket', ''))])
+def test_parse_s3_keeps_whole_key(s3path, expected):
+    """
+    Test that parsing an s3 path keeps every character of the key
+    """
+    assert parse_s3(s3path) == expected
+
+
+def test_s3_sync_prefix_keys_with_special_characters(s3_bucket, tmp_path):
+    """
+    Test that keys with characters such as = or spaces are synced under their full name in both directions
+    """
+    keys = ['raw/date=2024-01/x.csv', 'raw/my file.csv', 'raw/a+b.csv']
+    for key in keys:
+        get_s3_client().put_object(Bucket=s3_bucket, Key=key, Body=key.encode())
+    local_dir = str(tmp_path / 'raw')
+    assert sync_prefix(local_dir, f's3://{s3_bucket}/raw/') == {'transferred': 3, 'skipped': 0}
+    with open(os.path.join(local_dir, 'date=2024-01', 'x.csv'), 'rb') as f:
+        assert f.read() == b'raw/date=2024-01/x.csv'
+    assert sync_prefix(local_dir, f's3://{s3_bucket}/copy/', direction='upload') == {'transferred': 3, 'skipped': 0}
+    listed = get_s3_client().list_objects_v2(Bucket=s3_bucket, Prefix='copy/')['Contents']
+    assert sorted(obj['Key'] for obj in listed) == sorted(key.replace('raw/', 'copy/', 1) for key in keys)
+
+
+def test_get_s3_client_per_pool_size(s3_bucket):
+    """
+    Test that clients are shared per connection pool size
+    """
+    assert get_s3_client(64) is get_s3_client(64)
+    assert get_s3_client(64) is not get_s3_client()
+    assert get_s3_client(64).meta.config.max_pool_connections == 64
+
+
+def _word_count_pipeline(tmp_path, calls, config=None):
+    source, counts, report = (str(tmp_path / name) for name in ['source.txt', 'counts.json', 'report.txt'])
+
+    def count(state):
+        calls.append('count')
+        with open(source, encoding='utf8') as f:
+            n_words = len(f.read().split())
+        with open(counts, 'w', encoding='utf8') as f:
+            f.write(str(n_words))
+        return {'n_words': n_words}
+
+    def write_report(state):
+        calls.append('report')
+        if 'n_words' not in state:
+            with open(counts, encoding='utf8') as f:
+                state = {'n_words': int(f.read())}
+        with open(report, 'w', encoding='utf8') as f:
+            f.write(f"{state['n_words']} words")
+
+    steps = [Step('report', write_report, inputs=[counts], outputs=[report], requires=['count']),
+             Step('count', count, inputs=[source], outputs=[counts], config=config)]
+    return Pipeline(steps, str(tmp_path / 'manifest.json')), source, report
+
+
+def test_histogram_quantiles():
+    """
+    Test that quantiles read off the logarithmic buckets are within 10% of the exact ones
+    """
+    latencies = np.random.default_rng(0).lognormal(mean=-7, sigma=1, size=10000)
+    histogram = Histogram()
+    for latency in latencies:
+        histogram.observe(latency)
+    for q in (0.5, 0.95, 0.99):
+        assert abs(histogram.quantile(q) / np.quantile(latencies, q) - 1) < 0.1
+    assert histogram.quantile(1.0) == latencies.max()
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_metrics_stages_and_prometheus_export():
+    """
+    Test that stages count records and errors, and that the export follows the Prometheus text format
+    """
+    registry = Metrics()
+    with registry.stage('validation', records=10):
+        pass
+    with pytest.raises(ValueError):
+        with registry.stage('validation'):
+            raise ValueError('invalid')
+    registry.inc('churn_http_requests_total', endpoint='/predict', method='POST', status=200)
+    snapshot = registry.snapshot()
+    assert {(c['name'], c['value']) for c in snapshot['counters']} == {
+        ('churn_stage_records_total', 10), ('churn_stage_errors_total', 1), ('churn_http_requests_total', 1)}
+    assert snapshot['histograms'][0]['count'] == 2
+    text = registry.to_prometheus()
+    assert '# TYPE churn_stage_seconds summary' in text
+    assert 'churn_stage_seconds_count{stage="validation"} 2' in text
+    assert 'churn_stage_seconds{stage="validation",quantile="0.99"}' in text
+    assert 'churn_http_requests_total{endpoint="/predict",method="POST",status="200"} 1' in text
+    registry.reset()
+    assert registry.snapshot()['counters'] == []
+
+
+def test_pipeline_skips_up_to_date_steps(tmp_path):
+    """
+    Test that steps run in dependency order and are skipped until an input, the config or an output changes
+    """
+    calls = []
+    pipeline, source, report = _word_count_pipeline(tmp_path, calls)
+    with open(source, 'w', encoding='utf8') as f:
+        f.write('one two three')
+    assert [t['status'] for t in pipeline.run()] == ['ran', 'ran']
+    assert calls == ['count', 'report']
+    # a new process reads the manifest left by the previous run
+    pipeline, source, report = _word_count_pipeline(tmp_path, calls)
+    assert [t['status'] for t in pipeline.run()] == ['skipped', 'skipped']
+    with open(report, 'w', encoding='utf8') as f:
+        f.write('tampered')
+    assert [t['status'] for t in pipeline.run()] == ['skipped', 'ran']
+    with open(source, 'w', encoding='utf8') as f:
+        f.write('one two three four')
+    assert [t['status'] for t in pipeline.run()] == ['ran', 'ran']
+    with open(report, encoding='utf8') as f:
+        assert f.read() == '4 words'
+    pipeline, _, _ = _word_count_pipeline(tmp_path, calls, config={'lowercase': True})
+    assert [t['status'] for t in pipeline.run(['count'])] == ['ran']
+    assert [t['status'] for t in pipeline.run(force=True)] == ['ran', 'ran']
+
+
+def test_pipeline_dumps_metrics_per_step(tmp_path):
+    """
+    Test that every step that runs writes its own metrics, timed by stage
+    """
+    def count(state):
+        with metrics.stage('encoding', records=3):
+            pass
+        with open(tmp_path / 'counts.txt', 'w', encoding='utf8') as f:
+            f.write('3')
+
+    metrics_dir = tmp_path / 'metrics'
+    pipeline = Pipeline([Step('count', count, outputs=[str(tmp_path / 'counts.txt')])],
+                        str(tmp_path / 'manifest.json'), metrics_dir=str(metrics_dir))
+    pipeline.run()
+    with open(metrics_dir / 'count.json', encoding='utf8') as f:
+        dump = json.load(f)
+    assert dump['step'] == 'count' and dump['status'] == 'ran'
+    assert dump['counters'] == [{'name': 'churn_stage_records_total', 'labels': {'stage': 'encoding'}, 'value': 3}]
+    assert {h['name'] for h in dump['histograms']} == {'churn_pipeline_step_seconds', 'churn_stage_seconds'}
+
+
+def test_pipeline_rejects_cycles():
+    """
+    Test that steps depending on each other in a cycle are rejected
+    """
+    with pytest.raises(ValueError):
+        Pipeline([Step('a', lambda state: None, requires=['b']), Step('b', lambda state: None, requires=['a'])],
+                 'unused.json')
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather', 'csv'])
+def test_save_load_table_projection(tmp_path, fmt):
+    """
+    Test that tables round trip through every artifact format and that reads can be limited to some columns
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    path = artifact_path(str(tmp_path), 'final_data', fmt)
+    save_table(data, path)
+    pd.testing.assert_frame_equal(load_table(path), data)
+    assert list(load_table(path, columns=['id', 'churn']).columns) == ['id', 'churn']
+
+
+def test_save_train_test_keeps_dummy_dtypes(tmp_path):
+    """
+    Test that train/test data saved as parquet keep the dtypes of the dummy columns and the target name
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    _, X_train, X_test, y_train, y_test = train_model(data, ['international_plan', 'voice_mail_plan',
+                                                             'number_vmail_messages'], 'churn', 0.2, 42)
+    paths = [str(tmp_path / f'{name}.parquet') for name in ['X_train', 'X_test', 'y_train', 'y_test']]
+    save_train_test(X_train, X_test, y_train, y_test, *paths)
+    assert (load_table(paths[0]).dtypes == X_train.dtypes.values).all()
+    assert load_table(paths[3])['churn'].tolist() == y_test.tolist()
+    with pytest.raises(ValueError):
+        save_table(X_train, str(tmp_path / 'X_train.xlsx'))
+
+
+def test_clean_data_streaming_matches_in_memory(tmp_path):
+    """
+    Test that streaming cleaning writes the same rows as cleaning in memory, projected and downcast
+    """
+    raw_path = "test/unit_test_data/raw_data_test.csv"
+    columns = ['id', 'international_plan', 'total_day_minutes', 'customer_service_calls', 'churn']
+    paths = [str(tmp_path / 'final_data.parquet'), str(tmp_path / 'final_data.csv')]
+    profile = clean_data_streaming(raw_path, paths, 'churn', chunksize=500, columns=columns)
+    assert (profile['rows'], profile['chunks']) == (2666, 6)
+    expected = clean_data(pd.read_csv(raw_path, usecols=columns), 'churn')
+    streamed = load_table(paths[0])
+    assert streamed['total_day_minutes'].dtype == np.float32 and streamed['id'].dtype == np.int32
+    pd.testing.assert_frame_equal(streamed, expected.astype(compact_dtypes(expected)))
+    assert load_table(paths[1])['churn'].tolist() == expected['churn'].tolist()
+
+
+def test_clean_data_streaming_memory_is_bounded(tmp_path):
+    """
+    Test that the peak memory of streaming cleaning does not grow with the size of the raw file
+    """
+    raw = pd.read_csv("test/unit_test_data/raw_data_test.csv")
+    small_path, large_path = str(tmp_path / 'small.csv'), str(tmp_path / 'large.csv')
+    raw.to_csv(small_path, index=False)
+    pd.concat([raw] * 8).to_csv(large_path, index=False)
+    small = clean_data_streaming(small_path, [str(tmp_path / 'small.parquet')], 'churn', chunksize=1000)
+    large = clean_data_streaming(large_path, [str(tmp_path / 'large.parquet')], 'churn', chunksize=1000)
+    assert large['rows'] == 8 * small['rows']
+    assert large['peak_traced_mb'] < 1.5 * small['peak_traced_mb'] + 1
+
+
+def _raw_dtypes():
+    with open('config/config.yaml', 'r', encoding='utf8') as f:
+        return parse_dtypes(yaml.load(f, Loader=yaml.FullLoader)['schema']['raw_data'])
+
+
+def test_read_csv_with_schema_compact_dtypes():
+    """
+    Test that the raw data is read straight into the declared dtypes with a fraction of the default memory
+    """
+    raw_path = "test/unit_test_data/raw_data_test.csv"
+    data = read_csv_with_schema(raw_path, _raw_dtypes())
+    default = pd.read_csv(raw_path)
+    assert data['total_day_minutes'].dtype == np.float32 and data['customer_service_calls'].dtype == np.int8
+    assert list(data['international_plan'].cat.categories) == ['No', 'Yes']
+    assert data['account_length'].tolist() == default['account_length'].tolist()
+    assert data.memory_usage(deep=True).sum() * 3 < default.memory_usage(deep=True).sum()
+
+
+@pytest.mark.parametrize('drift', ['missing_column', 'extra_column', 'overflow', 'not_numeric', 'unknown_level'])
+def test_read_csv_with_schema_rejects_drift(tmp_path, drift):
+    """
+    Test that files that do not fit the declared schema are rejected instead of silently converted
+    """
+    data = pd.read_csv("test/unit_test_data/raw_data_test.csv").head(20)
+    if drift == 'missing_column':
+        data = data.drop(columns='area_code')
+    elif drift == 'extra_column':
+        data['region'] = 'west'
+    elif drift == 'overflow':
+        data.loc[3, 'customer_service_calls'] = 300
+    elif drift == 'not_numeric':
+        data['total_day_calls'] = data['total_day_calls'].astype(str)
+        data.loc[3, 'total_day_calls'] = 'n/a'
+    else:
+        data.loc[3, 'voice_mail_plan'] = 'Maybe'
+    path = str(tmp_path / 'raw_data.csv')
+    data.to_csv(path, index=False)
+    with pytest.raises(ValueError, match='Schema drift'):
+        read_csv_with_schema(path, _raw_dtypes())
+    with pytest.raises(ValueError, match='Schema drift'):
+        list(iter_csv_with_schema(path, _raw_dtypes(), chunksize=5))
+
+
+def test_enforce_schema_checks_dataframes():
+    """
+    Test that dataframes are downcast to the declared dtypes and rejected if they do not fit
+    """
+    dtypes = parse_dtypes({'calls': 'int8', 'minutes': 'float32', 'churn': ['No', 'Yes']})
+    data = enforce_schema(pd.DataFrame({'calls': [1, 2], 'minutes': [1.5, 2.0], 'churn': ['No', 'Yes']}), dtypes)
+    assert list(data.dtypes.astype(str)) == ['int8', 'float32', 'category']
+    with pytest.raises(ValueError):
+        enforce_schema(pd.DataFrame({'calls': [1.5]}), dtypes)
+    with pytest.raises(ValueError):
+        enforce_schema(pd.DataFrame({'churn': ['no']}), dtypes)
+
+
+def test_add_customer_data_with_schema(tmp_path):
+    """
+    Test that ingest checks the declared dtypes and still stores the exact float values
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    with open('config/config.yaml', 'r', encoding='utf8') as f:
+        dtypes = parse_dtypes(yaml.load(f, Loader=yaml.FullLoader)['schema']['cleaned_data'])
+    cm = ChurnManager(engine_string=engine_string)
+    assert cm.add_customer_data("test/unit_test_data/final_data_test.csv", chunksize=1000, dtypes=dtypes) == 2666
+    assert cm.session.query(Customer).get(1).total_day_minutes == 265.1
+    cm.close()
+
+
+def test_cli_and_app_startup_do_not_import_sklearn():
+    """
+    Test that the CLI, the database steps and the app start without importing scikit-learn or boto3
+    """
+    code = ('import sys, run, app, src.create_db; '
+            'print(sorted(m for m in ("sklearn", "boto3") if m in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == '[]'
+
+
+def test_cli_exits_non_zero_when_a_step_input_is_missing(tmp_path):
+    """
+    Test that run.py exits with an error, and records the step as failed, when a pipeline step's input is missing
+    """
+    with open('config/config.yaml', 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    config['pipeline']['manifest_path'] = str(tmp_path / 'pipeline_manifest.json')
+    config['metrics']['dump_dir'] = str(tmp_path / 'metrics')
+    config_path = tmp_path / 'config.yaml'
+    with open(config_path, 'w', encoding='utf8') as f:
+        yaml.safe_dump(config, f)
+    result = subprocess.run([sys.executable, 'run.py', 'evaluate', '--config', str(config_path),
+                             '--model_dir', str(tmp_path), '--pred_result_dir', str(tmp_path),
+                             '--y_test_dir', str(tmp_path), '--model_eval_dir', str(tmp_path)],
+                            capture_output=True, text=True, check=False)
+    assert result.returncode == 1
+    with open(tmp_path / 'metrics' / 'evaluate.json', 'r', encoding='utf8') as f:
+        assert json.load(f)['status'] == 'failed'
+
+
+def test_pipeline_steps_do_not_import_sklearn_before_they_need_it(tmp_path):
+    """
+    Test that building the model pipeline, as acquire_data does, imports neither pandas, scikit-learn nor boto3,
+    and that clean_data runs without scikit-learn and boto3
+    """
+    shutil.copy("test/unit_test_data/raw_data_test.csv", tmp_path / 'raw_data.csv')
+    code = (
+        'import argparse, sys, yaml, run\n'
+        f'tmp = {str(tmp_path)!r}\n'
+        'with open("config/config.yaml") as f:\n'
+        '    config = yaml.safe_load(f)\n'
+        'config["pipeline"]["manifest_path"] = tmp + "/manifest.json"\n'
+        'config["metrics"]["dump_dir"] = None\n'
+        'dirs = ["raw_data_dir", "cleaned_data_dir", "model_dir", "X_train_dir", "X_test_dir", "y_train_dir",'
+        ' "y_test_dir", "pred_result_dir", "model_eval_dir"]\n'
+        'args = argparse.Namespace(s3_path="s3://bucket/raw_data.csv", force=False, chunksize=None, n_jobs=1,'
+        ' **{name: tmp for name in dirs})\n'
+        'pipeline = run.build_pipeline(args, config)\n'
+        'print(sorted(m for m in ("pandas", "sklearn", "boto3") if m in sys.modules))\n'
+        'pipeline.run(["clean_data"])\n'
+        'print(sorted(m for m in ("sklearn", "boto3") if m in sys.modules))\n')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-2:] == ['[]', '[]']
+    assert (tmp_path / 'final_data.parquet').exists()
+
+
+def test_sample_candidates_from_search_space():
+    """
+    Test that candidates are distinct, reproducible and drawn from the declared choices and ranges
+    """
+    space = {'max_depth': [None, 5], 'min_samples_leaf': {'low': 1, 'high': 10},
+             'max_samples': {'low': 0.1, 'high': 1.0, 'log': True}}
+    candidates = sample_candidates(space, 10, 42)
+    assert candidates == sample_candidates(space, 10, 42)
+    assert len({str(c) for c in candidates}) == 10
+    for c in candidates:
+        assert c['max_depth'] in (None, 5)
+        assert isinstance(c['min_samples_leaf'], int) and 1 <= c['min_samples_leaf'] <= 10
+        assert 0.1 <= c['max_samples'] <= 1.0
+    # only two distinct combinations exist
+    assert len(sample_candidates({'max_depth': [None, 5]}, 10, 42)) == 2
+
+
+def test_search_resumes_from_fold_cache(tmp_path):
+    """
+    Test that halving search keeps the best candidates, returns fitting hyperparameters and reuses cached folds
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv").head(600)
+    X_train, _, y_train, _ = split_data(data, ['total_day_minutes', 'customer_service_calls'], 'churn', 0.2, 42)
+    space = {'max_depth': [3, 5, None], 'min_samples_leaf': {'low': 1, 'high': 5}}
+    cache_path = str(tmp_path / 'tuning_cache.jsonl')
+    best, results = search(X_train, y_train, space, n_candidates=4, n_splits=3, min_resource=5, max_resource=20,
+                           cache_path=cache_path)
+    assert results.groupby('round').size().tolist() == [4, 2, 1]
+    assert best['n_estimators'] == 20 and set(best) == {'max_depth', 'min_samples_leaf', 'n_estimators'}
+    assert len(FoldCache(cache_path).scores) == 3 * (4 + 2 + 1)
+    rf, _, _, _, _ = train_model(data, ['total_day_minutes', 'customer_service_calls'], 'churn', 0.2, 42,
+                                 model_params=best)
+    assert rf.n_estimators == 20 and rf.max_depth == best['max_depth']
+    # a rerun fits nothing and finds the same best candidate
+    with open(cache_path, 'a', encoding='utf8') as f:
+        f.write('{"key": "interrupted')
+    rerun_best, rerun_results = search(X_train, y_train, space, n_candidates=4, n_splits=3, min_resource=5,
+                                       max_resource=20, cache_path=cache_path)
+    assert rerun_best == best
+    pd.testing.assert_frame_equal(rerun_results, results)
+
+
+def test_resolve_n_jobs():
+    """
+    Test that n_jobs settings are turned into core counts like scikit-learn does
+    """
+    cpu_count = os.cpu_count()
+    assert resolve_n_jobs(None) == 1 and resolve_n_jobs(4) == 4
+    assert resolve_n_jobs(-1) == cpu_count
+    assert resolve_n_jobs(-2) == max(1, cpu_count - 1)
+
+
+def test_parallel_training_and_sharded_predictions():
+    """
+    Test that multi-core training and predictions sharded across processes match single-core results
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    columns = ['international_plan', 'total_day_minutes', 'customer_service_calls']
+    rf, _, X_test, _, _ = train_model(data, columns, 'churn', 0.2, 42, model_params={'n_estimators': 20})
+    rf_parallel, _, _, _, _ = train_model(data, columns, 'churn', 0.2, 42, model_params={'n_estimators': 20},
+                                          n_jobs=2)
+    # the saved model predicts single records in the app without starting threads
+    assert rf_parallel.n_jobs is None
+    expected = make_predictions(rf, X_test)
+    pd.testing.assert_frame_equal(make_predictions(rf_parallel, X_test, n_jobs=2), expected)
+    pd.testing.assert_frame_equal(make_predictions(rf, X_test, n_jobs=2, shard_rows=100), expected)
+
+
+def test_score_db_versions_scores_like_the_app(tmp_path):
+    """
+    Test that run.py score_db scores with the model and schema the app serves, under the version the app gives them
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    with open('config/config.yaml', 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    modeling = config['modeling']
+    rf, _, _, _, _ = train_model(data, model_params={'n_estimators': 10}, **modeling['train_model'])
+    compile_forest(rf).save(str(tmp_path / modeling['compiled_model_filename']))
+    build_feature_schema(data, modeling['train_model']['used_features']) \
+        .save(str(tmp_path / modeling['feature_schema_filename']))
+    config['create_db']['score_customers']['checkpoint_path'] = str(tmp_path / 'score_checkpoint.json')
+    config['metrics']['dump_dir'] = None
+    config_path = tmp_path / 'config.yaml'
+    with open(config_path, 'w', encoding='utf8') as f:
+        yaml.safe_dump(config, f)
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv", chunksize=1000)
+    subprocess.run([sys.executable, 'run.py', 'score_db', '--config', str(config_path), '--model_dir', str(tmp_path),
+                    '--engine_string', engine_string], check=True)
+
+    registry = ModelRegistry(str(tmp_path / modeling['compiled_model_filename']), str(config_path),
+                             str(tmp_path / modeling['feature_schema_filename']))
+    versions = {score.model_version for score in cm.session.query(ChurnScore)}
+    assert versions == {registry.versioned_model()[2]}
+    assert cm.session.query(ChurnScore).count() == len(data)
+    cm.close()
+
+
+def test_score_customers_resumes_from_checkpoint(tmp_path):
+    """
+    Test that scoring the churn table writes the model's predictions for every customer and resumes after the
+    customer id recorded in its checkpoint
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    columns = ['international_plan', 'voice_mail_plan', 'total_day_minutes', 'customer_service_calls']
+    rf, _, _, _, _ = train_model(data, columns, 'churn', 0.2, 42, model_params={'n_estimators': 10})
+    schema = build_feature_schema(data, columns)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv", chunksize=1000)
+    assert [len(batch) for batch in cm.iter_customer_batches(columns, 1000)] == [1000, 1000, 666]
+
+    checkpoint_path = str(tmp_path / 'score_checkpoint.json')
+    write_checkpoint(checkpoint_path, {'model_version': 'v1', 'last_id': 2000, 'rows_scored': 2000})
+    assert cm.score_customers(rf, schema, 'v1', batch_size=500, checkpoint_path=checkpoint_path) == 666
+    assert not os.path.exists(checkpoint_path)
+    # a checkpoint of another model version is discarded
+    write_checkpoint(checkpoint_path, {'model_version': 'v1', 'last_id': 2000, 'rows_scored': 2000})
+    assert cm.score_customers(rf, schema, 'v2', batch_size=500, checkpoint_path=checkpoint_path) == 2666
+
+    scores = pd.DataFrame([(score.id, score.pred_class, score.pred_proba, score.model_version)
+                           for score in cm.session.query(ChurnScore).order_by(ChurnScore.id)],
+                          columns=['id', 'pred_class', 'pred_proba', 'model_version']).set_index('id')
+    expected = predict_batch(rf, schema, data.set_index('id'))
+    assert (scores['model_version'] == 'v2').all()
+    assert (scores['pred_class'] == expected['pred_class']).all()
+    assert np.allclose(scores['pred_proba'], expected['pred_proba'])
+    cm.close()
+
+
+def test_prediction_cache_lru_ttl_and_versions():
+    """
+    Test that the prediction cache evicts the least recently used vectors, expires old entries and drops all
+    entries when the model version changes
+    """
+    X = np.arange(8, dtype=float).reshape(4, 2)
+    proba = np.array([[0.1, 0.9], [0.2, 0.8], [0.3, 0.7], [0.4, 0.6]])
+    cache = PredictionCache(max_entries=3)
+    cache.put_many('v1', X[:3], proba[:3])
+    cache.get_many('v1', X[:1])
+    cache.put_many('v1', X[3:], proba[3:])
+    found, missing = cache.get_many('v1', X)
+    assert missing == [1] and np.array_equal(found[0], proba[0]) and np.array_equal(found[3], proba[3])
+    assert cache.stats()['evictions'] == 1
+    _, missing = cache.get_many('v2', X)
+    assert missing == [0, 1, 2, 3] and cache.stats()['invalidations'] == 1
+
+    expired = PredictionCache(ttl_seconds=0)
+    expired.put_many('v1', X, proba)
+    assert expired.get_many('v1', X)[1] == [0, 1, 2, 3] and expired.stats()['expirations'] == 4
+
+
+def test_prediction_cache_shared_store_and_predict_batch(tmp_path):
+    """
+    Test that cached batch predictions equal the model's own, are only computed for missed rows, and are shared
+    with other workers through the SQLite store
+    """
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv").head(300)
+    columns = ['international_plan', 'voice_mail_plan', 'total_day_minutes', 'customer_service_calls']
+    rf, _, _, _, _ = train_model(data, columns, 'churn', 0.2, 42, model_params={'n_estimators': 10})
+    schema = build_feature_schema(data, columns)
+    store_path = str(tmp_path / 'cache.db')
+    cache = PredictionCache(store_path=store_path)
+    expected = predict_batch(rf, schema, data)
+    pd.testing.assert_frame_equal(predict_batch(rf, schema, data.head(100), cache=cache, model_version='v1'),
+                                  expected.head(100))
+    pd.testing.assert_frame_equal(predict_batch(rf, schema, data, cache=cache, model_version='v1'), expected)
+    # the first 100 records are hits the second time
+    assert cache.stats()['hits'] >= 100 and cache.stats()['hits'] + cache.stats()['misses'] == 400
+
+    other_worker = PredictionCache(store_path=store_path)
+    pd.testing.assert_frame_equal(predict_batch(rf, schema, data, cache=other_worker, model_version='v1'),
+                                  expected)
+    assert other_worker.stats()['misses'] == 0 and other_worker.stats()['hit_ratio'] == 1.0
+    assert pred_one_record(rf, schema, data.iloc[0].to_dict(), cache=other_worker, model_version='v1') == \
+        expected['pred_class'].iloc[0]
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    """
+    The Flask app on a fresh SQLite database holding the test customers, serving a small forest trained on them
+    """
+    tmp_path = tmp_path_factory.mktemp('app')
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    cm = ChurnManager(engine_string=engine_string)
+    cm.add_customer_data("test/unit_test_data/final_data_test.csv")
+    cm.close()
+    with open('config/config.yaml', 'r') as f:
+        columns = yaml.safe_load(f)['modeling']['train_model']['used_features']
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv")
+    rf, _, _, _, _ = train_model(data, columns, 'churn', 0.2, 42, model_params={'n_estimators': 10})
+    compile_forest(rf).save(str(tmp_path / 'rf_model_flat.npz'))
+    build_feature_schema(data, columns).save(str(tmp_path / 'feature_schema.json'))
+
+    import app  # pylint: disable=import-outside-toplevel
+    app.app.config['SQLALCHEMY_DATABASE_URI'] = engine_string
+    app.registry.model_artifact = Artifact(str(tmp_path / 'rf_model_flat.npz'), load_model_with_schema,
+                                           companions=[str(tmp_path / 'feature_schema.json')])
+    return app
+
+
+def _form(cust_id, **values):
+    """Form of the /predict page for one customer."""
+    return {'id': cust_id, 'IntlPlan': 'on', 'vm_msg': 25, 'day_mins': 265.1, 'eve_mins': 197.4, 'night_mins': 244.7,
+            'intl_mins': 10.0, 'intl_calls': 3, 'service_calls': 1, **values}
+
+
+def test_api_predict_responses(app_module):
+    """
+    Test that /api/predict scores JSON and CSV batches and answers malformed or oversized payloads with JSON errors
+    """
+    client = app_module.app.test_client()
+    data = pd.read_csv("test/unit_test_data/final_data_test.csv").head(5).drop(columns='churn')
+    response = client.post('/api/predict', json=data.to_dict(orient='records'))
+    assert response.status_code == 200
+    assert len(response.get_data(as_text=True).splitlines()) == 5
+    response = client.post('/api/predict', data=data.to_csv(index=False), content_type='text/csv')
+    assert response.status_code == 200 and response.get_data(as_text=True).startswith('id,')
+
+    response = client.post('/api/predict', data='{"records": [', content_type='application/json')
+    assert response.status_code == 400 and 'error' in response.get_json()
+    response = client.post('/api/predict', json={'records': 'none'})
+    assert response.status_code == 400 and 'error' in response.get_json()
+    response = client.post('/api/predict', json=[data.iloc[0].to_dict(), 5])
+    assert response.status_code == 400 and 'JSON object' in response.get_json()['error']
+    response = client.post('/api/predict', json=data.drop(columns='total_day_minutes').to_dict(orient='records'))
+    assert response.status_code == 400 and 'Missing columns' in response.get_json()['error']
+    response = client.post('/api/predict', data=data.head(0).to_csv(index=False), content_type='text/csv')
+    assert response.status_code == 400 and response.get_json()['error'] == 'No records'
+    response = client.post('/api/predict', json=[{**data.iloc[0].to_dict(), 'number_vmail_messages': True}])
+    assert response.status_code == 400 and 'number_vmail_messages' in response.get_json()['errors'][0]
+    max_records = app_module.app.config['API_MAX_RECORDS']
+    app_module.app.config['API_MAX_RECORDS'] = 3
+    try:
+        response = client.post('/api/predict', json=data.to_dict(orient='records'))
+    finally:
+        app_module.app.config['API_MAX_RECORDS'] = max_records
+    assert response.status_code == 413 and 'error' in response.get_json()
+
+
+def test_api_customers_and_stats_responses(app_module):
+    """
+    Test the status codes and JSON bodies of /api/customers and /api/stats, including invalid parameters
+    """
+    client = app_module.app.test_client()
+    response = client.get('/api/customers?churn=Yes&limit=5')
+    body = response.get_json()
+    assert response.status_code == 200 and len(body['customers']) == 5
+    assert all(customer['churn'] == 'Yes' for customer in body['customers']) and body['next_after_id'] is not None
+    for query in ('limit=0', 'limit=ten', 'churn=Maybe'):
+        response = client.get(f'/api/customers?{query}')
+        assert response.status_code == 400 and 'error' in response.get_json()
+
+    body = client.get('/api/stats?by=international_plan').get_json()
+    assert [segment['international_plan'] for segment in body['segments']] == ['No', 'Yes']
+    assert body['totals']['customers'] == 2666
+    response = client.get('/api/stats?by=international_plan,state')
+    assert response.status_code == 400 and 'error' in response.get_json()
+
+
+def test_predict_form_and_metrics(app_module, monkeypatch):
+    """
+    Test that /predict saves the customer directly or through the write-behind queue, and that /metrics and
+    /api/status report the requests
+    """
+    client = app_module.app.test_client()
+    response = client.post('/predict', data=_form(900001))
+    assert response.status_code == 302
+    write_behind = WriteBehindQueue(app_module.write_customers, flush_interval_ms=1)
+    monkeypatch.setattr(app_module, 'write_behind', write_behind)
+    assert client.post('/predict', data=_form(900002)).status_code == 302
+    write_behind.close()
+    assert write_behind.stats()['written'] == 1
+    assert 'write_behind' in client.get('/api/status').get_json()
+    customers = client.get('/api/customers?after_id=900000').get_json()['customers']
+    assert [customer['id'] for customer in customers] == [900001, 900002]
+    response = client.post('/predict', data=_form(900003, vm_msg=-1))
+    assert response.status_code == 200 and b'A problem occurred' in response.data
+    response = client.post('/predict', data=_form(10 ** 30))
+    assert response.status_code == 200 and b'A problem occurred' in response.data
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    exported = response.get_data(as_text=True)
+    assert 'churn_http_requests_total{endpoint="/predict",method="POST",status="302"}' in exported
+
+
+def test_asgi_runs_requests_in_its_thread_pool():
+    """
+    Test that asgi.py runs the WSGI app in its own thread pool and sends the whole response, cut to Content-Length
+    """
+    code = (
+        'import asyncio, threading\n'
+        'from asgiref.testing import ApplicationCommunicator\n'
+        'import asgi\n'
+        'def wsgi_app(environ, start_response):\n'
+        '    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", "9")])\n'
+        '    return [threading.current_thread().name.encode()[:4], b"-", b"body-and-more"]\n'
+        'async def main():\n'
+        '    http = ApplicationCommunicator(asgi.ChurnApplication(wsgi_app), {"type": "http", "method": "GET",'
+        ' "path": "/", "query_string": b"", "headers": [], "http_version": "1.1"})\n'
+        '    await http.send_input({"type": "http.request", "body": b""})\n'
+        '    assert (await http.receive_output(5))["status"] == 200\n'
+        '    body = b""\n'
+        '    while True:\n'
+        '        message = await http.receive_output(5)\n'
+        '        body += message.get("body", b"")\n'
+        '        if not message.get("more_body"):\n'
+        '            break\n'
+        '    print(body.decode())\n'
+        'asyncio.run(main())\n')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=False)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split()[-1] == 'asgi-body'
+
+
+def test_asgi_application_serves_and_drains_write_behind(tmp_path):
+    """
+    Test that asgi.py serves the app and writes the records queued by /predict when the server shuts down
+    """
+    engine_string = f'sqlite:///{tmp_path / "churn.db"}'
+    create_db(engine_string)
+    code = (
+        'import asyncio\n'
+        'from asgiref.testing import ApplicationCommunicator\n'
+        'import asgi\n'
+        'async def main():\n'
+        '    lifespan = ApplicationCommunicator(asgi.application, {"type": "lifespan"})\n'
+        '    await lifespan.send_input({"type": "lifespan.startup"})\n'
+        '    assert (await lifespan.receive_output(5))["type"] == "lifespan.startup.complete"\n'
+        '    http = ApplicationCommunicator(asgi.application, {"type": "http", "method": "GET", "path": "/api/status",'
+        ' "query_string": b"", "headers": [], "http_version": "1.1"})\n'
+        '    await http.send_input({"type": "http.request", "body": b""})\n'
+        '    assert (await http.receive_output(5))["status"] == 200\n'
+        '    asgi.write_behind.submit({"id": 1, "international_plan": "No", "voice_mail_plan": "No",'
+        ' "number_vmail_messages": 0, "total_day_minutes": 1.0, "total_eve_minutes": 1.0,'
+        ' "total_night_minutes": 1.0, "total_intl_minutes": 1.0, "total_intl_calls": 1,'
+        ' "customer_service_calls": 1, "churn": "No"})\n'
+        '    await lifespan.send_input({"type": "lifespan.shutdown"})\n'
+        '    assert (await lifespan.receive_output(30))["type"] == "lifespan.shutdown.complete"\n'
+        '    print(asgi.write_behind.stats()["written"])\n'
+        'asyncio.run(main())\n')
+    env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': engine_string}
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=False)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split()[-1] == '1'